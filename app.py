@@ -1,191 +1,559 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, session
 import os.path
 from datetime import datetime, timedelta
-import requests
+import asyncio
+import atexit
 import json
+import logging
+import queue
 import re
 import secrets
-from groq import Groq
+import threading
+from functools import lru_cache
+from string import Template
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from dateparser import parse
+from timp import AdmissionsCache, AsyncTimpClient, AvailabilityBitmap, AvailabilitySnapshot, TimpClient, TimpError
+from sessions import MemoryBackend, SessionStore, SQLiteBackend
+from catalogue import CATALOGUE_PATH, Catalogue, fold_text
+from prewarm import AvailabilityPrewarmer
+from query_planner import DAY_PERIODS, AvailabilityQuery, plan_availability_query
+from llm_cache import LLMResponseCache
+from model_router import ModelRouter, ModelTier
+from resilience import UpstreamGuard, UpstreamUnavailable
+from llm_output import DEFAULT_REPLY, LLMOutputError, parse_llm_output
+from logging_config import setup_logging
+from metrics import (
+    REGISTRY, AVAILABILITY_SEARCH_DAYS, LLM_ESCALATIONS, LLM_SECONDS, LLM_TIER_SECONDS, LLM_TOKENS, LLM_PARSE_SECONDS,
+    PREFETCHES, STEP_SECONDS, UPSTREAM_ERRORS
+)
 from datetime import datetime, time
+from time import perf_counter
 
 
 load_dotenv()
 
-app = Flask(__name__)
+setup_logging()
+log = logging.getLogger('secretario.app')
 
-app.secret_key = secrets.token_hex(32) 
+app = Flask(__name__)
 
-def find_timp_slot(activity_id: int, date: str, time: str) -> str | None:
+# Clave fija por entorno para que la cookie de sesión sea válida en todos los workers
+app.secret_key = os.getenv('FLASK_SECRET_KEY') or secrets.token_hex(32)
+
+# Consultas de disponibilidad en paralelo (una petición por día)
+TIMP_MAX_CONCURRENCY = int(os.getenv('TIMP_MAX_CONCURRENCY', '8'))
+
+# Límite de ritmo y circuit breaker por servicio externo (compartidos por todas las sesiones)
+timp_guard = UpstreamGuard(
+    "timp",
+    rate=float(os.getenv('TIMP_RATE_LIMIT', '20')),
+    burst=int(os.getenv('TIMP_RATE_BURST', '40')),
+    failure_threshold=int(os.getenv('TIMP_BREAKER_FAILURES', '5')),
+    reset_timeout=float(os.getenv('TIMP_BREAKER_RESET', '30'))
+)
+groq_guard = UpstreamGuard(
+    "groq",
+    rate=float(os.getenv('GROQ_RATE_LIMIT', '20')),
+    burst=int(os.getenv('GROQ_RATE_BURST', '50')),
+    failure_threshold=int(os.getenv('GROQ_BREAKER_FAILURES', '3')),
+    reset_timeout=float(os.getenv('GROQ_BREAKER_RESET', '20'))
+)
+
+# Cliente TIMP compartido: reutiliza conexiones entre peticiones y usuarios
+timp_client = TimpClient(pool_maxsize=TIMP_MAX_CONCURRENCY)
+async_timp_client = AsyncTimpClient(pool_maxsize=TIMP_MAX_CONCURRENCY * 4)
+# Foto de disponibilidad del pre-calentador (las consultas en vivo solo como respaldo si TIMP cae)
+availability_snapshot = AvailabilitySnapshot(
+    max_age=float(os.getenv('PREWARM_MAX_AGE', '600')),
+    maxsize=int(os.getenv('SNAPSHOT_MAX_SIZE', '4096'))
+)
+admissions_cache = AdmissionsCache(
+    timp_client,
+    ttl=float(os.getenv('TIMP_CACHE_TTL', '60')),
+    maxsize=int(os.getenv('TIMP_CACHE_SIZE', '1024')),
+    async_client=async_timp_client,
+    snapshot=availability_snapshot,
+    guard=timp_guard
+)
+
+def find_timp_slot(activity_id: int, date: str, time: str, force_refresh: bool = False) -> str | None:
     """
     Busca un slot disponible en TIMP.
     Retorna el slot_id (str) si está disponible, None si no.
+    Con force_refresh=True ignora la caché (útil justo antes de generar el enlace).
     """
-    url = f"https://panel.timp.pro/api/user_app/v2/activities/{activity_id}/admissions"
-    params = {'date': date}
-
-    headers = {
-        'accept': 'application/timp.user-app-v2',
-        'accept-language': 'en_US',
-        'api-access-key': os.getenv('TIMP_API_KEY'),
-        'app-platform': 'web',
-        'app-version': '8.7.0',
-        'content-type': 'application/json',
-        'origin': 'https://web.timp.pro/',
-        'referer': 'https://web.timp.pro/',
-        'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Google Chrome";v="140"',
-        'sec-ch-ua-mobile': '?1',
-        'sec-ch-ua-platform': '"Android"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-site',
-        'time-zone': 'Europe/Madrid',
-        'user-agent': 'Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36'
-    }
-
     try:
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != 200:
-            print(f"Error al buscar sitio: {response.status_code} - {response.text}")
-            return None
+        index = admissions_cache.get_index(activity_id, date, force_refresh=force_refresh)
+    except Exception as e:
+        return _slot_lookup_failed(e, activity_id)
+    return _slot_at(index, activity_id, time)
 
-        slots = response.json()
+async def afind_timp_slot(activity_id: int, date: str, time: str, force_refresh: bool = False) -> str | None:
+    """Versión asíncrona de find_timp_slot (ruta ASGI)."""
+    try:
+        index = await admissions_cache.aget_index(activity_id, date, force_refresh=force_refresh)
+    except Exception as e:
+        return _slot_lookup_failed(e, activity_id)
+    return _slot_at(index, activity_id, time)
+
+def _slot_at(index, activity_id: int, time: str) -> str | None:
+    """slot_id del índice a la hora pedida, o None (común a find_timp_slot y afind_timp_slot)."""
+    slot_id = index.exact(time)
+    if slot_id is not None:
+        log.debug("Sitio encontrado", extra={"slot_id": slot_id, "activity_id": activity_id})
+        return slot_id
+
+    log.info("No se encontró sitio a esa hora", extra={"activity_id": activity_id})
+    return None
+
+def _slot_lookup_failed(error: Exception, activity_id: int) -> None:
+    if isinstance(error, TimpError):
+        log.warning("Error al buscar sitio: %s", error, extra={"activity_id": activity_id})
+    else:
+        log.error("Excepción al buscar slot", exc_info=error, extra={"activity_id": activity_id})
+    return None
+
+# Alternativas cuando la hora pedida no está libre
+SLOT_SEARCH_WINDOW = int(os.getenv('SLOT_SEARCH_WINDOW', '60'))          # ± minutos
+SLOT_SEARCH_ADJACENT_DAYS = int(os.getenv('SLOT_SEARCH_ADJACENT_DAYS', '1'))
+SLOT_SUGGESTIONS = int(os.getenv('SLOT_SUGGESTIONS', '3'))
+
+def day_period(text: str) -> tuple[str, str] | None:
+    """'por la mañana', 'tarde'... → franja ('HH:MM', 'HH:MM'), o None."""
+    text = fold_text(text or "")
+    for prefix in ("por la ", "a la ", "al ", "el ", "la "):
+        text = text.removeprefix(prefix)
+    return DAY_PERIODS.get(text)
+
+def _nearby_dates(date: str, adjacent_days: int) -> list[str]:
+    """El día pedido y luego los contiguos (+1, -1, +2...), sin días ya pasados."""
+    day = datetime.strptime(date, "%Y-%m-%d")
+    today = datetime.today().date()
+    dates = [date]
+    for offset in range(1, adjacent_days + 1):
+        for delta in (offset, -offset):
+            other = day + timedelta(days=delta)
+            if other.date() >= today:
+                dates.append(other.strftime("%Y-%m-%d"))
+    return dates
+
+def _day_lookup_failed(error: Exception, activity_id: int, check_date: str) -> None:
+    """Un día que no se pudo consultar cuenta como día sin huecos."""
+    log.warning("Error consultando disponibilidad: %s", error, extra={"activity_id": activity_id, "date": check_date})
+    return None
+
+def _pick_nearby(dates, indexes, time, period, window, limit) -> list[tuple[str, str]]:
+    found = []
+    for check_date, index in zip(dates, indexes):
+        if index is None:
+            continue
+        slots = index.window(*period) if period else index.nearest(time, window, limit)
+        found += [(check_date, t) for t, _ in slots]
+    return found[:limit]
+
+def find_nearby_slots(
+    activity_id: int,
+    date: str,
+    time: str | None = None,
+    period: tuple[str, str] | None = None,
+    window: int = SLOT_SEARCH_WINDOW,
+    adjacent_days: int = SLOT_SEARCH_ADJACENT_DAYS,
+    limit: int = SLOT_SUGGESTIONS
+) -> list[tuple[str, str]]:
+    """
+    Huecos más cercanos a `time` (±window minutos) o dentro de la franja `period`:
+    primero el día pedido y después los contiguos, consultados en paralelo y desde caché.
+    Retorna [('YYYY-MM-DD', 'HH:MM'), ...] con como mucho `limit` elementos.
+    """
+    def index_for(check_date):
+        try:
+            return admissions_cache.get_index(activity_id, check_date)
+        except Exception as e:
+            return _day_lookup_failed(e, activity_id, check_date)
+
+    dates = _nearby_dates(date, adjacent_days)
+    with ThreadPoolExecutor(max_workers=max(1, min(TIMP_MAX_CONCURRENCY, len(dates)))) as executor:
+        indexes = list(executor.map(index_for, dates))
+    return _pick_nearby(dates, indexes, time, period, window, limit)
+
+async def afind_nearby_slots(
+    activity_id: int,
+    date: str,
+    time: str | None = None,
+    period: tuple[str, str] | None = None,
+    window: int = SLOT_SEARCH_WINDOW,
+    adjacent_days: int = SLOT_SEARCH_ADJACENT_DAYS,
+    limit: int = SLOT_SUGGESTIONS
+) -> list[tuple[str, str]]:
+    """Versión asíncrona de find_nearby_slots."""
+    async def index_for(check_date):
+        try:
+            return await admissions_cache.aget_index(activity_id, check_date)
+        except Exception as e:
+            return _day_lookup_failed(e, activity_id, check_date)
 
-        for slot in slots:
-            if slot.get('status') == 'available':
-                hours_str = slot.get('hours', '')
-                start_time = hours_str.split(' - ')[0] if ' - ' in hours_str else hours_str
+    dates = _nearby_dates(date, adjacent_days)
+    indexes = await asyncio.gather(*(index_for(d) for d in dates))
+    return _pick_nearby(dates, indexes, time, period, window, limit)
 
-                if start_time == time:
-                    slot_id = slot['id']
-                    print(f"Sitio encontrado: ID={slot_id}, Hora={start_time}")
-                    return slot_id
+def _range_dates(start_offset: int, end_offset: int) -> list[str]:
+    """Días (YYYY-MM-DD) del rango de offsets desde hoy; nunca antes de hoy."""
+    today = datetime.today()
+    return [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(max(0, start_offset), end_offset + 1)]
 
-        print("No se encontró sitio a esa hora.")
-        return None
+def _fetch_free_bitmap(activity_id: int, check_date: str, timeout=None) -> AvailabilityBitmap:
+    """
+    Horas libres de un día como bitmap, del índice que la caché ya guarda junto a las
+    admisiones (no se vuelve a parsear el JSON). Un error cuenta como día sin huecos.
+    """
+    try:
+        return admissions_cache.get_index(activity_id, check_date, timeout=timeout).free
 
+    except TimpError:
+        return AvailabilityBitmap()
     except Exception as e:
-        print(f"Excepción al buscar slot: {str(e)}")
-        return None
+        _day_lookup_failed(e, activity_id, check_date)
+        return AvailabilityBitmap()
+
+def _free_times(bitmap: AvailabilityBitmap, window=None) -> list[str]:
+    """Horas de inicio libres del bitmap (solo las de la franja `window`, si se indica), ordenadas."""
+    return (bitmap.window(*window) if window else bitmap).times()
+
+def _fetch_available_times(activity_id: int, check_date: str, timeout=None, window=None) -> list[str]:
+    return _free_times(_fetch_free_bitmap(activity_id, check_date, timeout), window)
+
+def _search_dates(start_offset: int, end_offset: int, query: AvailabilityQuery | None) -> tuple[list[str], tuple | None]:
+    """Días a consultar y franja: los del plan si lo hay, si no el rango contiguo."""
+    if query is None:
+        return _range_dates(start_offset, end_offset), None
+    return query.dates(), query.window
+
+def _record_search(activity_id: int, check_dates: list[str], window):
+    """Cuántos días pide una búsqueda y cuántos de ellos tendrán que ir a TIMP (no estaban en caché)."""
+    upstream = sum(not admissions_cache.cached(activity_id, d) for d in check_dates)
+    AVAILABILITY_SEARCH_DAYS.observe(len(check_dates), source="requested")
+    AVAILABILITY_SEARCH_DAYS.observe(upstream, source="upstream")
+    log.info("Búsqueda de disponibilidad", extra={
+        "activity_id": activity_id, "days": len(check_dates), "upstream_calls": upstream, "window": window
+    })
 
 def get_available_dates_for_therapy(
     activity_id: int, 
     start_offset: int = 0, 
-    end_offset: int = 6
+    end_offset: int = 6,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+    on_day=None,
+    query: AvailabilityQuery | None = None
 ) -> dict:
-    available = {}
-    headers = {
-        'accept': 'application/timp.user-app-v2',
-        'accept-language': 'en_US',
-        'api-access-key': os.getenv('TIMP_API_KEY'),
-        'app-platform': 'web',
-        'app-version': '8.7.0',
-        'content-type': 'application/json',
-        'origin': 'https://web.timp.pro/',
-        'referer': 'https://web.timp.pro/',
-        'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Google Chrome";v="140"',
-        'sec-ch-ua-mobile': '?1',
-        'sec-ch-ua-platform': '"Android"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-site',
-        'time-zone': 'Europe/Madrid',
-        'user-agent': 'Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36'
-    }
+    """
+    Consulta en paralelo la disponibilidad de cada día del rango (o solo de los días
+    y la franja del plan `query`, si se pasa).
+    Retorna {'dd/mm': ['HH:MM', ...]} ordenado por fecha, igual que la versión secuencial.
+    Si se pasa on_day(fecha, horas), se invoca en cuanto termina cada día con huecos.
+    """
+    if max_workers is None:
+        max_workers = TIMP_MAX_CONCURRENCY
+
+    check_dates, window = _search_dates(start_offset, end_offset, query)
+    if not check_dates:
+        return {}
+    _record_search(activity_id, check_dates, window)
+
+    by_date = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(check_dates)))) as executor:
+        futures = {
+            executor.submit(_fetch_available_times, activity_id, d, timeout, window): d
+            for d in check_dates
+        }
+        for future in as_completed(futures):
+            _day_done(by_date, futures[future], future.result(), on_day)
+
+    return _by_date_in_order(check_dates, by_date)
+
+def _day_done(by_date: dict, check_date: str, slots_today: list[str], on_day=None):
+    """Guarda las horas de un día con huecos como ('dd/mm', horas) y avisa a on_day."""
+    if slots_today:
+        formatted_date = datetime.strptime(check_date, "%Y-%m-%d").strftime("%d/%m")
+        by_date[check_date] = (formatted_date, slots_today)
+        if on_day:
+            on_day(*by_date[check_date])
+
+def _by_date_in_order(check_dates: list[str], by_date: dict) -> dict:
+    """Resultado en orden de fecha, independiente del orden de llegada."""
+    return {by_date[d][0]: by_date[d][1] for d in check_dates if d in by_date}
+
+async def _afetch_available_times(activity_id: int, check_date: str, timeout=None, window=None) -> list[str]:
+    try:
+        bitmap = (await admissions_cache.aget_index(activity_id, check_date, timeout=timeout)).free
 
-    today = datetime.today()
-    for i in range(start_offset, end_offset + 1):
-        if i < 0:
-            continue
-        check_date = (today + timedelta(days=i)).strftime("%Y-%m-%d")
-        url = f"https://panel.timp.pro/api/user_app/v2/activities/{activity_id}/admissions"
-        params = {'date': check_date}
+    except TimpError:
+        return []
+    except Exception as e:
+        _day_lookup_failed(e, activity_id, check_date)
+        return []
+    return _free_times(bitmap, window)
+
+async def aget_available_dates_for_therapy(
+    activity_id: int,
+    start_offset: int = 0,
+    end_offset: int = 6,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+    on_day=None,
+    query: AvailabilityQuery | None = None
+) -> dict:
+    """
+    Versión asíncrona de get_available_dates_for_therapy: mismas consultas por día
+    lanzadas con asyncio, como máximo max_workers a la vez, y mismo resultado ordenado.
+    """
+    if max_workers is None:
+        max_workers = TIMP_MAX_CONCURRENCY
 
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code != 200:
-                continue
+    check_dates, window = _search_dates(start_offset, end_offset, query)
+    if check_dates:
+        _record_search(activity_id, check_dates, window)
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+    by_date = {}
 
-            slots = response.json()
-            slots_today = []
+    async def fetch(check_date):
+        async with semaphore:
+            slots_today = await _afetch_available_times(activity_id, check_date, timeout, window)
+        _day_done(by_date, check_date, slots_today, on_day)
 
-            for slot in slots:
-                if slot.get('status') == 'available':
-                    hours_str = slot.get('hours', '')
-                    start_time = hours_str.split(' - ')[0] if ' - ' in hours_str else hours_str
-                    slots_today.append(start_time)
+    await asyncio.gather(*(fetch(d) for d in check_dates))
 
-            if slots_today:
-                formatted_date = datetime.strptime(check_date, "%Y-%m-%d").strftime("%d/%m")
-                available[formatted_date] = sorted(set(slots_today))
+    return _by_date_in_order(check_dates, by_date)
 
-        except Exception as e:
-            print(f"Error checking date {check_date}: {e}")
-            continue
+# Hilos para las consultas anticipadas de la ruta síncrona (se crean al primer uso)
+prefetch_executor = ThreadPoolExecutor(max_workers=TIMP_MAX_CONCURRENCY, thread_name_prefix="prefetch")
+
+class SpeculativeFetch:
+    """
+    Consulta anticipada de la disponibilidad del paso 2 mientras responde el LLM.
+    No devuelve nada: los días quedan en admissions_cache y, si el paso 2 pide el
+    mismo rango, se une a las peticiones en curso (single-flight) o las encuentra
+    ya cacheadas. cancel() descarta los días que aún no habían empezado; los que
+    ya estaban en curso terminan y quedan en la caché.
+    """
+
+    def __init__(self, activity_id: int, query: AvailabilityQuery):
+        self.target = (activity_id, query)
+        self.cancelled = False
+        self._pending = []
+        # Referencias a las tareas asíncronas para que no se recojan antes de terminar
+        self._tasks = []
+        self._finished = False
+
+    def start(self):
+        activity_id, query = self.target
+        self._pending = [prefetch_executor.submit(self._fetch_day, activity_id, d) for d in query.dates()]
+        return self
+
+    def astart(self):
+        activity_id, query = self.target
+        semaphore = asyncio.Semaphore(max(1, TIMP_MAX_CONCURRENCY))
+        self._tasks = [asyncio.ensure_future(self._afetch_day(semaphore, activity_id, d)) for d in query.dates()]
+        return self
+
+    def _fetch_day(self, activity_id: int, check_date: str):
+        if not self.cancelled:
+            _fetch_free_bitmap(activity_id, check_date)
+
+    async def _afetch_day(self, semaphore, activity_id: int, check_date: str):
+        # No se cancela la tarea en curso: otras sesiones pueden estar esperando esa misma petición
+        async with semaphore:
+            if not self.cancelled:
+                await _afetch_available_times(activity_id, check_date)
+
+    def cancel(self):
+        self.cancelled = True
+        # Las tareas asíncronas miran self.cancelled al entrar; los hilos en cola se cancelan
+        for future in self._pending:
+            future.cancel()
+
+    def finish(self, target: tuple | None):
+        """Al conocer la respuesta del LLM: se aprovecha si el paso 2 pide lo mismo; si no, se cancela."""
+        if self._finished:
+            return
+        self._finished = True
+        if target == self.target:
+            PREFETCHES.inc(outcome="used")
+        else:
+            self.cancel()
+            PREFETCHES.inc(outcome="cancelled")
+
+# Máximo de días por consulta de /availability (multi-semana)
+AVAILABILITY_MAX_DAYS = int(os.getenv('AVAILABILITY_MAX_DAYS', '28'))
+
+HHMM_RE = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+
+def get_availability_bitmaps(
+    activity_ids: list[int],
+    check_dates: list[str],
+    max_workers: int | None = None,
+    timeout: float | None = None,
+    window: tuple[str, str] | None = None
+) -> dict:
+    """
+    Bitmaps de horas libres de varias actividades y días en un único lote concurrente
+    (una consulta por actividad y día, servida desde la caché si ya está), opcionalmente
+    recortados a la franja `window` ('HH:MM', 'HH:MM').
+    Retorna {activity_id: {'YYYY-MM-DD': AvailabilityBitmap}} con todos los días, también los vacíos.
+    """
+    if max_workers is None:
+        max_workers = TIMP_MAX_CONCURRENCY
 
-    return available
+    pairs = [(activity_id, d) for activity_id in activity_ids for d in check_dates]
+    bitmaps = {activity_id: {} for activity_id in activity_ids}
+    if not pairs:
+        return bitmaps
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pairs)))) as executor:
+        results = executor.map(lambda pair: _fetch_free_bitmap(*pair, timeout), pairs)
+        for (activity_id, check_date), bitmap in zip(pairs, results):
+            bitmaps[activity_id][check_date] = bitmap.window(*window) if window else bitmap
+
+    return bitmaps
+
+def combine_options(bitmaps: dict, how: str = "any") -> dict:
+    """
+    Combina por día los bitmaps de varias subopciones: 'any' (alguna libre, unión)
+    o 'all' (todas libres, intersección). Retorna {'YYYY-MM-DD': AvailabilityBitmap}.
+    """
+    combine = AvailabilityBitmap.union if how == "any" else AvailabilityBitmap.intersection
+    dates = list(dict.fromkeys(d for by_date in bitmaps.values() for d in by_date))
+    return {
+        d: combine(by_date.get(d, AvailabilityBitmap()) for by_date in bitmaps.values())
+        for d in dates
+    }
+
+def free_options_at(bitmaps: dict, time: str) -> dict:
+    """
+    Qué subopciones tienen hueco a `time` cada día, a partir de los bitmaps de
+    get_availability_bitmaps: {'YYYY-MM-DD': [activity_id, ...]} solo con los días en que alguna está libre.
+    """
+    free = {}
+    for activity_id, by_date in bitmaps.items():
+        for check_date, bitmap in by_date.items():
+            if bitmap.has(time):
+                free.setdefault(check_date, []).append(activity_id)
+    return dict(sorted(free.items()))
+
+def get_availability_grid(
+    activity_ids: list[int],
+    start_offset: int = 0,
+    days: int = 14,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+    window: tuple[str, str] | None = None
+) -> dict:
+    """
+    Disponibilidad de varias actividades y semanas (ver get_availability_bitmaps).
+    Retorna {activity_id: {'YYYY-MM-DD': ['HH:MM', ...]}} solo con los días con huecos, en orden.
+    """
+    check_dates = _range_dates(start_offset, max(0, start_offset) + days - 1)
+    return times_grid(get_availability_bitmaps(activity_ids, check_dates, max_workers, timeout, window))
+
+def times_grid(bitmaps: dict) -> dict:
+    """{activity_id: {'YYYY-MM-DD': AvailabilityBitmap}} → {activity_id: {'YYYY-MM-DD': ['HH:MM', ...]}} sin días vacíos."""
+    return {
+        activity_id: {d: bitmap.times() for d, bitmap in by_date.items() if bitmap}
+        for activity_id, by_date in bitmaps.items()
+    }
+
+# Ventana de historial enviada al LLM: últimos N mensajes dentro de un presupuesto de tokens
+LLM_HISTORY_MESSAGES = int(os.getenv('LLM_HISTORY_MESSAGES', '6'))
+LLM_HISTORY_TOKEN_BUDGET = int(os.getenv('LLM_HISTORY_TOKEN_BUDGET', '1000'))
+# Mensajes que se conservan en memoria por conversación (además del prompt de sistema)
+HISTORY_MAX_STORED = int(os.getenv('HISTORY_MAX_STORED', '20'))
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata (~4 caracteres por token), suficiente para acotar el prompt."""
+    return len(text) // 4 + 1
+
+THINK_BLOCK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+THINK_LINE_RE = re.compile(r'^\s*<think>.*$', re.MULTILINE)
 
 def clean_llm_response(text: str) -> str:
     """
     Elimina cualquier rastro de <think>... incluso si no está bien cerrado.
     También elimina texto antes del primer '{' si es necesario.
+    (El turno usa parse_llm_output, que hace todo esto en una pasada.)
     """
-    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
-    text = re.sub(r'^\s*<think>.*$', '', text, flags=re.MULTILINE)
-    text = re.sub(r'\n\s*\n', '\n', text)
-    text = text.strip()
+    text = THINK_BLOCK_RE.sub('', text)
+    text = THINK_LINE_RE.sub('', text).strip()
+
+    start, end = text.find('{'), text.rfind('}')
+    if start > 0 and end > start:
+        text = text[start:end + 1]
 
     return text
 
+JSON_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+class ReplyStreamExtractor:
+    """
+    Extrae de forma incremental el texto de "respuesta" de un JSON que llega por trozos,
+    para poder mostrarlo mientras el LLM todavía está generando.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Añade un trozo y devuelve el texto nuevo de "respuesta" ya decodificado."""
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = re.search(r'"respuesta"\s*:\s*"', self.buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buf, i, out = self.buffer, self._pos, []
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self.done = True
+                i += 1
+                break
+            if c != '\\':
+                out.append(c)
+                i += 1
+                continue
+            # Secuencia de escape: esperar a tenerla completa
+            if i + 1 >= len(buf):
+                break
+            if buf[i + 1] != 'u':
+                out.append(JSON_ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            # Emojis llegan como par de surrogates (\ud83d\ude05): decodificar juntos
+            size = 12 if buf[i + 2:i + 4].lower() in ('d8', 'd9', 'da', 'db') else 6
+            if i + size > len(buf):
+                break
+            try:
+                out.append(json.loads(f'"{buf[i:i + size]}"'))
+            except ValueError:
+                pass
+            i += size
+        self._pos = i
+        return ''.join(out)
+
 def interpret_date_range(user_message: str, today: datetime) -> tuple[int, int]:
     """
     Interpreta frases como "la semana que viene", "el miércoles que viene", etc.
-    Retorna (start_days_from_today, end_days_from_today)
+    Retorna (start_days_from_today, end_days_from_today); el paso 2 usa el plan
+    completo (días concretos + franja) de plan_availability_query.
     """
-    msg = user_message.lower()
-    weekday_names = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
-    
-    # Caso: "la semana que viene" → días 7 a 13
-    if any(phrase in msg for phrase in ["semana que viene", "próxima semana", "semana próxima"]):
-        return 7, 13
-
-    # Caso: "el [día] que viene"
-    for i, day_name in enumerate(weekday_names):
-        if f"{day_name} que viene" in msg or f"próximo {day_name}" in msg:
-            # Días hasta el próximo X
-            days_ahead = (i - today.weekday() + 7) % 7
-            if days_ahead == 0:
-                days_ahead = 7  # si es hoy, ir al próximo
-            return days_ahead - 1, days_ahead + 1  # ±1 día de margen
-
-    # Caso: "en X días"
-    import re
-    match = re.search(r"en\s+(\d+)\s*d[ií]as", msg)
-    if match:
-        n = int(match.group(1))
-        return n - 1, n + 2
-
-    # Caso: "del 20 al 25" → convertir a offsets
-    match = re.search(r"del\s+(\d+)\s+al\s+(\d+)", msg)
-    if match:
-        try:
-            day1, day2 = int(match.group(1)), int(match.group(2))
-            # Asumir mismo mes (simplificación)
-            date1 = today.replace(day=day1)
-            date2 = today.replace(day=day2)
-            if date1 < today:
-                date1 = date1.replace(month=date1.month + 1)
-            if date2 < today:
-                date2 = date2.replace(month=date2.month + 1)
-            start_offset = (date1 - today).days
-            end_offset = (date2 - today).days
-            return max(0, start_offset), min(21, end_offset)  # límite 3 semanas
-        except:
-            pass
-
-    # Por defecto: próximos 7 días
-    return 0, 6
+    return plan_availability_query(user_message, today, AVAILABILITY_MAX_DAYS).span
 
 def normalize_date_string(date_str: str, today: datetime = None) -> str:
     """
@@ -221,127 +589,535 @@ def normalize_date_string(date_str: str, today: datetime = None) -> str:
     else:
         raise ValueError("Formato de fecha no reconocido")
 
-THERAPY_OPTIONS = {
-    "ondas": {
-        "first_visit": {"id": 109996, "name": "Primera Visita Ondas"},
-        "options": [
-            {"id": 109998, "name": "Tratamiento Ondas Focales"},
-            {"id": 109999, "name": "Tratamiento Ondas Radiales"}
-        ]
-    },
-    "fisioterapia": {
-        "first_visit": {"id": 72648, "name": "Fisioterapia 1ª visita"},
-        "options": [
-            {"id": 72574, "name": "Fisioterapia"},
-            {"id": 96265, "name": "Fisio+Indiba+Láser"}
-        ]
-    },
-    "indiba": {
-        "first_visit": None,
-        "options": [
-            {"id": 72573, "name": "Indiba 45'"},
-            {"id": 97822, "name": "Indiba + Láser"}
-        ]
-    },
-    "láser": {
-        "first_visit": None,
-        "options": [
-            {"id": 94798, "name": "Láser"},
-            {"id": 110000, "name": "Tratamiento Láser"}
-        ]
-    },
-    "osteopatía": {
-        "first_visit": {"id": 72651, "name": "Osteopatía 1ª visita"},
-        "options": [
-            {"id": 72576, "name": "Osteopatía"}
-        ]
-    }
+# Catálogo de terapias (terapias.json), cargado una vez e indexado para búsquedas O(1)
+catalogue = Catalogue(os.getenv('CATALOGUE_PATH', CATALOGUE_PATH))
+
+# Pre-calentador de disponibilidad: desactivado salvo PREWARM_ENABLED=1
+# (con varios workers conviene activarlo solo en uno)
+prewarmer = AvailabilityPrewarmer(
+    admissions_cache,
+    activity_ids=catalogue.activity_ids,
+    days=int(os.getenv('PREWARM_DAYS', '7')),
+    interval=float(os.getenv('PREWARM_INTERVAL', '300')),
+    rate=float(os.getenv('PREWARM_RATE', '2'))
+)
+if os.getenv('PREWARM_ENABLED') == '1':
+    prewarmer.start()
+
+def normalize_subopcion(val: str) -> str:
+    """Convierte el nombre que da el usuario o el LLM al nombre EXACTO del catálogo."""
+    return catalogue.option_name(val) or fold_text(val).title()
+
+class FastPathStats:
+    """Contadores de aciertos del parser local (turnos resueltos sin LLM)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+fast_path_stats = FastPathStats()
+
+llm_cache = LLMResponseCache(
+    ttl=float(os.getenv('LLM_CACHE_TTL', '3600')),
+    maxsize=int(os.getenv('LLM_CACHE_SIZE', '2048'))
+)
+
+FAST_DATE_TIME_RE = re.compile(
+    r"^(?:(?:el|para el|dia)\s+)?(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?"
+    r"(?:\s*(?:,|-|a las|a la|sobre las)?\s*(\d{1,2})[:.h](\d{2}))?$"
+)
+FAST_TIME_RE = re.compile(r"^(?:(?:a las|a la|sobre las)\s+)?(\d{1,2})[:.h](\d{2})(?:\s*h)?$")
+
+def _fast_time(h: str, m: str) -> str | None:
+    h, m = int(h), int(m)
+    if 0 <= h <= 23 and 0 <= m <= 59:
+        return f"{h:02d}:{m:02d}"
+    return None
+
+def fast_extract_slots(user_message: str, user_data: dict, today: datetime = None) -> dict | None:
+    """
+    Extracción local sin LLM para respuestas estructuradas:
+    'Fisioterapia', 'Indiba + Láser', '20/10 a las 09:15', 'a las 10:30'.
+    Solo devuelve datos si TODO el mensaje se ha reconocido; si no, None (→ LLM).
+    """
+    msg = re.sub(r"[¿?¡!]", "", fold_text(user_message)).strip(" .")
+    if not msg:
+        return None
+
+    terapia_key = catalogue.therapy_key(user_data.get("terapia", ""))
+
+    # Con terapia elegida: ¿es una de sus subopciones?
+    if terapia_key:
+        name = catalogue.option_name(msg, therapy=terapia_key)
+        if name:
+            return {"subopcion": name}
+
+    # Nombre de terapia
+    key = catalogue.therapy_key(msg)
+    if key and key != terapia_key and not user_data.get("subopcion"):
+        return {"terapia": catalogue.therapy_name(key)}
+
+    # Subopción de cualquier terapia (implica la terapia); los alias sin contexto son ambiguos
+    if not terapia_key:
+        name = catalogue.option_name(msg, aliases=False)
+        if name:
+            key = catalogue.therapy_for_activity(catalogue.activity_id(name))
+            return {"terapia": catalogue.therapy_name(key), "subopcion": name}
+
+    # Fecha y hora: solo tienen sentido con terapia y subopción ya elegidas
+    if not (terapia_key and user_data.get("subopcion")):
+        return None
+
+    match = FAST_DATE_TIME_RE.match(msg)
+    if match and match.group(4):
+        day, month, year, h, m = match.groups()
+        hora = _fast_time(h, m)
+        try:
+            date_str = f"{int(day):02d}/{int(month):02d}" + (f"/{year}" if year else "")
+            fecha = normalize_date_string(date_str, today)
+            datetime.strptime(fecha, "%d/%m/%y")
+        except (ValueError, IndexError):
+            return None
+        return {"fecha": fecha, "hora": hora} if hora else None
+
+    match = FAST_TIME_RE.match(msg)
+    if match and user_data.get("fecha"):
+        hora = _fast_time(*match.groups())
+        return {"hora": hora} if hora else None
+
+    return None
+
+def _record_llm_usage(usage):
+    """Suma los tokens de una respuesta de Groq (si la trae)."""
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if isinstance(value, int):
+            LLM_TOKENS.inc(value, kind=kind.split("_")[0])
+
+def _record_llm_error(mode: str, start: float, error: Exception):
+    LLM_SECONDS.observe(perf_counter() - start, mode=mode, outcome="error")
+    UPSTREAM_ERRORS.inc(upstream="groq", reason=type(error).__name__)
+
+def _feed_llm_chunk(chunk, extractor: ReplyStreamExtractor, on_token):
+    """Un trozo del streaming de Groq: suma tokens y emite el texto de "respuesta" que ya se pueda."""
+    _record_llm_usage(getattr(getattr(chunk, "x_groq", None), "usage", None))
+    delta = chunk.choices[0].delta.content if chunk.choices else None
+    if delta:
+        text = extractor.feed(delta)
+        if text:
+            on_token(text)
+
+def _llm_completion_text(chat_completion) -> str:
+    _record_llm_usage(getattr(chat_completion, "usage", None))
+    return chat_completion.choices[0].message.content
+
+def _llm_call_done(mode: str, tier: ModelTier, start: float, raw_content: str) -> str:
+    LLM_SECONDS.observe(perf_counter() - start, mode=mode, outcome="ok")
+    LLM_TIER_SECONDS.observe(perf_counter() - start, tier=tier.name, outcome="ok")
+    return raw_content
+
+def _llm_call_failed(mode: str, tier: ModelTier, start: float, error: Exception) -> str:
+    """Registra el fallo (salvo circuito abierto, que no llegó a Groq) y devuelve la respuesta de reserva."""
+    if not isinstance(error, UpstreamUnavailable):
+        _record_llm_error(mode, start, error)
+        LLM_TIER_SECONDS.observe(perf_counter() - start, tier=tier.name, outcome="error")
+    log.error("Error en extracción LLM: %s", error, extra={"mode": mode, "tier": tier.name})
+    return LLM_FALLBACK_RESPONSE
+
+HHMM_TEXT_RE = re.compile(r'^\d{1,2}:\d{2}$')
+
+def slot_problems(data: dict, user_data: dict) -> list[str]:
+    """
+    Campos que devolvió el LLM pero no encajan con el catálogo o con el formato que
+    esperan los pasos 1-3; si hay alguno, la extracción es de poca confianza.
+    """
+    problems = []
+    terapia = data.get("terapia") or user_data.get("terapia")
+    terapia_key = catalogue.therapy_key(terapia.lower()) if terapia else None
+    if data.get("terapia") and not terapia_key:
+        problems.append("terapia")
+    subopcion = data.get("subopcion")
+    if subopcion and terapia_key and not catalogue.activity_id(normalize_subopcion(subopcion), therapy=terapia_key):
+        problems.append("subopcion")
+    if data.get("fecha"):
+        try:
+            datetime.strptime(data["fecha"], "%d/%m/%y")
+        except ValueError:
+            problems.append("fecha")
+    hora = data.get("hora")
+    if hora and not HHMM_TEXT_RE.match(hora) and day_period(hora) is None:
+        problems.append("hora")
+    return problems
+
+# Consultar la disponibilidad del paso 2 en paralelo con la llamada al LLM
+SPECULATIVE_PREFETCH = os.getenv('SPECULATIVE_PREFETCH', '1') != '0'
+
+LLM_FALLBACK_RESPONSE = '{"respuesta": "Vaya, tuve un pequeño fallo técnico. ¿Podrías repetirme eso, por favor? 😅", "data": {"fecha": "?", "hora": "?", "terapia": "?"}}'
+
+LLM_DEGRADED_REPLY = "Ahora mismo voy un poco justo y necesito respuestas sencillas 🙏\n{question}"
+
+# Prompt de sistema: prefijo fijo, idéntico en todas las sesiones y todos los días (el proveedor
+# puede reutilizarlo entre llamadas), + una cabecera corta con la fecha de hoy y los datos ya recogidos
+LLM_OUTPUT_MODE = os.getenv('LLM_OUTPUT_MODE', 'compact')
+
+OUTPUT_FORMATS = {
+    # Respuesta completa en cada turno (los pasos 1-3 la sustituyen por su propio texto)
+    "full": (
+        "- Responde SIEMPRE en JSON válido con este formato:\n"
+        '{"respuesta": "mensaje amable en español", '
+        '"data": {"terapia": "?", "subopcion": "?", "fecha": "?", "hora": "?"}}\n'
+        "- Si falta algo, pregunta con empatía en 'respuesta', y deja los campos como '?'."
+    ),
+    # Solo lo que cambia; el texto lo pone la aplicación salvo que haga falta uno libre
+    "compact": (
+        "- Responde SIEMPRE con un objeto JSON con SOLO los campos que este mensaje aporta o cambia, "
+        'de entre "terapia", "subopcion", "fecha" y "hora". Nada de \'?\'; sin datos nuevos: {}.\n'
+        '- Añade "respuesta" (breve, amable, en español) SOLO si aún no hay terapia elegida '
+        "o el usuario pregunta algo; el resto de mensajes los escribe la aplicación.\n"
+        '  Ej: {"fecha": "17/10/25", "hora": "10:00"}'
+    ),
 }
 
+SYSTEM_PROMPT_TEMPLATE = Template(
+    "Eres SecretarioAI, un asistente empático de agendamiento.\n\n"
+    "REGLAS ESTRICTAS:\n"
+    "$output_format\n\n"
+    "INSTRUCCIONES:\n"
+    "- Convierte CUALQUIER expresión de fecha/hora a formato estándar, usando HOY (ver abajo) como base:\n"
+    "  • 'mañana' → HOY + 1 día, hora='10:00'\n"
+    "  • 'pasado mañana por la tarde' → HOY + 2 días, hora='17:00'\n"
+    "  • 'el 27 a las 8' → el próximo día 27, hora='08:00'\n"
+    "  • 'la semana que viene' → HOY + 7 días, hora='10:00'\n"
+    "  • 'el martes que viene' → el próximo martes, hora='10:00'\n"
+    "  • 'a las 3' → hora='15:00'\n"
+    "- Formato de salida:\n"
+    "  • fecha: SIEMPRE dd/mm/yy (ej: 27/10/25)\n"
+    "  • hora: SIEMPRE HH:MM (ej: 08:00)\n"
+    "- terapia: uno de: $therapies.\n"
+    "- subopcion: nombre EXACTO de la opción (ej: \"$option\", no \"$option_lower\").\n"
+    "- Si el usuario dice 'láser' o 'Láser', normaliza a 'Láser'.\n"
+    "- **NUNCA digas 'formato inválido', 'error', ni nada técnico.**\n"
+    "- **NUNCA inventes enlaces.**"
+)
+
+WEEKDAY_NAMES = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+
+@lru_cache(maxsize=4)
+def _system_message(output_mode: str, therapies: tuple[str, ...], option: str) -> dict:
+    content = SYSTEM_PROMPT_TEMPLATE.substitute(
+        output_format=OUTPUT_FORMATS.get(output_mode, OUTPUT_FORMATS["full"]), therapies=', '.join(therapies),
+        option=option, option_lower=option.lower())
+    return {"role": "system", "content": content}
+
+def _option_example() -> str:
+    """Subopción del catálogo para el ejemplo del prompt; mejor una con tildes, que es donde más se equivoca."""
+    names = [choice["name"] for key in catalogue.therapies for choice in catalogue.choices(key)]
+    return next((name for name in names if any(c in "áéíóúñ" for c in name.lower())), names[0] if names else "")
+
+def system_message() -> dict:
+    """Prefijo fijo del prompt; se formatea una vez (o al recargar el catálogo) y lo comparten todas las sesiones."""
+    return _system_message(LLM_OUTPUT_MODE, tuple(catalogue.therapy_names()), _option_example())
+
+def date_header(today: datetime | None = None) -> str:
+    """Parte variable del prompt, detrás del prefijo fijo: 'Hoy es jueves 16/10/2025.'"""
+    today = today or datetime.now()
+    return f"Hoy es {WEEKDAY_NAMES[today.weekday()]} {today:%d/%m/%Y}."
+
+def missing_slot_reply(user_data: dict) -> str:
+    """Texto del turno cuando el LLM (formato compacto) no ha escrito "respuesta"."""
+    if not user_data.get("terapia"):
+        return "¿Qué tipo de terapia te gustaría reservar?\n" + "\n".join(f"• {name}" for name in catalogue.therapy_names())
+    if user_data.get("fecha") and not user_data.get("hora"):
+        return f"¿A qué hora te viene bien el {user_data['fecha']}? Por ejemplo: 'a las 10' o 'por la tarde'."
+    if not user_data.get("fecha"):
+        return "¿Qué día te viene bien? Por ejemplo: 'mañana por la tarde' o 'el martes que viene'."
+    return DEFAULT_REPLY
+
+# Por defecto el SDK espera 60 s y reintenta 2 veces: un turno podría bloquear un worker
+# ~3 min antes de que el circuit breaker cuente un solo fallo
+GROQ_TIMEOUT = float(os.getenv('GROQ_TIMEOUT', '15'))
+GROQ_MAX_RETRIES = int(os.getenv('GROQ_MAX_RETRIES', '1'))
+
+def Groq(**kwargs):
+    """Cliente Groq síncrono; el SDK se importa al primer uso para no frenar el arranque."""
+    from groq import Groq as client_class
+    return client_class(**{"timeout": GROQ_TIMEOUT, "max_retries": GROQ_MAX_RETRIES, **kwargs})
+
+def AsyncGroq(**kwargs):
+    from groq import AsyncGroq as client_class
+    return client_class(**{"timeout": GROQ_TIMEOUT, "max_retries": GROQ_MAX_RETRIES, **kwargs})
+
 class NaturalAppointmentAgent:
-    def __init__(self, model_name="llama-3.1-8b-instant"):
+    def __init__(self, model_name="llama-3.1-8b-instant", client=None, async_client=None):
         self.model = model_name
+        # Nivel de modelo según la dificultad del turno (ver model_router)
+        self.router = ModelRouter(model_name)
         self.user_data = {}
-        today = datetime.now()
-        today_str = today.strftime("%d/%m/%Y")
-
-        self.conversation_history = [
-                {
-                    "role": "system",
-                    "content": (
-                        f"Hoy es {today_str}. Eres SecretarioAI, un asistente empático de agendamiento.\n\n"
-                        "REGLAS ESTRICAS:\n"
-                        "- Responde SIEMPRE en JSON válido con este formato:\n"
-                        '{\n'
-                        '  "respuesta": "mensaje amable en español",\n'
-                        '  "data": {\n'
-                        '    "terapia": "?",\n'
-                        '    "subopcion": "?",\n'
-                        '    "fecha": "?",\n'
-                        '    "hora": "?"\n'
-                        '  }\n'
-                        '}\n\n'
-                        "INSTRUCCIONES:\n"
-                        "- Convierte CUALQUIER expresión de fecha/hora a formato estándar, usando HOY como base:\n"
-                        "  • 'el 27 a las 8' → fecha='27/10/25', hora='08:00'\n"
-                        "  • 'mañana' → fecha='17/10/25', hora='10:00'\n"
-                        "  • 'pasado mañana por la tarde' → fecha='18/10/25', hora='17:00'\n"
-                        "  • 'la semana que viene' → fecha='24/10/25', hora='10:00'\n"
-                        "  • 'el martes que viene' → fecha='21/10/25', hora='10:00'\n"
-                        "  • 'a las 3' → hora='15:00'\n"
-                        "- Formato de salida:\n"
-                        "  • fecha: SIEMPRE dd/mm/yy (ej: 27/10/25)\n"
-                        "  • hora: SIEMPRE HH:MM (ej: 08:00)\n"
-                        "- terapia: uno de: Ondas, Fisioterapia, Indiba, Láser, Osteopatía.\n"
-                        "- subopcion: nombre EXACTO de la opción (ej: \"Tratamiento Laser\", no \"tratamiento láser\").\n"
-                        "- Si el usuario dice 'láser' o 'Láser', normaliza a 'Láser'.\n"
-                        "- Si falta algo, pregunta con empatía en 'respuesta', y deja los campos como '?'.\n"
-                        "- **NUNCA digas 'formato inválido', 'error', ni nada técnico.**\n"
-                        "- **NUNCA inventes enlaces.**"
-                    )
-                }
-            ]
-    
-        groq_api_key = os.getenv('GROQ_API_KEY')
-        self.client = Groq(api_key=groq_api_key)
+        self.conversation_history = [system_message()]
+
+        if client is None:
+            groq_api_key = os.getenv('GROQ_API_KEY')
+            client = Groq(api_key=groq_api_key)
+        self.client = client
+        self.last_step = None
+        # El cliente asíncrono (ruta ASGI) se crea al primer uso si no se comparte uno
+        self.async_client = async_client
+
+    # Estado compacto para los backends de sesión: roles abreviados y sin el prompt de sistema
+    ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+    ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+    def dump_state(self) -> dict:
+        return {
+            "d": self.user_data,
+            "h": [[self.ROLE_CODES[m["role"]], m["content"]] for m in self.conversation_history[1:]]
+        }
+
+    def load_state(self, state: dict):
+        self.user_data = dict(state.get("d", {}))
+        self.conversation_history = self.conversation_history[:1] + [
+            {"role": self.ROLE_NAMES[role], "content": content} for role, content in state.get("h", [])
+        ]
 
     def is_data_complete(self):
         required = ["fecha", "hora", "terapia"]
         return all(key in self.user_data for key in required)
 
-    def extract_data_with_llm(self, user_message):
-        messages = self.conversation_history + [{"role": "user", "content": user_message}]
+    def build_llm_messages(self, user_message: str) -> list[dict]:
+        """
+        Construye el prompt acotado: prefijo fijo + cabecera (fecha de hoy y datos ya
+        recogidos) + últimos mensajes que quepan en el presupuesto + mensaje actual.
+        """
+        history = self.conversation_history[1:]
+        # send_message ya añadió el mensaje actual al historial: no duplicarlo
+        if history and history[-1] == {"role": "user", "content": user_message}:
+            history = history[:-1]
+
+        budget = LLM_HISTORY_TOKEN_BUDGET
+        window = []
+        for msg in reversed(history[-LLM_HISTORY_MESSAGES:] if LLM_HISTORY_MESSAGES > 0 else []):
+            cost = estimate_tokens(msg["content"])
+            if cost > budget:
+                break
+            budget -= cost
+            window.append(msg)
+        window.reverse()
+
+        # La fecha va aparte del prefijo: una sesión abierta tras medianoche ve el nuevo día
+        # sin que cambie el texto fijo
+        self.conversation_history[0] = system_message()
+        header = date_header()
+        if self.user_data:
+            header += f" Datos ya recogidos: {json.dumps(self.user_data, ensure_ascii=False)}"
+        messages = [self.conversation_history[0], {"role": "system", "content": header}]
+        return messages + window + [{"role": "user", "content": user_message}]
+
+    def _trim_history(self):
+        """Conserva el prompt de sistema y solo los últimos HISTORY_MAX_STORED mensajes."""
+        if len(self.conversation_history) > HISTORY_MAX_STORED + 1:
+            self.conversation_history = self.conversation_history[:1] + self.conversation_history[-HISTORY_MAX_STORED:]
+
+    def _llm_request(self, user_message: str, stream: bool, tier: ModelTier) -> dict:
+        """Parámetros de la llamada al LLM (el modo JSON de Groq no admite streaming)."""
+        request = {
+            "messages": self.build_llm_messages(user_message),
+            "model": tier.model,
+            "temperature": 0.3,
+            "max_tokens": tier.max_tokens,
+            "top_p": 1,
+            "stream": stream,
+            "stop": None
+        }
+        if not stream:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    def extract_data_with_llm(self, user_message, on_token=None, tier: ModelTier | None = None):
+        """
+        Llama al LLM y devuelve su salida tal cual (la limpia y valida parse_llm_output).
+        Con on_token(texto) la llamada es en streaming y se emite el texto de "respuesta" según llega.
+        tier elige modelo y tope de tokens (por defecto, el modelo del agente).
+        """
+        tier = tier or self.router.default
+        mode = "stream" if on_token else "sync"
+        start = perf_counter()
         try:
-            chat_completion = self.client.chat.completions.create(
-                messages=messages,
-                model=self.model,
-                temperature=0.3,
-                max_tokens=800,
-                top_p=1,
-                stream=False,
-                stop=None,
-                response_format={"type": "json_object"}
-            )
-            raw_content = chat_completion.choices[0].message.content
-            return clean_llm_response(raw_content)
+            with groq_guard.call():
+                response = self.client.chat.completions.create(**self._llm_request(user_message, bool(on_token), tier))
+                if on_token:
+                    extractor = ReplyStreamExtractor()
+                    for chunk in response:
+                        _feed_llm_chunk(chunk, extractor, on_token)
+                    raw_content = extractor.buffer
+                else:
+                    raw_content = _llm_completion_text(response)
         except Exception as e:
-            print(f"Error en extracción LLM: {e}")
-            return '{"respuesta": "Vaya, tuve un pequeño fallo técnico. ¿Podrías repetirme eso, por favor? 😅", "data": {"fecha": "?", "hora": "?", "terapia": "?"}}'
-
-    def update_data_from_llm_response(self, llm_response):
+            return _llm_call_failed(mode, tier, start, e)
+        return _llm_call_done(mode, tier, start, raw_content)
+
+    async def aextract_data_with_llm(self, user_message, on_token=None, tier: ModelTier | None = None):
+        """Igual que extract_data_with_llm pero con el cliente asíncrono de Groq."""
+        if self.async_client is None:
+            self.async_client = AsyncGroq(api_key=os.getenv('GROQ_API_KEY'))
+        tier = tier or self.router.default
+        mode = "async_stream" if on_token else "async"
+        start = perf_counter()
         try:
-            cleaned_response = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', llm_response).strip()
-            data = json.loads(cleaned_response)
-            if 'data' in data and isinstance(data['data'], dict):
-                for key in ["fecha", "hora", "terapia"]:
-                    val = data['data'].get(key)
-                    if val and val != "?":
-                        self.user_data[key] = str(val).strip()
+            async with groq_guard.acall():
+                response = await self.async_client.chat.completions.create(**self._llm_request(user_message, bool(on_token), tier))
+                if on_token:
+                    extractor = ReplyStreamExtractor()
+                    async for chunk in response:
+                        _feed_llm_chunk(chunk, extractor, on_token)
+                    raw_content = extractor.buffer
+                else:
+                    raw_content = _llm_completion_text(response)
         except Exception as e:
-            print(f"Error al actualizar datos: {e}")
+            return _llm_call_failed(mode, tier, start, e)
+        return _llm_call_done(mode, tier, start, raw_content)
+
+    def _parse_llm(self, llm_response: str) -> tuple:
+        """
+        (LLMOutput o None, motivo para escalar o None). Motivos: 'parse_error',
+        'truncated' (JSON cortado, típico del tope de tokens) e 'invalid_slots'.
+        """
+        log.debug("Respuesta LLM", extra={"llm_raw": llm_response})
+        parse_start = perf_counter()
+        try:
+            parsed = parse_llm_output(llm_response)
+        except LLMOutputError as e:
+            LLM_PARSE_SECONDS.observe(perf_counter() - parse_start, outcome="error")
+            log.warning("JSON inválido del LLM: %s", e, extra={"llm_raw": llm_response})
+            return None, "parse_error"
+        LLM_PARSE_SECONDS.observe(perf_counter() - parse_start, outcome="recovered" if parsed.recovered else "ok")
+        if parsed.recovered:
+            return parsed, "truncated"
+        problems = slot_problems(parsed.data.slots(), self.user_data)
+        if problems:
+            log.info("Datos del LLM que no validan", extra={"fields": problems})
+            return parsed, "invalid_slots"
+        return parsed, None
 
-    def send_message(self, user_message: str) -> str:
-        print(f"[DEBUG] 🧠 Estado actual de user_data: {self.user_data}")
+    def update_data_from_llm_response(self, llm_response):
+        try:
+            data = parse_llm_output(llm_response).data
+        except LLMOutputError as e:
+            log.warning("Error al actualizar datos: %s", e)
+            return
+        for key in ["fecha", "hora", "terapia"]:
+            val = getattr(data, key)
+            if val:
+                self.user_data[key] = val
+
+    def send_message(self, user_message: str, on_event=None) -> str:
+        """
+        Procesa un mensaje y devuelve la respuesta final.
+        on_event(evento, datos) recibe el progreso ('progress', 'token', 'availability')
+        para el endpoint en streaming; por defecto no se emite nada.
+        """
+        start = perf_counter()
+        turn = self._turn(user_message, on_event)
+        try:
+            effect = next(turn)
+            while True:
+                effect = turn.send(self._run_effect(effect))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            STEP_SECONDS.observe(perf_counter() - start, step=self.last_step)
+
+    async def asend_message(self, user_message: str, on_event=None) -> str:
+        """Versión asíncrona de send_message: el LLM y TIMP se esperan sin bloquear el hilo."""
+        start = perf_counter()
+        turn = self._turn(user_message, on_event)
+        try:
+            effect = next(turn)
+            while True:
+                effect = turn.send(await self._arun_effect(effect))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            STEP_SECONDS.observe(perf_counter() - start, step=self.last_step)
+
+    def _availability_target(self, user_message: str, guess: bool = False) -> tuple | None:
+        """
+        (activity_id, AvailabilityQuery) que consultaría el paso 2 con los datos
+        actuales, o None si el turno no va a llegar ahí. Con guess=True la subopción
+        también puede salir del propio mensaje (sin esperar al LLM).
+        """
+        if "fecha" in self.user_data:
+            return None
+        terapia_key = catalogue.therapy_key(self.user_data.get("terapia", "").lower())
+        if not terapia_key:
+            return None
+        subopcion = self.user_data.get("subopcion")
+        if not subopcion and guess:
+            subopcion = catalogue.option_name(user_message, therapy=terapia_key)
+        activity_id = catalogue.activity_id(subopcion, therapy=terapia_key) if subopcion else None
+        if not activity_id:
+            return None
+        return activity_id, plan_availability_query(user_message, datetime.today(), AVAILABILITY_MAX_DAYS)
+
+    def _run_effect(self, effect: tuple):
+        kind, *args = effect
+        if kind == "llm":
+            user_message, on_token, tier = args
+            return self.extract_data_with_llm(user_message, on_token=on_token, tier=tier)
+        if kind == "prefetch":
+            return SpeculativeFetch(*args).start()
+        if kind == "availability":
+            activity_id, query, on_day = args
+            return get_available_dates_for_therapy(activity_id, on_day=on_day, query=query)
+        if kind == "slot":
+            activity_id, fecha_iso, hora_norm = args
+            return find_timp_slot(activity_id, fecha_iso, hora_norm, force_refresh=True)
+        if kind == "nearby":
+            activity_id, fecha_iso, hora_norm, period = args
+            return find_nearby_slots(activity_id, fecha_iso, hora_norm, period)
+        raise ValueError(f"Efecto desconocido: {kind}")
+
+    async def _arun_effect(self, effect: tuple):
+        kind, *args = effect
+        if kind == "llm":
+            user_message, on_token, tier = args
+            return await self.aextract_data_with_llm(user_message, on_token=on_token, tier=tier)
+        if kind == "prefetch":
+            return SpeculativeFetch(*args).astart()
+        if kind == "availability":
+            activity_id, query, on_day = args
+            return await aget_available_dates_for_therapy(activity_id, on_day=on_day, query=query)
+        if kind == "slot":
+            activity_id, fecha_iso, hora_norm = args
+            return await afind_timp_slot(activity_id, fecha_iso, hora_norm, force_refresh=True)
+        if kind == "nearby":
+            activity_id, fecha_iso, hora_norm, period = args
+            return await afind_nearby_slots(activity_id, fecha_iso, hora_norm, period)
+        raise ValueError(f"Efecto desconocido: {kind}")
+
+    def _turn(self, user_message: str, on_event=None):
+        """
+        Máquina de estados de un turno, independiente de la E/S.
+        Cada llamada externa se pide con `yield (tipo, *args)` y el driver
+        (send_message o asend_message) devuelve el resultado; el valor de retorno es la respuesta.
+        """
+        emit = on_event or (lambda event, data: None)
+        # Paso en el que termina el turno (etiqueta de las métricas de latencia)
+        self.last_step = "bienvenida"
+        catalogue.maybe_reload()
+        log.debug("Estado actual", extra={"user_data": dict(self.user_data)})
 
         # Bienvenida inicial
         if len(self.conversation_history) == 1:
@@ -349,28 +1125,80 @@ class NaturalAppointmentAgent:
             response_text = (
                 "¡Hola! 👋 Soy tu asistente de agendamiento.\n\n"
                 "¿Qué tipo de terapia te gustaría reservar?\n\n"
-                "• Ondas\n• Fisioterapia\n• Indiba\n• Láser\n• Osteopatía"
+                + "\n".join(f"• {name}" for name in catalogue.therapy_names())
             )
             self.conversation_history.append({"role": "assistant", "content": response_text})
             return response_text
 
         # Añadir mensaje al historial
         self.conversation_history.append({"role": "user", "content": user_message})
-
-        # Extraer datos del LLM
-        llm_response = self.extract_data_with_llm(user_message)
-        print(f"[DEBUG] 🤖 Respuesta LLM (raw): {llm_response}")
-
-        try:
-            parsed = json.loads(clean_llm_response(llm_response))
-            data = parsed.get("data", {})
-            reply = parsed.get("respuesta", "¿Podrías repetirlo?")
-            print(f"[DEBUG] 📦 Datos extraídos del LLM: {data}")
-        except Exception as e:
-            print(f"[ERROR] ❌ JSON inválido: {e}")
-            reply = "Vaya, tuve un fallo técnico. ¿Me lo dices de nuevo? 😅"
-            self.conversation_history.append({"role": "assistant", "content": reply})
-            return reply
+        self._trim_history()
+
+        # Intentar primero el parser local; si no está seguro, usar el LLM
+        speculative = None
+        data = fast_extract_slots(user_message, self.user_data)
+        fast_path_stats.record(data is not None)
+        if data is not None:
+            # El texto lo ponen los pasos 1-3 o, si no aplica ninguno, missing_slot_reply
+            reply = None
+            log.debug("Datos extraídos sin LLM", extra={"user_data": data})
+        else:
+            # El texto del LLM solo se muestra si aún no hay terapia (si no, lo sustituyen los pasos 1-3)
+            on_token = None
+            if on_event and not self.user_data.get("terapia"):
+                on_token = lambda text: emit("token", {"text": text})
+
+            cache_key = llm_cache.key(user_message, self.user_data)
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                data, reply = cached
+                if on_token and reply:
+                    on_token(reply)
+                log.debug("Extracción servida desde la caché", extra={"user_data": data})
+            elif not groq_guard.available():
+                # Groq caído: sin esperar al timeout, seguir con los pasos guiados
+                # (listas de opciones que el parser local sí entiende)
+                data = {}
+                reply = LLM_DEGRADED_REPLY.format(question=missing_slot_reply(self.user_data))
+                log.warning("Circuito de Groq abierto: respuesta guiada sin LLM")
+            else:
+                emit("progress", {"message": "Pensando…"})
+                # Si el turno apunta al paso 2, TIMP se consulta a la vez que el LLM
+                target = self._availability_target(user_message, guess=True) if SPECULATIVE_PREFETCH else None
+                if target is not None:
+                    speculative = yield ("prefetch", *target)
+                tier = self.router.route(user_message)
+                # El nivel rápido no emite texto: si hubiera que escalar se mezclarían dos respuestas
+                llm_response = yield ("llm", user_message, on_token if tier is not self.router.fast else None, tier)
+                parsed, problem = self._parse_llm(llm_response)
+
+                # Salida inservible o que no valida: una única reintentona con el modelo fuerte
+                stronger = self.router.escalation(tier)
+                if problem and stronger and llm_response != LLM_FALLBACK_RESPONSE:
+                    LLM_ESCALATIONS.inc(tier=tier.name, reason=problem)
+                    log.info("Escalando al modelo fuerte", extra={"tier": tier.name, "reason": problem})
+                    # Sin streaming: el texto del primer intento ya se envió y no se mezclan dos respuestas
+                    retry_response = yield ("llm", user_message, None, stronger)
+                    retry, retry_problem = self._parse_llm(retry_response)
+                    if retry is not None:
+                        parsed, llm_response, problem = retry, retry_response, retry_problem
+
+                if parsed is not None:
+                    data = parsed.data.slots()
+                    reply = parsed.respuesta
+                    log.debug("Datos extraídos del LLM", extra={"user_data": data})
+                else:
+                    self.last_step = "error_llm"
+                    if speculative is not None:
+                        speculative.finish(None)
+                    reply = "Vaya, tuve un fallo técnico. ¿Me lo dices de nuevo? 😅"
+                    self.conversation_history.append({"role": "assistant", "content": reply})
+                    return reply
+
+                # Ni los fallos de Groq (LLM_FALLBACK_RESPONSE) ni una extracción que no validó:
+                # repetir el mensaje debe volver a pasar por la validación y el escalado
+                if llm_response != LLM_FALLBACK_RESPONSE and not problem:
+                    llm_cache.put(cache_key, data, reply)
 
         # Guardar estado anterior para comparar
         prev_data = self.user_data.copy()
@@ -381,111 +1209,77 @@ class NaturalAppointmentAgent:
             if val and val != "?":
                 self.user_data[key] = val.strip()
 
-                # Normalización especial para "subopcion"
+        # Normalización especial para "subopcion"
         val = data.get("subopcion")
         if val and val != "?":
-            # Normalizar: quitar acentos, estandarizar formato
-            import unicodedata
-            normalized_val = ''.join(c for c in unicodedata.normalize('NFD', val) if unicodedata.category(c) != 'Mn')
-            normalized_val = normalized_val.strip().title()
-
-            # Mapeo manual para coincidir EXACTAMENTE con THERAPY_OPTIONS
-            lower_val = normalized_val.lower()
-            if lower_val in ["tratamiento laser", "tratamiento láser", "laser tratamiento", "tratamiento con laser", "tratamiento"]:
-                normalized_val = "Tratamiento Láser"
-            elif lower_val in ["fisioterapia 1a visita", "fisio primera", "primera visita fisio", "fisioterapia primera", "primera fisio"]:
-                normalized_val = "Fisioterapia 1ª visita"
-            elif lower_val in ["osteopatia 1a visita", "osteopatía primera", "primera osteo"]:
-                normalized_val = "Osteopatía 1ª visita"
-            elif lower_val in ["ondas focales", "ondas focales tratamiento", "focales"]:
-                normalized_val = "Tratamiento Ondas Focales"
-            elif lower_val in ["ondas radiales", "tratamiento ondas radiales", "radiales"]:
-                normalized_val = "Tratamiento Ondas Radiales"
-            elif lower_val in ["indiba 45", "indiba 45 minutos", "indiba"]:
-                normalized_val = "Indiba 45'"
-            elif lower_val in ["indiba laser", "indiba + laser", "indiba y laser", "doble"]:
-                normalized_val = "Indiba + Láser"
-            elif lower_val in ["fisio+indiba+laser", "fisio indiba laser", "triple"]:
-                normalized_val = "Fisio+Indiba+Láser"
-
-            self.user_data["subopcion"] = normalized_val
+            self.user_data["subopcion"] = normalize_subopcion(val)
 
         # Mostrar qué cambió
-        if self.user_data != prev_data:
-            print(f"[DEBUG] ✅ user_data ACTUALIZADO: {self.user_data}")
-        else:
-            print(f"[DEBUG] ➖ user_data SIN CAMBIOS: {self.user_data}")
+        log.debug("user_data %s", "actualizado" if self.user_data != prev_data else "sin cambios",
+                  extra={"user_data": dict(self.user_data)})
+
+        if speculative is not None:
+            speculative.finish(self._availability_target(user_message))
 
         terapia = self.user_data.get("terapia", "").lower()
+        terapia_key = catalogue.therapy_key(terapia)
         subopcion = self.user_data.get("subopcion")
 
         # --- Paso 1: Terapia seleccionada, pero sin subopción ---
         if terapia and not subopcion:
-            print(f"[DEBUG] 🚶‍♂️ Entrando en PASO 1: terapia='{terapia}', subopcion no definida")
-            if terapia not in THERAPY_OPTIONS:
+            self.last_step = "paso1"
+            log.debug("Paso 1: elegir subopción", extra={"terapia": terapia})
+            if not terapia_key:
                 self.user_data.pop("terapia", None)
-                return "No ofrecemos esa terapia. Por favor, elige entre: Ondas, Fisioterapia, Indiba, Láser u Osteopatía."
+                names = catalogue.therapy_names()
+                return f"No ofrecemos esa terapia. Por favor, elige entre: {', '.join(names[:-1])} u {names[-1]}."
 
-            config = THERAPY_OPTIONS[terapia]
-            choices = []
-            if config["first_visit"]:
-                choices.append(config["first_visit"]["name"])
-            for opt in config["options"]:
-                choices.append(opt["name"])
-
-            msg = f"Elige una opción para **{terapia.capitalize()}**:\n" + "\n".join(f"• {c}" for c in choices)
+            choices = [c["name"] for c in catalogue.choices(terapia_key)]
+            msg = f"Elige una opción para **{catalogue.therapy_name(terapia_key)}**:\n" + "\n".join(f"• {c}" for c in choices)
             self.conversation_history.append({"role": "assistant", "content": msg})
             return msg
 
         # --- Paso 2: Subopción seleccionada → disponibilidad dinámica ---
         if terapia and subopcion and "fecha" not in self.user_data:
-            print(f"[DEBUG] 🚶‍♂️ Entrando en PASO 2: terapia='{terapia}', subopcion='{subopcion}'")
-            activity_id = None
-            config = THERAPY_OPTIONS.get(terapia)
-            if config:
-                if config["first_visit"] and config["first_visit"]["name"] == subopcion:
-                    activity_id = config["first_visit"]["id"]
-                else:
-                    for opt in config["options"]:
-                        if opt["name"] == subopcion:
-                            activity_id = opt["id"]
-                            break
+            self.last_step = "paso2"
+            log.debug("Paso 2: disponibilidad", extra={"terapia": terapia, "subopcion": subopcion})
+            activity_id = catalogue.activity_id(subopcion, therapy=terapia_key)
 
             if not activity_id:
-                print(f"[DEBUG] ❌ Subopción no encontrada: '{subopcion}'")
+                log.info("Subopción no encontrada", extra={"terapia": terapia, "subopcion": subopcion})
                 self.user_data.pop("subopcion", None)
                 return "Opción no reconocida."
 
-            today = datetime.today()
-            start_off, end_off = interpret_date_range(user_message, today)
-            print(f"[DEBUG] 📅 Rango de búsqueda: hoy+{start_off} a hoy+{end_off} días")
+            # Solo los días y la franja que pide el mensaje ("martes y jueves por la mañana")
+            query = plan_availability_query(user_message, datetime.today(), AVAILABILITY_MAX_DAYS)
+            log.debug("Plan de búsqueda", extra={"offsets": list(query.offsets), "window": query.window})
+            # Con una franja pedida, un único hueco ya es una respuesta útil
+            min_times = 1 if query.window else 2
 
-            available = get_available_dates_for_therapy(activity_id, start_offset=start_off, end_offset=end_off)
+            emit("progress", {"message": "Buscando disponibilidad…"})
+            available = yield (
+                "availability", activity_id, query,
+                lambda date, times: emit("availability", {"date": date, "times": times[:5]}) if len(times) >= min_times else None
+            )
 
+            # Lo pedido pasaba del horizonte: se avisa en vez de responder a otra pregunta
+            note = f"Solo puedo consultar hasta {AVAILABILITY_MAX_DAYS} días vista; te muestro los últimos que puedo ver.\n" if query.clamped else ""
             if not available:
-                return "No hay disponibilidad en el periodo solicitado. ¿Quieres intentar con otro rango?"
+                return note + "No hay disponibilidad en el periodo solicitado. ¿Quieres intentar con otro rango?"
 
-            filtered = {d: t for d, t in available.items() if len(t) >= 2}
+            filtered = {d: t for d, t in available.items() if len(t) >= min_times}
             lines = [f"• **{date}**: {', '.join(times[:5])}" for date, times in list(filtered.items())[:4]]
-            msg = "Elige una fecha y hora (ej: '20/10 a las 09:15'):\n" + "\n".join(lines)
+            msg = note + "Elige una fecha y hora (ej: '20/10 a las 09:15'):\n" + "\n".join(lines)
             self.conversation_history.append({"role": "assistant", "content": msg})
             return msg
 
                # --- Paso 3: Fecha y hora seleccionadas → generar enlace ---
         elif terapia and subopcion and self.user_data.get("fecha") and self.user_data.get("hora"):
-            print(f"[DEBUG] 🎯 Entrando en PASO 3: ¡Todos los datos completos!")
+            self.last_step = "paso3"
+            log.debug("Paso 3: generar enlace", extra={"terapia": terapia, "subopcion": subopcion})
             
             # Buscar activity_id
-            activity_id = None
-            config = THERAPY_OPTIONS.get(terapia)
-            if config:
-                if config["first_visit"] and config["first_visit"]["name"] == subopcion:
-                    activity_id = config["first_visit"]["id"]
-                else:
-                    for opt in config["options"]:
-                        if opt["name"] == subopcion:
-                            activity_id = opt["id"]
-                            break
+            activity_id = catalogue.activity_id(subopcion, therapy=terapia_key)
 
             if not activity_id:
                 reply = "Lo siento, no encontré esa opción. ¿Podrías repetirme la terapia y el tipo de cita?"
@@ -495,6 +1289,8 @@ class NaturalAppointmentAgent:
 
             fecha_str = self.user_data["fecha"]
             hora_str = self.user_data["hora"]
+            # "por la mañana", "tarde"...: se ofrecen los huecos de esa franja
+            period = day_period(hora_str)
 
             try:
                 # Convertir a formato ISO para la API
@@ -502,42 +1298,114 @@ class NaturalAppointmentAgent:
                 fecha_iso = fecha_dt.strftime("%Y-%m-%d")
                 
                 # Asegurar formato HH:MM
-                h, m = hora_str.split(':')
-                hora_norm = f"{int(h):02d}:{int(m):02d}"
+                hora_norm = None
+                if period is None:
+                    h, m = hora_str.split(':')
+                    hora_norm = f"{int(h):02d}:{int(m):02d}"
                 
-                print(f"[DEBUG] 📅 Fecha/hora para API: {fecha_iso} a las {hora_norm}")
+                log.debug("Fecha/hora para API", extra={"fecha": fecha_iso, "hora": hora_norm})
             except Exception as e:
-                print(f"[ERROR] El LLM no entregó fecha/hora en formato válido: fecha='{fecha_str}', hora='{hora_str}' | Error: {e}")
+                log.warning("Fecha/hora en formato no válido (%s)", type(e).__name__, extra={"fecha": fecha_str, "hora": hora_str})
                 reply = "Vaya, tuve un pequeño fallo al procesar tu cita. ¿Podrías repetirme la fecha y hora? Por ejemplo: 'el 27 a las 8' o 'mañana por la tarde'."
                 self.conversation_history.append({"role": "assistant", "content": reply})
                 return reply
 
-            # Verificar disponibilidad real
-            slot_id = find_timp_slot(activity_id, fecha_iso, hora_norm)
+            # Verificar disponibilidad real (sin caché: el enlace debe ser válido)
+            emit("progress", {"message": "Comprobando el horario…"})
+            slot_id = None
+            if period is None:
+                slot_id = yield ("slot", activity_id, fecha_iso, hora_norm)
             if not slot_id:
-                reply = "Lo siento, ese horario ya no está disponible. ¿Te gustaría proponer otro?"
+                # Ofrecer en la misma respuesta los huecos más cercanos (el día pedido ya está en caché)
+                nearby = yield ("nearby", activity_id, fecha_iso, hora_norm, period)
                 # No reiniciar: permitir corregir solo fecha/hora
+                self.user_data.pop("hora", None)
+                if nearby:
+                    nearby = [(datetime.strptime(d, "%Y-%m-%d").strftime("%d/%m"), t) for d, t in nearby]
+                    options = "\n".join(f"• {d} a las {t}" for d, t in nearby)
+                    intro = "Estos son los huecos libres en esa franja:" if period else "Lo siento, a esa hora no hay hueco. Lo más cercano:"
+                    reply = f"{intro}\n{options}\n\n¿Te viene bien alguno? Dime, por ejemplo, 'el {nearby[0][0]} a las {nearby[0][1]}'."
+                else:
+                    reply = "Lo siento, ese horario ya no está disponible. ¿Te gustaría proponer otro?"
                 self.conversation_history.append({"role": "assistant", "content": reply})
                 return reply
 
             BRANCH_BUILDING_ID = "11269"
             cita_url = f"https://web.timp.pro/home/{BRANCH_BUILDING_ID}#/home/{BRANCH_BUILDING_ID}/branch_building/admissions/{slot_id}"
-            print(f"[DEBUG] 🔗 Enlace generado: {cita_url}")
+            log.info("Enlace de cita generado", extra={"activity_id": activity_id, "cita_url": cita_url})
             msg = f"✅ **¡Listo!** Haz clic aquí para confirmar tu cita: {cita_url}\n\n¿Te gustaría agendar otra cita? 😊"
 
-            # Reiniciar estado tras éxito
+            # Reiniciar estado tras éxito (la conversación anterior ya no aporta contexto)
             self.user_data = {}
-            print(f"[DEBUG] 🧹 user_data REINICIADO tras cita exitosa")
+            self.conversation_history = self.conversation_history[:1]
             self.conversation_history.append({"role": "assistant", "content": msg})
             return msg
 
         # --- Por defecto: responder con el mensaje del LLM ---
-        print(f"[DEBUG] 💬 Respondiendo con el mensaje del LLM: {reply}")
+        self.last_step = "respuesta_llm"
+        if not reply:
+            # Formato compacto sin "respuesta": se pregunta por lo que falta
+            reply = missing_slot_reply(self.user_data)
+        log.debug("Respondiendo con el mensaje del LLM", extra={"reply": reply})
         self.conversation_history.append({"role": "assistant", "content": reply})
         return reply
         
-# Instancia global
-agent = NaturalAppointmentAgent()
+# Clientes Groq compartidos; cada sesión solo guarda su propio estado de conversación.
+# Se crean con la primera sesión: importar la app no necesita el SDK ni GROQ_API_KEY.
+_groq_clients = {}
+_groq_clients_lock = threading.Lock()
+
+def shared_groq_client(kind: str = "sync", create: bool = True):
+    """Cliente compartido 'sync' o 'async'; con create=False devuelve None si aún no existe."""
+    with _groq_clients_lock:
+        if kind not in _groq_clients and create:
+            client_class = Groq if kind == "sync" else AsyncGroq
+            _groq_clients[kind] = client_class(api_key=os.getenv('GROQ_API_KEY'))
+        return _groq_clients.get(kind)
+
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+
+def make_session_backend(kind: str | None):
+    """SESSION_BACKEND: vacío (solo este proceso), 'memory' o 'sqlite' (SESSION_DB, compartido entre workers)."""
+    if not kind:
+        return None
+    if kind == 'memory':
+        return MemoryBackend(idle_ttl=SESSION_IDLE_TTL)
+    if kind == 'sqlite':
+        return SQLiteBackend(
+            os.getenv('SESSION_DB', 'sessions.db'),
+            idle_ttl=SESSION_IDLE_TTL,
+            flush_interval=float(os.getenv('SESSION_FLUSH_INTERVAL', '0.2'))
+        )
+    raise ValueError(f"SESSION_BACKEND desconocido: {kind}")
+
+session_backend = make_session_backend(os.getenv('SESSION_BACKEND'))
+if session_backend is not None:
+    atexit.register(session_backend.close)
+
+sessions = SessionStore(
+    factory=lambda: NaturalAppointmentAgent(client=shared_groq_client(), async_client=shared_groq_client("async")),
+    idle_ttl=SESSION_IDLE_TTL,
+    max_sessions=int(os.getenv('SESSION_MAX', '1000')),
+    backend=session_backend
+)
+
+SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+def get_session_id() -> str:
+    """
+    Identificador de conversación: cabecera X-Session-Id si es válida,
+    si no la cookie firmada de Flask (se crea una nueva si no existe).
+    """
+    session_id = request.headers.get('X-Session-Id', '')
+    if SESSION_ID_RE.match(session_id):
+        return session_id
+
+    session_id = session.get('sid')
+    if not session_id:
+        session_id = SessionStore.new_session_id()
+        session['sid'] = session_id
+    return session_id
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -547,8 +1415,150 @@ def chat():
     if not user_message:
         return jsonify({'error': 'Mensaje vacío'}), 400
 
-    bot_reply = agent.send_message(user_message)
-    return jsonify({'response': bot_reply})
+    session_id = get_session_id()
+    with sessions.session(session_id) as agent:
+        bot_reply = agent.send_message(user_message)
+    return jsonify({'response': bot_reply, 'session_id': session_id})
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Igual que /chat pero con Server-Sent Events: 'progress', 'token' y 'availability'
+    mientras se procesa, y 'done' con la respuesta final (o 'error').
+    """
+    data = request.get_json()
+    user_message = data.get('message', '').strip()
+
+    if not user_message:
+        return jsonify({'error': 'Mensaje vacío'}), 400
+
+    # La cookie de sesión se fija antes de empezar a enviar el cuerpo
+    session_id = get_session_id()
+    events = queue.Queue()
+
+    def worker():
+        try:
+            with sessions.session(session_id) as agent:
+                bot_reply = agent.send_message(user_message, on_event=lambda e, d: events.put((e, d)))
+            events.put(("done", {'response': bot_reply, 'session_id': session_id}))
+        except Exception as e:
+            log.exception("Error en chat_stream")
+            events.put(("error", {'error': 'Error interno'}))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def generate():
+        while True:
+            event, payload = events.get()
+            yield sse_event(event, payload)
+            if event in ("done", "error"):
+                break
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/availability/status')
+def availability_status():
+    """Estado del pre-calentador y antigüedad de la foto de disponibilidad."""
+    return jsonify({
+        'prewarmer': prewarmer.status(),
+        'snapshot': availability_snapshot.status(),
+        'upstreams': {'timp': timp_guard.status(), 'groq': groq_guard.status()}
+    })
+
+@app.route('/availability')
+def availability():
+    """
+    Rejilla de disponibilidad para que el front pagine sin pasar por el LLM:
+    ?therapy=fisioterapia (todas sus subopciones) o ?activity_id=72648&activity_id=...,
+    con &start=días desde hoy (0) y &days=número de días (14); start + days <= AVAILABILITY_MAX_DAYS.
+    Opcional: solo una franja (&from=09:00&to=10:00 o &period=manana|mediodia|tarde),
+    &combine=any|all para añadir por día las horas en que alguna/todas las opciones están libres
+    y &at=HH:MM para añadir por día qué opciones están libres a esa hora.
+    """
+    try:
+        start = int(request.args.get('start', 0))
+        days = int(request.args.get('days', 14))
+        activity_ids = [int(a) for a in request.args.getlist('activity_id')]
+    except ValueError:
+        return jsonify({'error': 'Parámetros no válidos'}), 400
+    # Mismo horizonte que el paso 2: nada de consultas a TIMP meses vista (ni OverflowError)
+    if start < 0 or days < 1 or start + days > AVAILABILITY_MAX_DAYS:
+        return jsonify({'error': f'start >= 0, days >= 1 y start + days <= {AVAILABILITY_MAX_DAYS}'}), 400
+
+    window = None
+    period = request.args.get('period')
+    if period:
+        window = DAY_PERIODS.get(fold_text(period))
+        if window is None:
+            return jsonify({'error': f'period debe ser uno de: {", ".join(DAY_PERIODS)}'}), 400
+    elif 'from' in request.args or 'to' in request.args:
+        window = (request.args.get('from', '00:00'), request.args.get('to', '23:59'))
+        if not all(HHMM_RE.match(t) for t in window):
+            return jsonify({'error': 'from y to en formato HH:MM'}), 400
+    combine = request.args.get('combine')
+    if combine not in (None, 'any', 'all'):
+        return jsonify({'error': 'combine debe ser any o all'}), 400
+    at = request.args.get('at')
+    if at is not None and not HHMM_RE.match(at):
+        return jsonify({'error': 'at en formato HH:MM'}), 400
+
+    therapy = request.args.get('therapy')
+    if therapy:
+        therapy_key = catalogue.therapy_key(therapy)
+        if not therapy_key:
+            return jsonify({'error': 'Terapia no reconocida'}), 404
+        activity_ids += [choice['id'] for choice in catalogue.choices(therapy_key)]
+    activity_ids = list(dict.fromkeys(activity_ids))
+    if not activity_ids:
+        return jsonify({'error': 'Indica therapy o activity_id'}), 400
+    if any(catalogue.therapy_for_activity(a) is None for a in activity_ids):
+        return jsonify({'error': 'Actividad no reconocida'}), 404
+
+    # Un único lote de bitmaps para la rejilla, la combinación y las opciones libres a una hora
+    bitmaps = get_availability_bitmaps(activity_ids, _range_dates(start, start + days - 1), window=window)
+    grid = times_grid(bitmaps)
+    first_day = datetime.today() + timedelta(days=start)
+    payload = {
+        'start': first_day.strftime("%Y-%m-%d"),
+        'end': (first_day + timedelta(days=days - 1)).strftime("%Y-%m-%d"),
+        'activities': [
+            {
+                'id': activity_id,
+                'name': catalogue.activity_name(activity_id),
+                'therapy': catalogue.therapy_name(catalogue.therapy_for_activity(activity_id)),
+                'dates': grid[activity_id]
+            }
+            for activity_id in activity_ids
+        ]
+    }
+    if combine:
+        combined = combine_options(bitmaps, combine)
+        payload['combined'] = {'how': combine, 'dates': {d: b.times() for d, b in combined.items() if b}}
+    if at is not None:
+        payload['free_at'] = {'time': at, 'dates': free_options_at(bitmaps, at)}
+    return jsonify(payload)
+
+REGISTRY.callback("secretario_timp_cache_hits_total", "Lecturas de admisiones servidas desde caché o foto.", lambda: admissions_cache.hits)
+REGISTRY.callback("secretario_timp_cache_misses_total", "Lecturas de admisiones que fueron a TIMP.", lambda: admissions_cache.misses)
+REGISTRY.callback("secretario_timp_cache_coalesced_total", "Peticiones a TIMP ahorradas por single-flight.", lambda: admissions_cache.coalesced)
+REGISTRY.callback("secretario_fast_path_hits_total", "Turnos resueltos por el parser local sin LLM.", lambda: fast_path_stats.hits)
+REGISTRY.callback("secretario_fast_path_misses_total", "Turnos que necesitaron el LLM.", lambda: fast_path_stats.misses)
+REGISTRY.callback("secretario_llm_cache_hits_total", "Extracciones servidas desde la caché del LLM.", lambda: llm_cache.hits)
+REGISTRY.callback("secretario_llm_cache_misses_total", "Extracciones cacheables que fueron al LLM.", lambda: llm_cache.misses)
+REGISTRY.callback("secretario_timp_stale_served_total", "Lecturas servidas con disponibilidad antigua por fallo de TIMP.", lambda: admissions_cache.stale_served)
+REGISTRY.callback("secretario_timp_circuit_open", "1 si el circuito de TIMP está abierto.", lambda: int(not timp_guard.available()), kind="gauge")
+REGISTRY.callback("secretario_groq_circuit_open", "1 si el circuito de Groq está abierto.", lambda: int(not groq_guard.available()), kind="gauge")
+REGISTRY.callback("secretario_active_sessions", "Conversaciones activas en este proceso.", lambda: len(sessions), kind="gauge")
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
@@ -0,0 +1,185 @@
+"""
+Punto de entrada ASGI: `uvicorn asgi:application`.
+
+POST /chat y POST /chat/stream se atienden de forma asíncrona (Groq y TIMP se esperan
+sin ocupar un hilo), de modo que un solo proceso mantiene cientos de conversaciones
+esperando E/S. El resto de rutas (página, /availability...) se delegan en la app Flask.
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+
+from app import app, sessions, sse_event, SESSION_ID_RE, admissions_cache, shared_groq_client
+from sessions import SessionStore
+
+log = logging.getLogger('secretario.asgi')
+
+
+MAX_BODY_SIZE = 64 * 1024
+
+flask_application = WsgiToAsgi(app)
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_SIZE:
+            raise ValueError("Cuerpo demasiado grande")
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, status: int, payload: dict, headers: list | None = None):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *(headers or [])
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def parse_cookies(raw: str) -> dict:
+    cookies = {}
+    for part in raw.split(';'):
+        name, sep, value = part.strip().partition('=')
+        if sep:
+            cookies[name] = value
+    return cookies
+
+
+def resolve_session_id(scope) -> tuple[str, list]:
+    """
+    Igual que app.get_session_id(): cabecera X-Session-Id o la cookie de sesión firmada
+    de Flask, para que un mismo navegador pueda usar ambas rutas indistintamente.
+    Devuelve (session_id, cabeceras extra de la respuesta).
+    """
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+
+    session_id = headers.get('x-session-id', '')
+    if SESSION_ID_RE.match(session_id):
+        return session_id, []
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    cookie = parse_cookies(headers.get('cookie', '')).get(cookie_name)
+    if cookie:
+        try:
+            session_id = serializer.loads(cookie).get('sid', '')
+        except BadSignature:
+            session_id = ''
+        if session_id:
+            return session_id, []
+
+    session_id = SessionStore.new_session_id()
+    value = serializer.dumps({'sid': session_id})
+    set_cookie = f"{cookie_name}={value}; Path=/; HttpOnly; SameSite=Lax"
+    return session_id, [(b'set-cookie', set_cookie.encode('latin-1'))]
+
+
+async def read_message(receive, send) -> str | None:
+    """Mensaje del cuerpo JSON; si no es válido responde 400 y devuelve None."""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError("Se esperaba un objeto JSON")
+    except ValueError:
+        await send_json(send, 400, {'error': 'Petición inválida'})
+        return None
+
+    user_message = str(data.get('message', '')).strip()
+    if not user_message:
+        await send_json(send, 400, {'error': 'Mensaje vacío'})
+        return None
+    return user_message
+
+
+async def chat(scope, receive, send):
+    user_message = await read_message(receive, send)
+    if user_message is None:
+        return
+
+    session_id, headers = resolve_session_id(scope)
+    async with sessions.asession(session_id) as agent:
+        bot_reply = await agent.asend_message(user_message)
+    await send_json(send, 200, {'response': bot_reply, 'session_id': session_id}, headers)
+
+
+async def chat_stream(scope, receive, send):
+    """Igual que app.chat_stream (Server-Sent Events) pero sin un hilo por petición."""
+    user_message = await read_message(receive, send)
+    if user_message is None:
+        return
+
+    session_id, headers = resolve_session_id(scope)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_event(event, payload):
+        loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+
+    async def run():
+        try:
+            async with sessions.asession(session_id) as agent:
+                bot_reply = await agent.asend_message(user_message, on_event=on_event)
+            on_event("done", {'response': bot_reply, 'session_id': session_id})
+        except Exception:
+            log.exception("Error en chat_stream")
+            on_event("error", {'error': 'Error interno'})
+
+    # El turno termina (y guarda la sesión) aunque el cliente se desconecte
+    task = asyncio.create_task(run())
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                *headers
+            ]
+        })
+        while True:
+            event, payload = await events.get()
+            body = sse_event(event, payload).encode('utf-8')
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            if event in ("done", "error"):
+                break
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await task
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await admissions_cache.async_client.aclose()
+            groq_client = shared_groq_client("async", create=False)
+            if groq_client is not None:
+                await groq_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/chat' and scope['method'] == 'POST':
+        await chat(scope, receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/chat/stream' and scope['method'] == 'POST':
+        await chat_stream(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
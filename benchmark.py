@@ -0,0 +1,341 @@
+"""
+Benchmark offline de /chat: `python benchmark.py --conversations 200 --concurrency 16`.
+
+Levanta en local un TIMP falso (latencia, densidad de huecos y tasa de errores
+configurables) y un endpoint de chat-completions de Groq falso, arranca la app
+Flask apuntando a ellos y lanza conversaciones de reserva guionizadas contra /chat.
+Informa de p50/p95/p99 por turno, peticiones/s, llamadas a TIMP/Groq por reserva
+y por búsqueda de disponibilidad, además del tiempo de arranque
+(`import app` en un proceso limpio).
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+
+# Conversaciones de reserva: (mensaje del usuario, datos que "extrae" el Groq falso).
+# Los mensajes con datos None los resuelve la propia app (bienvenida o parser local).
+SCRIPTS = [
+    [
+        ("hola", None),
+        ("quiero pedir cita de fisioterapia", {"terapia": "Fisioterapia"}),
+        ("la primera visita, por favor", {"subopcion": "Fisioterapia 1ª visita"}),
+        ("el {fecha} a las {hora}", None)
+    ],
+    [
+        ("buenas tardes", None),
+        ("me gustaría hacerme indiba con láser", {"terapia": "Indiba", "subopcion": "Indiba + Láser"}),
+        ("el {fecha} a las {hora}", None)
+    ],
+    [
+        ("hola", None),
+        ("Osteopatía", None),
+        ("Osteopatía", None),
+        ("el {fecha} a las {hora}", None)
+    ]
+]
+
+BOOKING_MARKER = "web.timp.pro/home"
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Percentil por rango más cercano (p entre 0 y 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+class _FakeServer:
+    """Servidor HTTP local en un puerto libre que cuenta las peticiones recibidas."""
+
+    def __init__(self, handler):
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = None
+
+    def count(self):
+        with self._lock:
+            self.calls += 1
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTimpServer(_FakeServer):
+    """
+    TIMP falso: GET /activities/<id>/admissions?date=YYYY-MM-DD.
+    Cada día tiene `slots_per_day` huecos de una hora desde las 09:00.
+    """
+
+    def __init__(self, latency: float = 0.05, slots_per_day: int = 8, error_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.slots_per_day = slots_per_day
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        super().__init__(_TimpHandler)
+
+    def admissions(self, activity_id: int, date: str) -> list[dict]:
+        day = date.replace("-", "")
+        return [
+            {
+                "id": int(f"{activity_id}{day}{hour:02d}"),
+                "status": "available",
+                "hours": f"{hour:02d}:00 - {hour + 1:02d}:00"
+            }
+            for hour in range(9, 9 + self.slots_per_day)
+        ]
+
+
+class _TimpHandler(_QuietHandler):
+    def do_GET(self):
+        fake = self.server.owner
+        fake.count()
+        time.sleep(fake.latency)
+
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) < 3 or parts[-1] != "admissions":
+            self.send_json(404, {"error": "not found"})
+            return
+        if fake.error_rate and fake.random.random() < fake.error_rate:
+            self.send_json(503, {"error": "unavailable"})
+            return
+        date = parse_qs(url.query).get("date", [""])[0]
+        self.send_json(200, fake.admissions(int(parts[-2]), date))
+
+
+class FakeGroqServer(_FakeServer):
+    """
+    Groq falso: POST .../chat/completions con la forma de respuesta de OpenAI.
+    El JSON devuelto sale de `replies` según el último mensaje del usuario.
+    """
+
+    def __init__(self, latency: float = 0.3, replies: dict | None = None):
+        self.latency = latency
+        self.replies = replies or {}
+        super().__init__(_GroqHandler)
+
+    def completion(self, user_message: str) -> str:
+        data = self.replies.get(user_message, {})
+        return json.dumps({"respuesta": "¡Perfecto! Lo miro ahora mismo.", "data": data}, ensure_ascii=False)
+
+
+class _GroqHandler(_QuietHandler):
+    def do_POST(self):
+        fake = self.server.owner
+        fake.count()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(fake.latency)
+
+        user_messages = [m["content"] for m in body.get("messages", []) if m.get("role") == "user"]
+        content = fake.completion(user_messages[-1] if user_messages else "")
+        self.send_json(200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content}
+            }],
+            "usage": {"prompt_tokens": 400, "completion_tokens": 40, "total_tokens": 440}
+        })
+
+
+def run_conversation(base_url: str, script: list, fecha: str, hora: str, timeout: float = 30) -> tuple[list[float], bool]:
+    """Una conversación completa; devuelve (latencias por turno, si terminó en reserva)."""
+    latencies = []
+    headers = {}
+    reply = ""
+    with requests.Session() as http:
+        for message, _ in script:
+            start = time.perf_counter()
+            response = http.post(
+                f"{base_url}/chat",
+                json={"message": message.format(fecha=fecha, hora=hora)},
+                headers=headers,
+                timeout=timeout
+            )
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+            payload = response.json()
+            headers["X-Session-Id"] = payload["session_id"]
+            reply = payload["response"]
+    return latencies, BOOKING_MARKER in reply
+
+
+def run_benchmark(base_url: str, conversations: int, concurrency: int, scripts: list = SCRIPTS) -> dict:
+    """Lanza `conversations` conversaciones (repartidas entre los guiones) con `concurrency` a la vez."""
+    target = datetime.today() + timedelta(days=1)
+    fecha, hora = target.strftime("%d/%m"), "09:00"
+
+    latencies, bookings, failures = [], 0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_conversation, base_url, scripts[i % len(scripts)], fecha, hora)
+            for i in range(conversations)
+        ]
+        for future in futures:
+            try:
+                turn_latencies, booked = future.result()
+            except requests.RequestException:
+                failures += 1
+                continue
+            latencies.extend(turn_latencies)
+            bookings += booked
+    elapsed = time.perf_counter() - start
+
+    return {
+        "conversations": conversations,
+        "concurrency": concurrency,
+        "bookings": bookings,
+        "failures": failures,
+        "requests": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1)
+    }
+
+
+# Dependencias que no deben cargarse al importar la app (solo al primer uso)
+HEAVY_MODULES = ("groq", "dateparser")
+
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.NaturalAppointmentAgent(client=object())
+built = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "agent_ms": (built - imported) * 1000,
+    "heavy_modules": [m for m in %r if m in sys.modules]
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup(runs: int = 3) -> dict:
+    """
+    Importa la app en `runs` procesos nuevos (sin GROQ_API_KEY) y devuelve la mediana
+    de import y de construcción de un agente, más los módulos pesados que se cargaron.
+    """
+    env = {k: v for k, v in os.environ.items() if k != "GROQ_API_KEY"}
+    env.setdefault("LOG_LEVEL", "WARNING")
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        "import_ms": round(percentile([s["import_ms"] for s in samples], 50), 1),
+        "agent_ms": round(percentile([s["agent_ms"] for s in samples], 50), 3),
+        "heavy_modules": samples[-1]["heavy_modules"]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timp-latency", type=float, default=0.05, help="segundos por petición a TIMP")
+    parser.add_argument("--timp-slots", type=int, default=8, help="huecos por día y actividad")
+    parser.add_argument("--timp-error-rate", type=float, default=0.0, help="fracción de respuestas 503")
+    parser.add_argument("--groq-latency", type=float, default=0.3, help="segundos por llamada a Groq")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--startup-runs", type=int, default=3, help="procesos para medir el arranque (0 = no medir)")
+    args = parser.parse_args(argv)
+
+    # Antes de importar la app en este proceso
+    startup = measure_startup(args.startup_runs) if args.startup_runs > 0 else None
+    replies = {message: data for script in SCRIPTS for message, data in script if data}
+    timp = FakeTimpServer(args.timp_latency, args.timp_slots, args.timp_error_rate, args.seed).start()
+    groq = FakeGroqServer(args.groq_latency, replies).start()
+
+    # La app lee la configuración al importarse: apuntarla antes a los servidores falsos
+    os.environ["TIMP_BASE_URL"] = timp.url
+    os.environ["GROQ_BASE_URL"] = groq.url
+    os.environ.setdefault("GROQ_API_KEY", "benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        result = run_benchmark(f"http://127.0.0.1:{server.server_port}", args.conversations, args.concurrency)
+    finally:
+        server.shutdown()
+        timp.stop()
+        groq.stop()
+
+    bookings = result["bookings"] or 1
+    result["timp_calls"] = timp.calls
+    result["groq_calls"] = groq.calls
+    result["timp_calls_per_booking"] = round(timp.calls / bookings, 2)
+    result["groq_calls_per_booking"] = round(groq.calls / bookings, 2)
+    # Búsquedas del paso 2: días pedidos y cuántos de ellos fueron a TIMP (el resto, de caché)
+    from metrics import AVAILABILITY_SEARCH_DAYS
+    searches = AVAILABILITY_SEARCH_DAYS.count(source="requested") or 1
+    result["days_per_search"] = round(AVAILABILITY_SEARCH_DAYS.sum(source="requested") / searches, 2)
+    result["timp_calls_per_search"] = round(AVAILABILITY_SEARCH_DAYS.sum(source="upstream") / searches, 2)
+    if startup:
+        result["startup"] = startup
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    return result
+
+
+if __name__ == "__main__":
+    main()
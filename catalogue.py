@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+
+log = logging.getLogger('secretario.catalogue')
+
+
+CATALOGUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'terapias.json')
+
+
+def fold_text(text: str) -> str:
+    """Minúsculas, sin acentos ('1ª' → '1a') y con espacios colapsados."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+    return ' '.join(text.lower().split())
+
+
+class _Index:
+    """Índices hash del catálogo; se construyen completos y se sustituyen de una vez."""
+
+    def __init__(self, data: dict):
+        self.options = data
+        self.therapy_words = {}      # palabra normalizada → clave de terapia
+        self.choices = {}            # clave de terapia → [{"id", "name"}] (1ª visita primero)
+        self.names = {}              # nombre normalizado → (terapia, id, nombre exacto)
+        self.aliases = {}            # alias normalizado → nombre exacto
+        self.activities = {}         # activity_id → (terapia, nombre exacto)
+
+        for key, config in data.items():
+            for word in [key, config.get("name", key), *config.get("aliases", [])]:
+                self.therapy_words[fold_text(word)] = key
+
+            choices = ([config["first_visit"]] if config.get("first_visit") else []) + config["options"]
+            self.choices[key] = [{"id": c["id"], "name": c["name"]} for c in choices]
+            for choice in choices:
+                self.names[fold_text(choice["name"])] = (key, choice["id"], choice["name"])
+                self.activities[choice["id"]] = (key, choice["name"])
+                for alias in choice.get("aliases", []):
+                    self.aliases[fold_text(alias)] = choice["name"]
+
+
+class Catalogue:
+    """
+    Catálogo de terapias cargado desde terapias.json (única fuente de verdad).
+    Todas las búsquedas son O(1), sin distinguir mayúsculas ni acentos.
+    El fichero se puede editar en caliente: maybe_reload() lo relee si cambió.
+    """
+
+    def __init__(self, path: str = CATALOGUE_PATH, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reload()
+
+    def reload(self):
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        index = _Index(data)
+        with self._lock:
+            self._index = index
+            self._mtime = os.path.getmtime(self.path)
+            self._checked_at = time.monotonic()
+
+    def maybe_reload(self) -> bool:
+        """Relee el fichero si su fecha de modificación cambió (como mucho cada check_interval s)."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        try:
+            if os.path.getmtime(self.path) == self._mtime:
+                return False
+            self.reload()
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            log.error("Error recargando catálogo: %s", e, extra={"path": self.path})
+            return False
+
+    @property
+    def options(self) -> dict:
+        """Catálogo tal cual está en el fichero (mismo formato que el antiguo THERAPY_OPTIONS)."""
+        return self._index.options
+
+    @property
+    def therapies(self) -> list[str]:
+        return list(self._index.options)
+
+    def therapy_key(self, text: str) -> str | None:
+        """'Láser', 'laser', 'fisio'... → clave de terapia ('láser', 'fisioterapia'), o None."""
+        return self._index.therapy_words.get(fold_text(text or ""))
+
+    def therapy_name(self, key: str) -> str:
+        return self._index.options[key].get("name", key.capitalize())
+
+    def therapy_names(self) -> list[str]:
+        return [self.therapy_name(key) for key in self._index.options]
+
+    def choices(self, key: str) -> list[dict]:
+        return self._index.choices.get(key, [])
+
+    def option_name(self, text: str, therapy: str | None = None, aliases: bool = True) -> str | None:
+        """
+        Nombre EXACTO de la subopción a partir del nombre o un alias.
+        Si se indica therapy, solo se aceptan subopciones de esa terapia.
+        """
+        index = self._index
+        folded = fold_text(text or "")
+        name = index.names[folded][2] if folded in index.names else None
+        if name is None and aliases:
+            name = index.aliases.get(folded)
+        if name is None:
+            return None
+        if therapy and index.names[fold_text(name)][0] != therapy:
+            return None
+        return name
+
+    def activity_id(self, name: str, therapy: str | None = None) -> int | None:
+        entry = self._index.names.get(fold_text(name or ""))
+        if entry is None or (therapy and entry[0] != therapy):
+            return None
+        return entry[1]
+
+    def therapy_for_activity(self, activity_id: int) -> str | None:
+        entry = self._index.activities.get(activity_id)
+        return entry[0] if entry else None
+
+    def activity_name(self, activity_id: int) -> str | None:
+        entry = self._index.activities.get(activity_id)
+        return entry[1] if entry else None
+
+    def activity_ids(self) -> list[int]:
+        return list(self._index.activities)
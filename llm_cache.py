@@ -0,0 +1,68 @@
+import threading
+import time
+from datetime import date
+
+from cachetools import TTLCache
+
+from catalogue import fold_text
+
+
+class LLMResponseCache:
+    """
+    Caché LRU+TTL de extracciones del LLM para mensajes cortos y repetidos
+    ("fisioterapia", "mañana a las 10", "sí") en el mismo estado de la conversación.
+    Guarda el resultado ya parseado (data, respuesta). Se vacía al cambiar de día,
+    porque las fechas relativas dependen del "Hoy es" del prompt.
+    """
+
+    def __init__(self, ttl: float = 3600, maxsize: int = 2048, max_chars: int = 80, timer=time.monotonic, today=date.today):
+        self.max_chars = max_chars
+        self._today = today
+        self._day = today()
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer) if maxsize > 0 else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, user_message: str, user_data: dict) -> tuple | None:
+        """Mensaje normalizado + estado compacto de los datos; None si no merece cachearse."""
+        message = fold_text(user_message).strip(" .!¡?¿")
+        if self._cache is None or not message or len(message) > self.max_chars:
+            return None
+        state = tuple(sorted((k, fold_text(str(v))) for k, v in user_data.items()))
+        return message, state
+
+    def _check_day(self):
+        today = self._today()
+        if today != self._day:
+            self._cache.clear()
+            self._day = today
+
+    def get(self, key: tuple | None) -> tuple[dict, str] | None:
+        if key is None:
+            return None
+        with self._lock:
+            self._check_day()
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        data, reply = entry
+        return dict(data), reply
+
+    def put(self, key: tuple | None, data: dict, reply: str):
+        if key is None:
+            return
+        with self._lock:
+            self._check_day()
+            self._cache[key] = (dict(data), reply)
+
+    def clear(self):
+        if self._cache is None:
+            return
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache) if self._cache is not None else 0
@@ -0,0 +1,154 @@
+import json
+
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator, model_validator
+
+
+DEFAULT_REPLY = "¿Podrías repetirlo?"
+
+# strict=False admite caracteres de control dentro de las cadenas (saltos de línea sin escapar)
+_decoder = json.JSONDecoder(strict=False)
+
+
+class LLMOutputError(ValueError):
+    """La salida del LLM no contiene un objeto JSON aprovechable."""
+
+
+class SlotData(BaseModel):
+    """Datos de la cita que devuelve el LLM; '?' o vacío equivalen a no informado."""
+
+    model_config = ConfigDict(extra='ignore')
+
+    terapia: str | None = None
+    subopcion: str | None = None
+    fecha: str | None = None
+    hora: str | None = None
+
+    @field_validator('terapia', 'subopcion', 'fecha', 'hora', mode='before')
+    @classmethod
+    def _clean(cls, value):
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        value = str(value).strip()
+        return value if value and value != '?' else None
+
+    def slots(self) -> dict:
+        """Solo los campos informados, como dict."""
+        return self.model_dump(exclude_none=True)
+
+
+SLOT_FIELDS = tuple(SlotData.model_fields)
+
+
+class LLMOutput(BaseModel):
+    """
+    Admite el formato completo ({"respuesta", "data": {...}}) y el compacto, con solo
+    los campos que cambian en el primer nivel y "respuesta" opcional (None si no viene).
+    """
+
+    model_config = ConfigDict(extra='ignore')
+
+    respuesta: str | None = None
+    data: SlotData = SlotData()
+    # True si el JSON venía cortado y se ha reconstruido
+    recovered: bool = False
+
+    @model_validator(mode='before')
+    @classmethod
+    def _compact(cls, value):
+        if isinstance(value, dict) and 'data' not in value:
+            value = {**value, 'data': {k: value[k] for k in SLOT_FIELDS if k in value}}
+        return value
+
+    @field_validator('respuesta', mode='before')
+    @classmethod
+    def _reply(cls, value):
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        value = str(value)
+        return value if value.strip() else None
+
+    @field_validator('data', mode='before')
+    @classmethod
+    def _data(cls, value):
+        return value if isinstance(value, dict) else {}
+
+
+def _json_start(text: str) -> int:
+    """Posición del primer '{' tras quitar los bloques <think> (cerrados o no)."""
+    closed = text.rfind('</think>')
+    text_start = closed + len('</think>') if closed != -1 else 0
+    open_think = text.find('<think>', text_start)
+    if open_think != -1:
+        # <think> sin cerrar: se descarta hasta el final de esa línea
+        line_end = text.find('\n', open_think)
+        text_start = len(text) if line_end == -1 else line_end
+    return text.find('{', text_start)
+
+
+def _repair_truncated(text: str) -> dict:
+    """
+    Cierra un JSON cortado a mitad (límite de tokens). Solo se completa una cadena
+    abierta en el primer nivel (el texto de "respuesta"); un valor cortado más adentro
+    se descarta volviendo a la última coma, para no guardar datos a medias ('Fis').
+    """
+    stack, cuts = [], []
+    in_string = escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+        elif c in '}]':
+            if stack:
+                stack.pop()
+        elif c == ',':
+            cuts.append((i, ''.join(reversed(stack))))
+
+    closers = ''.join(reversed(stack))
+    candidates = []
+    if not in_string:
+        candidates.append(text.rstrip().rstrip(',') + closers)
+    elif len(stack) == 1:
+        body = text[:-1] if escaped else text
+        candidates.append(body + '"' + closers)
+    candidates += [text[:i] + closing for i, closing in reversed(cuts)]
+
+    for candidate in candidates:
+        try:
+            return _decoder.decode(candidate)
+        except ValueError:
+            continue
+    raise LLMOutputError("JSON incompleto irrecuperable")
+
+
+def parse_llm_output(text: str) -> LLMOutput:
+    """
+    Una sola pasada: localiza el objeto JSON (ignorando <think> y texto alrededor),
+    lo parsea una vez y lo valida. Si viene cortado, intenta reconstruirlo.
+    """
+    start = _json_start(text or "")
+    if start == -1:
+        raise LLMOutputError("La respuesta no contiene JSON")
+
+    recovered = False
+    try:
+        raw, _ = _decoder.raw_decode(text, start)
+    except ValueError:
+        raw = _repair_truncated(text[start:])
+        recovered = True
+
+    if not isinstance(raw, dict):
+        raise LLMOutputError("Se esperaba un objeto JSON")
+    try:
+        return LLMOutput.model_validate({**raw, 'recovered': recovered})
+    except ValidationError as e:
+        # Sin str(e): incluye los valores recibidos (datos del paciente) y acabaría en los logs
+        raise LLMOutputError(f"Campos no válidos: {', '.join(str(err['loc'][0]) for err in e.errors())}") from e
@@ -0,0 +1,149 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+
+# Campos de `extra` con datos del paciente: nunca se escriben en claro si LOG_REDACT=1
+PII_FIELDS = {"user_message", "user_data", "llm_raw", "reply", "fecha", "hora", "cita_url"}
+
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_RE = re.compile(r"(?<!\d)(?:\+?\d[\s.-]?){9,}(?!\d)")
+
+# Atributos estándar de LogRecord: lo demás viene de `extra` y va al JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def redact_text(text: str) -> str:
+    """Enmascara emails y teléfonos que aparezcan en texto libre."""
+    return PHONE_RE.sub("[teléfono]", EMAIL_RE.sub("[email]", text))
+
+
+def redact_value(value):
+    """Sustituye un dato personal por una descripción sin contenido."""
+    if isinstance(value, dict):
+        return {key: "***" for key in value}
+    if isinstance(value, str):
+        return f"<{len(value)} caracteres>"
+    return "***"
+
+
+def _pii_strings(value) -> list[str]:
+    """Textos de un campo PII (también los valores de un dict), para buscarlos en el mensaje."""
+    values = value.values() if isinstance(value, dict) else [value]
+    return [v for v in values if isinstance(v, str) and len(v) >= 3]
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Redacta los campos PII_FIELDS, sus valores si se repiten en el mensaje (p. ej. dentro
+    del texto de una excepción) y emails/teléfonos (se ejecuta en el hilo de escritura).
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        for field in PII_FIELDS & vars(record).keys():
+            value = getattr(record, field)
+            # Los más largos primero: "27/10/25 10:00" antes que "27/10/25"
+            for text in sorted(_pii_strings(value), key=len, reverse=True):
+                message = message.replace(text, f"<{field}>")
+            setattr(record, field, redact_value(value))
+        record.msg = redact_text(message)
+        record.args = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar solo una fracción `rate` de los registros DEBUG; el resto de niveles siempre."""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea: ts, level, logger, msg y los campos de `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # La cola no sale del proceso: basta con congelar el texto de la excepción,
+        # el formateo y la redacción se hacen en el hilo del listener.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level: str | None = None, debug_sample_rate: float | None = None, redact: bool | None = None, stream=None):
+    """
+    Configura el logger 'secretario': los registros se encolan (coste casi nulo en la
+    petición) y un hilo aparte los redacta, formatea como JSON y escribe.
+    """
+    global _listener
+    if level is None:
+        level = os.getenv('LOG_LEVEL', 'INFO')
+    if debug_sample_rate is None:
+        debug_sample_rate = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1'))
+    if redact is None:
+        redact = os.getenv('LOG_REDACT', '1') == '1'
+
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    if redact:
+        output.addFilter(RedactingFilter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _InProcessQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+
+    logger = logging.getLogger('secretario')
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return logger
+
+
+def flush_logging():
+    """Vacía la cola y detiene el hilo de escritura (al salir del proceso)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(flush_logging)
@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Contador monotónico con etiquetas opcionales."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Histograma acumulativo (buckets, suma y recuento) con etiquetas opcionales."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        return series[2] if series else 0
+
+    def sum(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        return series[1] if series else 0.0
+
+    @contextmanager
+    def time(self, **labels):
+        """Span de tiempo: observa la duración del bloque (también si lanza excepción)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(b), s, c) for key, (b, s, c) in self._series.items()}
+        for key, (buckets, total, count) in series.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, buckets):
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, bucket_count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class CallbackMetric:
+    """Valor leído en el momento del scrape (p. ej. contadores que ya mantiene otra clase)."""
+
+    def __init__(self, name: str, help: str, fn, kind: str = "counter"):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self):
+        yield self.name, {}, self._fn()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Registrar dos veces el mismo nombre devuelve la métrica existente
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, fn, kind: str = "counter") -> CallbackMetric:
+        with self._lock:
+            metric = self._metrics[name] = CallbackMetric(name, help, fn, kind)
+            return metric
+
+    def render(self) -> str:
+        """Formato de exposición de texto de Prometheus."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LLM_SECONDS = REGISTRY.histogram(
+    "secretario_llm_request_seconds", "Duración de las llamadas a Groq.", ("mode", "outcome"))
+LLM_TIER_SECONDS = REGISTRY.histogram(
+    "secretario_llm_tier_seconds", "Duración de las llamadas a Groq por nivel de la cascada.", ("tier", "outcome"))
+LLM_ESCALATIONS = REGISTRY.counter(
+    "secretario_llm_escalations_total", "Turnos reenviados al modelo fuerte, por nivel de origen y motivo.",
+    ("tier", "reason"))
+LLM_TOKENS = REGISTRY.counter(
+    "secretario_llm_tokens_total", "Tokens consumidos en Groq.", ("kind",))
+LLM_PARSE_SECONDS = REGISTRY.histogram(
+    "secretario_llm_parse_seconds", "Limpieza y parseo del JSON devuelto por el LLM.", ("outcome",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+TIMP_SECONDS = REGISTRY.histogram(
+    "secretario_timp_request_seconds", "Duración de cada petición a TIMP.", ("mode", "outcome"))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "secretario_upstream_errors_total", "Errores de servicios externos.", ("upstream", "reason"))
+AVAILABILITY_SEARCH_DAYS = REGISTRY.histogram(
+    "secretario_availability_search_days", "Días pedidos por búsqueda de disponibilidad y cuántos fueron a TIMP.", ("source",),
+    buckets=(0, 1, 2, 3, 5, 7, 14, 21, 28))
+PREFETCHES = REGISTRY.counter(
+    "secretario_availability_prefetch_total", "Consultas anticipadas de disponibilidad según se aprovecharon o no.", ("outcome",))
+STEP_SECONDS = REGISTRY.histogram(
+    "secretario_step_seconds", "Duración de un turno según el paso de la máquina de estados.", ("step",))
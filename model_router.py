@@ -0,0 +1,53 @@
+import os
+from typing import NamedTuple
+
+
+# Modelos por nivel; vacío = el modelo del agente
+LLM_FAST_MODEL = os.getenv('LLM_FAST_MODEL', '')
+LLM_FAST_MAX_TOKENS = int(os.getenv('LLM_FAST_MAX_TOKENS', '256'))
+LLM_MAX_TOKENS = int(os.getenv('LLM_MAX_TOKENS', '800'))
+LLM_STRONG_MODEL = os.getenv('LLM_STRONG_MODEL', 'llama-3.3-70b-versatile')
+LLM_STRONG_MAX_TOKENS = int(os.getenv('LLM_STRONG_MAX_TOKENS', '800'))
+
+# Turno "simple": pocas palabras y sin frases encadenadas
+LLM_SIMPLE_MAX_WORDS = int(os.getenv('LLM_SIMPLE_MAX_WORDS', '6'))
+LLM_SIMPLE_MAX_CHARS = int(os.getenv('LLM_SIMPLE_MAX_CHARS', '48'))
+
+
+class ModelTier(NamedTuple):
+    name: str
+    model: str
+    max_tokens: int
+
+
+class ModelRouter:
+    """
+    Cascada de modelos: los turnos simples van al nivel rápido (tope de tokens
+    ajustado), el resto al modelo por defecto, y solo se escala al nivel fuerte
+    si la salida no valida. `escalation(tier)` es None si no hay nivel superior distinto.
+    """
+
+    def __init__(self, default_model: str):
+        self.fast = ModelTier("fast", LLM_FAST_MODEL or default_model, LLM_FAST_MAX_TOKENS)
+        self.default = ModelTier("default", default_model, LLM_MAX_TOKENS)
+        self.strong = ModelTier("strong", LLM_STRONG_MODEL or default_model, LLM_STRONG_MAX_TOKENS)
+
+    @staticmethod
+    def is_simple(user_message: str) -> bool:
+        text = user_message.strip()
+        return (
+            len(text) <= LLM_SIMPLE_MAX_CHARS
+            and len(text.split()) <= LLM_SIMPLE_MAX_WORDS
+            and not any(sep in text for sep in ('.', ';', '\n'))
+        )
+
+    def route(self, user_message: str) -> ModelTier:
+        return self.fast if self.is_simple(user_message) else self.default
+
+    def escalation(self, tier: ModelTier) -> ModelTier | None:
+        if tier.name == "strong":
+            return None
+        # Mismo modelo y mismo tope: repetir la llamada no aportaría nada
+        if tier.model == self.strong.model and tier.max_tokens >= self.strong.max_tokens:
+            return None
+        return self.strong
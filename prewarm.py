@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+log = logging.getLogger('secretario.prewarm')
+
+
+class AvailabilityPrewarmer:
+    """
+    Hilo en segundo plano que refresca periódicamente los próximos `days` días de
+    admisiones de todas las actividades del catálogo, para que el primer paciente
+    que pregunta por una terapia no pague la latencia de TIMP.
+    Las peticiones se espacian para no superar `rate` por segundo.
+    """
+
+    def __init__(self, cache, activity_ids, days: int = 7, interval: float = 300, rate: float = 2.0):
+        self.cache = cache
+        self.activity_ids = activity_ids
+        self.days = days
+        self.interval = interval
+        self.rate = rate
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.errors = 0
+        self.last_started = None
+        self.last_finished = None
+
+    def refresh_all(self):
+        """Una pasada completa por todas las actividades y días."""
+        self.last_started = datetime.now()
+        today = datetime.today()
+        dates = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(self.days)]
+        if self.cache.snapshot is not None:
+            self.cache.snapshot.prune(dates[0])
+
+        for activity_id in self.activity_ids():
+            for date in dates:
+                if self._stop.is_set():
+                    return
+                started = time.monotonic()
+                try:
+                    self.cache.get_admissions(activity_id, date, force_refresh=True, prewarm=True)
+                except Exception as e:
+                    self.errors += 1
+                    log.warning("Error pre-calentando: %s", e, extra={"activity_id": activity_id, "date": date})
+                # Limitar el ritmo de peticiones contra TIMP
+                self._stop.wait(max(0.0, 1 / self.rate - (time.monotonic() - started)))
+
+        self.runs += 1
+        self.last_finished = datetime.now()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh_all()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="availability-prewarmer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "runs": self.runs,
+            "errors": self.errors,
+            "days": self.days,
+            "interval_seconds": self.interval,
+            "last_started": self.last_started.isoformat(timespec='seconds') if self.last_started else None,
+            "last_finished": self.last_finished.isoformat(timespec='seconds') if self.last_finished else None
+        }
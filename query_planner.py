@@ -0,0 +1,165 @@
+import calendar
+import re
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from catalogue import fold_text
+
+
+# Franjas que el usuario puede pedir en lugar de una hora exacta
+DAY_PERIODS = {
+    "manana": ("07:00", "13:59"),
+    "mediodia": ("12:00", "15:59"),
+    "tarde": ("14:00", "21:59")
+}
+
+WEEKDAYS = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
+NUMBER_WORDS = {"un": 1, "una": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6}
+
+# Rango por defecto si el mensaje no dice nada: los próximos 7 días
+DEFAULT_DAYS = 7
+
+_NUMBER = r"(\d+|" + "|".join(NUMBER_WORDS) + r")"
+WEEKS_RE = re.compile(r"(?:durante|proximas|siguientes)\s+(?:las\s+)?(?:proximas\s+)?" + _NUMBER + r"\s+semanas?")
+IN_DAYS_RE = re.compile(r"\ben\s+(\d+)\s*dias\b")
+DAY_SPAN_RE = re.compile(r"\bdel\s+(\d{1,2})\s+al\s+(\d{1,2})\b")
+AFTER_RE = re.compile(r"\b(?:a partir de|despues de|desde)\s+las?\s+(\d{1,2})(?:[:.h](\d{2}))?")
+BEFORE_RE = re.compile(r"\bantes de\s+las?\s+(\d{1,2})(?:[:.h](\d{2}))?")
+# "mañana" como franja ("por la mañana", "las mañanas"), no como día
+MORNING_RE = re.compile(r"\b(?:por la|de la|de|las|a primera hora de la)\s+mananas?\b")
+AFTERNOON_RE = re.compile(r"\b(?:por la|de la|las)\s+tardes?\b")
+NOON_RE = re.compile(r"\b(?:a\s+)?mediodia\b")
+
+
+class AvailabilityQuery(NamedTuple):
+    """
+    Búsqueda de disponibilidad ya planificada: los días concretos que hay que pedir a
+    TIMP (offsets desde hoy, ordenados) y, si se indicó, la franja horaria a filtrar.
+    clamped=True si lo pedido pasaba del horizonte y se ha recortado (hay que decírselo al usuario).
+    """
+
+    offsets: tuple[int, ...]
+    window: tuple[str, str] | None = None
+    clamped: bool = False
+
+    def dates(self, today: datetime | None = None) -> list[str]:
+        today = today or datetime.today()
+        return [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in self.offsets]
+
+    @property
+    def span(self) -> tuple[int, int]:
+        """(primer, último) offset, como devolvía interpret_date_range."""
+        return (self.offsets[0], self.offsets[-1]) if self.offsets else (0, -1)
+
+
+def _number(text: str) -> int:
+    return int(text) if text.isdigit() else NUMBER_WORDS[text]
+
+def _hour(h: str, m: str | None) -> int:
+    """Minutos del día; 'las 5' sin más es por la tarde (como en el prompt: 'a las 3' → 15:00)."""
+    hour = int(h)
+    if hour < 8:
+        hour += 12
+    return min(hour, 23) * 60 + min(int(m or 0), 59)
+
+def _hhmm(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def _next_month_day(today: datetime, day: int) -> datetime | None:
+    """El próximo día `day` del mes a partir de hoy (este mes o el siguiente, cruzando de año)."""
+    year, month = today.year, today.month
+    for _ in range(2):
+        if day <= calendar.monthrange(year, month)[1]:
+            candidate = today.replace(year=year, month=month, day=day)
+            if candidate.date() >= today.date():
+                return candidate
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return None
+
+def _time_window(msg: str) -> tuple[str, str] | None:
+    if MORNING_RE.search(msg):
+        return DAY_PERIODS["manana"]
+    if AFTERNOON_RE.search(msg):
+        return DAY_PERIODS["tarde"]
+    if NOON_RE.search(msg):
+        return DAY_PERIODS["mediodia"]
+
+    after, before = AFTER_RE.search(msg), BEFORE_RE.search(msg)
+    if not after and not before:
+        return None
+    start = _hour(*after.groups()) if after else 0
+    end = _hour(*before.groups()) - 1 if before else 23 * 60 + 59
+    return (_hhmm(start), _hhmm(end)) if start <= end else None
+
+def _day_range(msg: str, today: datetime) -> tuple[int, int] | None:
+    """Rango contiguo (inicio, fin) de offsets que cubre la frase, o None si no nombra ninguno."""
+    weekday = today.weekday()
+
+    match = WEEKS_RE.search(msg)
+    if match:
+        return 0, 7 * _number(match.group(1)) - 1
+
+    if any(p in msg for p in ("semana que viene", "proxima semana", "semana proxima", "siguiente semana")):
+        # De lunes a domingo de la semana siguiente
+        start = 7 - weekday
+        return start, start + 6
+    if "esta semana" in msg:
+        return 0, 6 - weekday
+    if "fin de semana" in msg:
+        # El próximo sábado y domingo (o lo que quede de este si ya es fin de semana)
+        start = max(0, 5 - weekday)
+        return start, 6 - weekday
+
+    match = IN_DAYS_RE.search(msg)
+    if match:
+        n = int(match.group(1))
+        return max(0, n - 1), n + 2
+
+    match = DAY_SPAN_RE.search(msg)
+    if match:
+        first = _next_month_day(today, int(match.group(1)))
+        last = _next_month_day(first or today, int(match.group(2)))
+        if first and last:
+            return (first - today).days, (last - today).days
+
+    return None
+
+def plan_availability_query(user_message: str, today: datetime, max_days: int = 28) -> AvailabilityQuery:
+    """
+    Traduce la frase del usuario a días concretos + franja, para pedir a TIMP solo lo necesario:
+    'martes y jueves por la mañana durante tres semanas' → 6 días y la franja de mañana.
+    """
+    msg = fold_text(user_message)
+    window = _time_window(msg)
+    weekday = today.weekday()
+
+    # Un rango explícito manda sobre un día suelto: "hoy no, mejor la semana que viene"
+    day_range = _day_range(msg, today)
+    if day_range is None:
+        # Un día concreto: "hoy", "pasado mañana", "mañana" (sin "por la"), "el martes que viene"
+        if re.search(r"\bhoy\b", msg):
+            return AvailabilityQuery((0,), window)
+        if "pasado manana" in msg:
+            return AvailabilityQuery((2,), window)
+        if re.search(r"\bmanana\b", MORNING_RE.sub("", msg)):
+            return AvailabilityQuery((1,), window)
+        for i, name in enumerate(WEEKDAYS):
+            if f"{name} que viene" in msg or f"proximo {name}" in msg:
+                return AvailabilityQuery(((i - weekday - 1) % 7 + 1,), window)
+        day_range = (0, DEFAULT_DAYS - 1)
+
+    start, end = max(0, day_range[0]), day_range[1]
+    clamped = end > max_days - 1
+    if clamped:
+        # Más allá del horizonte: los últimos días que sí se consultan, con la misma duración
+        end = max_days - 1
+        start = max(0, min(start, end - (day_range[1] - day_range[0])))
+    offsets = range(start, end + 1)
+
+    # "martes y jueves", "los lunes": solo esos días de la semana dentro del rango
+    wanted = {i for i, name in enumerate(WEEKDAYS) if re.search(rf"\b{name}\b", msg)}
+    if wanted:
+        selected = [i for i in offsets if (weekday + i) % 7 in wanted]
+        if selected:
+            return AvailabilityQuery(tuple(selected), window, clamped)
+    return AvailabilityQuery(tuple(offsets), window, clamped)
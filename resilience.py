@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import UPSTREAM_ERRORS
+
+
+class UpstreamUnavailable(Exception):
+    """Llamada rechazada sin salir del proceso: circuito abierto o límite de ritmo agotado."""
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class TokenBucket:
+    """Cubo de tokens: `rate` peticiones por segundo de media con ráfagas de hasta `burst`."""
+
+    def __init__(self, rate: float, burst: int, timer=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._timer = timer
+        self._tokens = float(burst)
+        self._updated = timer()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float = 0.0) -> float | None:
+        """
+        Reserva un token. Devuelve los segundos que hay que esperar antes de usarlo
+        (0 si hay uno libre), o None si la espera superaría max_wait (no se reserva nada).
+        """
+        with self._lock:
+            now = self._timer()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    """
+    Tras `failure_threshold` fallos seguidos se abre y rechaza llamadas durante
+    `reset_timeout` segundos; después deja pasar una de prueba (semiabierto) y
+    se cierra si sale bien o vuelve a abrirse si falla.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, timer=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._timer = timer
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._timer() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._timer() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # Semiabierto: solo una llamada de prueba a la vez
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """Libera la llamada de prueba sin cambiar de estado (no llegó a hacerse)."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._timer()
+
+
+def _is_upstream_failure(error: BaseException) -> bool:
+    """5xx, 429, timeouts y errores de red cuentan como fallo; los 4xx son culpa de la petición."""
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return isinstance(error, Exception)
+
+
+class UpstreamGuard:
+    """
+    Limitador de ritmo + circuit breaker compartidos para un servicio externo.
+    Uso: `with guard.call(): ...` (o `async with guard.acall(): ...`); si el circuito
+    está abierto o no hay token en max_wait segundos se lanza UpstreamUnavailable al momento.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float = 10,
+        burst: int = 20,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        max_wait: float = 0.5,
+        is_failure=_is_upstream_failure,
+        timer=time.monotonic
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(rate, burst, timer)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, timer)
+        self._is_failure = is_failure
+
+    def available(self) -> bool:
+        """False si el circuito está abierto (una llamada ahora fallaría sin intentarlo)."""
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def _admit(self) -> float:
+        if not self.breaker.allow():
+            UPSTREAM_ERRORS.inc(upstream=self.name, reason="circuit_open")
+            raise UpstreamUnavailable(self.name, "circuit_open")
+        wait = self.bucket.reserve(self.max_wait)
+        if wait is None:
+            # No llegó a salir la llamada: no cuenta ni como éxito ni como fallo
+            self.breaker.release()
+            UPSTREAM_ERRORS.inc(upstream=self.name, reason="rate_limited")
+            raise UpstreamUnavailable(self.name, "rate_limited")
+        return wait
+
+    def _record(self, error: BaseException | None):
+        if error is None:
+            self.breaker.record_success()
+        elif self._is_failure(error):
+            self.breaker.record_failure()
+        elif isinstance(error, Exception):
+            # 4xx: el servicio responde, la culpa es de la petición
+            self.breaker.record_success()
+        else:
+            # Cancelación: no dice nada del servicio
+            self.breaker.release()
+
+    @contextmanager
+    def call(self):
+        wait = self._admit()
+        if wait:
+            time.sleep(wait)
+        try:
+            yield
+        except BaseException as e:
+            self._record(e)
+            raise
+        self._record(None)
+
+    @asynccontextmanager
+    async def acall(self):
+        wait = self._admit()
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            yield
+        except BaseException as e:
+            self._record(e)
+            raise
+        self._record(None)
+
+    def status(self) -> dict:
+        return {"state": self.breaker.state, "rate": self.bucket.rate, "burst": self.bucket.burst}
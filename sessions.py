@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+
+from cachetools import TTLCache
+
+log = logging.getLogger('secretario.sessions')
+
+
+def encode_state(state: dict) -> bytes:
+    """Estado del agente → JSON compacto comprimido."""
+    return zlib.compress(json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_state(blob: bytes) -> dict:
+    return json.loads(zlib.decompress(blob))
+
+
+class SessionBackend:
+    """
+    Almacenamiento compartido del estado serializado de las sesiones, para que
+    varios workers o nodos atiendan la misma conversación sin sesiones pegajosas.
+    """
+
+    def load(self, session_id: str) -> bytes | None:
+        raise NotImplementedError
+
+    def save(self, session_id: str, blob: bytes):
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def flush(self):
+        """Escribe lo que quede pendiente (backends con escritura diferida)."""
+
+    def close(self):
+        self.flush()
+
+
+class MemoryBackend(SessionBackend):
+    """Backend en memoria del proceso (un solo worker, tests)."""
+
+    def __init__(self, idle_ttl: float = 1800, max_sessions: int = 10000, timer=time.monotonic):
+        self._blobs = TTLCache(maxsize=max_sessions, ttl=idle_ttl, timer=timer)
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> bytes | None:
+        with self._lock:
+            return self._blobs.get(session_id)
+
+    def save(self, session_id: str, blob: bytes):
+        with self._lock:
+            self._blobs[session_id] = blob
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._blobs.pop(session_id, None)
+
+
+class SQLiteBackend(SessionBackend):
+    """
+    Backend SQLite en modo WAL, compartido por los workers de una máquina.
+    Las escrituras se acumulan y un hilo las vuelca en lote cada flush_interval
+    segundos (una transacción para todas), así cada turno no paga un fsync.
+    """
+
+    def __init__(self, path: str, idle_ttl: float = 1800, flush_interval: float = 0.2, timer=time.time):
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._timer = timer
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state BLOB NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db_lock = threading.Lock()
+        self._pending: dict[str, bytes | None] = {}
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(target=self._run, name="session-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.error("Error guardando sesiones: %s", e)
+
+    def load(self, session_id: str) -> bytes | None:
+        with self._pending_lock:
+            if session_id in self._pending:
+                return self._pending[session_id]
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT state FROM sessions WHERE id = ? AND updated >= ?",
+                (session_id, self._timer() - self.idle_ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save(self, session_id: str, blob: bytes):
+        with self._pending_lock:
+            self._pending[session_id] = blob
+        if self._thread is None:
+            self.flush()
+
+    def delete(self, session_id: str):
+        with self._pending_lock:
+            self._pending[session_id] = None
+        if self._thread is None:
+            self.flush()
+
+    def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = self._timer()
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (id, state, updated) VALUES (?, ?, ?)",
+                    [(sid, blob, now) for sid, blob in pending.items() if blob is not None]
+                )
+                self._conn.executemany(
+                    "DELETE FROM sessions WHERE id = ?",
+                    [(sid,) for sid, blob in pending.items() if blob is None]
+                )
+                self._conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.idle_ttl,))
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+async def _acquire_in_thread(lock: threading.Lock):
+    """Toma un threading.Lock sin bloquear el event loop; si se cancela la espera, lo suelta al conseguirlo."""
+    if lock.acquire(blocking=False):
+        return
+    task = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+    try:
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        task.add_done_callback(lambda _: lock.release())
+        raise
+
+
+class _Session:
+    __slots__ = ("agent", "lock", "alock", "blob")
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.lock = threading.Lock()
+        # Turnos asíncronos de la misma sesión: esperan aquí sin ocupar hilos
+        self.alock = asyncio.Lock()
+        # Último estado serializado que conoce este proceso (evita decodificar si no cambió)
+        self.blob = None
+
+
+class SessionStore:
+    """
+    Estado de conversación por sesión (un agente por paciente).
+    Las sesiones caducan tras idle_ttl segundos sin actividad y, si se supera
+    max_sessions, se descarta la usada hace más tiempo (LRU).
+    Con un backend, el estado (agent.dump_state()) se relee al empezar cada turno
+    y se guarda al terminarlo, de modo que otros workers pueden continuar la conversación.
+    """
+
+    def __init__(
+        self,
+        factory,
+        idle_ttl: float = 1800,
+        max_sessions: int = 1000,
+        timer=time.monotonic,
+        backend: SessionBackend | None = None
+    ):
+        self._factory = factory
+        self.backend = backend
+        self._sessions = TTLCache(maxsize=max_sessions, ttl=idle_ttl, timer=timer)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id() -> str:
+        return secrets.token_urlsafe(24)
+
+    def _entry(self, session_id: str) -> _Session:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = _Session(self._factory())
+            # Reasignar renueva el TTL de inactividad y la posición LRU
+            self._sessions[session_id] = entry
+            return entry
+
+    def _restore(self, session_id: str, entry: _Session):
+        if self.backend is None:
+            return
+        blob = self.backend.load(session_id)
+        if blob is not None and blob != entry.blob:
+            entry.agent.load_state(decode_state(blob))
+            entry.blob = blob
+
+    def _persist(self, session_id: str, entry: _Session):
+        if self.backend is None:
+            return
+        blob = encode_state(entry.agent.dump_state())
+        if blob != entry.blob:
+            self.backend.save(session_id, blob)
+            entry.blob = blob
+
+    @contextmanager
+    def session(self, session_id: str):
+        """
+        Devuelve el agente de la sesión (creándolo si no existe) con su lock tomado,
+        de modo que dos peticiones de la misma sesión no se pisan el estado.
+        """
+        entry = self._entry(session_id)
+        with entry.lock:
+            self._restore(session_id, entry)
+            try:
+                yield entry.agent
+            finally:
+                self._persist(session_id, entry)
+
+    @asynccontextmanager
+    async def asession(self, session_id: str):
+        """
+        Igual que session() para la ruta asíncrona: los turnos de la misma sesión se
+        ponen en cola en un asyncio.Lock, y la lectura/escritura del backend (SQLite)
+        va a un hilo para no bloquear el event loop.
+        """
+        entry = self._entry(session_id)
+        async with entry.alock:
+            # Excluye también a la ruta síncrona (normalmente libre: una sola espera en hilo si no)
+            await _acquire_in_thread(entry.lock)
+            try:
+                if self.backend is not None:
+                    await asyncio.to_thread(self._restore, session_id, entry)
+                try:
+                    yield entry.agent
+                finally:
+                    if self.backend is not None:
+                        await asyncio.to_thread(self._persist, session_id, entry)
+            finally:
+                entry.lock.release()
+
+    def discard(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._sessions.expire()
+            return len(self._sessions)
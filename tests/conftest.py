@@ -0,0 +1,31 @@
+from unittest.mock import patch
+
+import pytest
+
+import app as app_module
+from resilience import UpstreamGuard
+
+
+@pytest.fixture(autouse=True)
+def clear_llm_cache():
+    # Cada test simula sus propias respuestas del LLM: no reutilizar las de otro test
+    app_module.llm_cache.clear()
+    yield
+    app_module.llm_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream_guards():
+    # Los fallos simulados de un test no deben dejar abierto el circuito para el siguiente
+    timp_guard = UpstreamGuard("timp", rate=1000, burst=1000)
+    groq_guard = UpstreamGuard("groq", rate=1000, burst=1000)
+    with patch.object(app_module, "timp_guard", timp_guard), patch.object(app_module, "groq_guard", groq_guard), \
+            patch.object(app_module.admissions_cache, "guard", timp_guard):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def no_speculative_prefetch():
+    # La consulta anticipada iría a TIMP de verdad: solo la activan los tests que la prueban
+    with patch.object(app_module, "SPECULATIVE_PREFETCH", False):
+        yield
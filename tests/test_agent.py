@@ -1,6 +1,12 @@
 import pytest
 from unittest.mock import patch, MagicMock
-from app import NaturalAppointmentAgent, clean_llm_response
+from datetime import datetime, timedelta
+from app import (
+    NaturalAppointmentAgent, clean_llm_response, LLM_HISTORY_MESSAGES,
+    fast_extract_slots, normalize_subopcion, FastPathStats
+)
+from metrics import LLM_ESCALATIONS
+from model_router import ModelRouter
 
 
 @pytest.fixture
@@ -23,6 +29,19 @@ def test_agent_init(agent):
     assert "JSON" in agent.conversation_history[0]["content"]
     assert agent.user_data == {}
 
+def test_prompt_de_sistema_compartido_y_del_dia(agent):
+    other = NaturalAppointmentAgent(client=MagicMock())
+    assert other.conversation_history[0] is agent.conversation_history[0]
+
+    # El prefijo no depende del día; la fecha de hoy va en la cabecera que lo sigue
+    messages = agent.build_llm_messages("hola")
+    assert messages[0] is agent.conversation_history[0]
+    assert "Fisioterapia" in messages[0]["content"]
+    assert "Hoy es" not in messages[0]["content"]
+    assert f"{datetime.now():%d/%m/%Y}." in messages[1]["content"]
+    # El ejemplo de subopción sale del catálogo, con su grafía exacta
+    assert '"Fisio+Indiba+Láser"' in messages[0]["content"]
+
 
 # === Tests de utilidad ===
 
@@ -59,8 +78,86 @@ def test_extract_data_with_llm_error_fallback(agent):
     assert "fallo técnico" in result
 
 
+def test_build_llm_messages_ventana_acotada(agent):
+    for i in range(30):
+        agent.conversation_history.append({"role": "user", "content": f"mensaje {i}"})
+        agent.conversation_history.append({"role": "assistant", "content": f"respuesta {i}"})
+
+    messages = agent.build_llm_messages("nuevo")
+
+    assert messages[0] is agent.conversation_history[0]
+    assert messages[-1] == {"role": "user", "content": "nuevo"}
+    assert len(messages) <= 2 + LLM_HISTORY_MESSAGES + 1
+    assert messages[-2]["content"] == "respuesta 29"
+
+def test_build_llm_messages_resumen_y_sin_duplicar(agent):
+    agent.user_data = {"terapia": "Láser"}
+    agent.conversation_history.append({"role": "user", "content": "el martes"})
+
+    messages = agent.build_llm_messages("el martes")
+
+    assert messages[1]["role"] == "system"
+    assert "Hoy es" in messages[1]["content"] and "Láser" in messages[1]["content"]
+    assert [m["content"] for m in messages].count("el martes") == 1
+
+def test_build_llm_messages_respeta_presupuesto_tokens(agent):
+    agent.conversation_history.append({"role": "user", "content": "x" * 100000})
+    agent.conversation_history.append({"role": "assistant", "content": "corto"})
+
+    messages = agent.build_llm_messages("hola")
+
+    assert all(len(m["content"]) < 100000 for m in messages)
+    assert messages[-2]["content"] == "corto"
+
+
+# === Tests del parser local (sin LLM) ===
+
+def test_fast_extract_terapia_y_subopcion():
+    assert fast_extract_slots("Fisioterapia", {}) == {"terapia": "Fisioterapia"}
+    assert fast_extract_slots("Indiba + Láser", {}) == {"terapia": "Indiba", "subopcion": "Indiba + Láser"}
+    assert fast_extract_slots("laser", {"terapia": "Láser"}) == {"subopcion": "Láser"}
+    assert fast_extract_slots("doble", {"terapia": "Indiba"}) == {"subopcion": "Indiba + Láser"}
+
+def test_fast_extract_fecha_y_hora():
+    today = datetime(2025, 10, 16)
+    user_data = {"terapia": "Láser", "subopcion": "Láser"}
+
+    assert fast_extract_slots("20/10 a las 09:15", user_data, today) == {"fecha": "20/10/25", "hora": "09:15"}
+    assert fast_extract_slots("a las 9:30", {**user_data, "fecha": "20/10/25"}, today) == {"hora": "09:30"}
+    assert fast_extract_slots("31/02 a las 10:00", user_data, today) is None
+
+def test_fast_extract_no_seguro_delega_en_llm():
+    assert fast_extract_slots("quiero fisio el martes que viene", {}) is None
+    assert fast_extract_slots("20/10 a las 09:15", {"terapia": "Láser"}) is None
+    assert fast_extract_slots("a las 3", {"terapia": "Láser", "subopcion": "Láser", "fecha": "20/10/25"}) is None
+
+def test_normalize_subopcion():
+    assert normalize_subopcion("Láser") == "Láser"
+    assert normalize_subopcion("fisioterapia 1a visita") == "Fisioterapia 1ª visita"
+    assert normalize_subopcion("tratamiento laser") == "Tratamiento Láser"
+
+def test_send_message_fast_path_no_llama_al_llm(agent):
+    stats = FastPathStats()
+    agent.send_message("Hola")
+    with patch('app.fast_path_stats', stats):
+        response = agent.send_message("Fisioterapia")
+
+    assert "Fisioterapia 1ª visita" in response
+    agent._mock_client.chat.completions.create.assert_not_called()
+    assert stats.hits == 1 and stats.hit_rate == 1.0
+
+
 # === Tests de actualización de datos ===
 
+def test_fast_path_pregunta_por_lo_que_falta(agent):
+    agent.send_message("Hola")
+    agent.user_data = {"terapia": "Fisioterapia", "subopcion": "Fisioterapia", "fecha": "20/10/26"}
+
+    response = agent.send_message("Fisioterapia 1ª visita")
+
+    assert response.startswith("¿A qué hora te viene bien el 20/10/26?")
+    agent._mock_client.chat.completions.create.assert_not_called()
+
 def test_update_data_from_llm_response_valid(agent):
     llm_response = '{"data": {"terapia": "Ondas", "fecha": "01/01/25", "hora": "09:00"}}'
     agent.update_data_from_llm_response(llm_response)
@@ -193,4 +290,131 @@ def test_send_message_llm_json_error(agent):
 
     response = agent.send_message("Hola")
 
-    assert "fallo técnico" in response or "repetirme" in response
\ No newline at end of file
+    assert "fallo técnico" in response or "repetirme" in response
+
+def test_send_message_json_cortado_no_pide_repetir(agent):
+    agent.send_message("Hola")
+    mock_response = MagicMock()
+    mock_response.choices[0].message.content = '{"data": {}, "respuesta": "Cuéntame qué terapia te interes'
+    agent._mock_client.chat.completions.create.return_value = mock_response
+
+    response = agent.send_message("no sé qué elegir")
+
+    assert response == "Cuéntame qué terapia te interes"
+    assert agent.last_step == "respuesta_llm"
+
+
+@patch('app.admissions_cache.get_admissions')
+def test_send_message_hora_ocupada_ofrece_la_mas_cercana(mock_admissions, agent):
+    day = datetime.today().replace(hour=0) + timedelta(days=1)
+    mock_admissions.return_value = [
+        {"id": "slot_915", "status": "available", "hours": "09:15 - 10:15"},
+        {"id": "slot_1200", "status": "available", "hours": "12:00 - 13:00"},
+    ]
+    agent.send_message("Hola")
+    agent.user_data = {"terapia": "Fisioterapia", "subopcion": "Fisioterapia"}
+
+    response = agent.send_message(f"el {day:%d/%m} a las 09:00")
+    assert "09:15" in response and "12:00" not in response
+    assert "hora" not in agent.user_data
+
+    response = agent.send_message("a las 09:15")
+    assert "slot_915" in response
+    agent._mock_client.chat.completions.create.assert_not_called()
+
+
+# === Tests de la cascada de modelos ===
+
+def _llm_reply(content):
+    response = MagicMock()
+    response.choices[0].message.content = content
+    return response
+
+def test_router_turnos_simples_al_nivel_rapido():
+    router = ModelRouter("fake-model")
+
+    assert router.route("sí, a las 10") is router.fast
+    assert router.route("quería una cita para mi madre, que tiene dolor de espalda") is router.default
+    assert router.escalation(router.default) is router.strong
+    assert router.escalation(router.strong) is None
+
+def test_escala_al_modelo_fuerte_si_los_datos_no_validan(agent):
+    agent.send_message("Hola")
+    agent._mock_client.chat.completions.create.side_effect = [
+        _llm_reply('{"respuesta": "Perfecto", "data": {"terapia": "Acupuntura Cuántica"}}'),
+        _llm_reply('{"respuesta": "Perfecto", "data": {"terapia": "Fisioterapia"}}'),
+    ]
+    before = LLM_ESCALATIONS.value(tier="default", reason="invalid_slots")
+
+    agent.send_message("quería algo para el dolor de espalda que tengo desde hace días")
+
+    calls = agent._mock_client.chat.completions.create.call_args_list
+    assert len(calls) == 2
+    assert calls[0].kwargs["model"] == "fake-model"
+    assert calls[1].kwargs["model"] == agent.router.strong.model
+    assert agent.user_data["terapia"] == "Fisioterapia"
+    assert LLM_ESCALATIONS.value(tier="default", reason="invalid_slots") == before + 1
+
+def test_no_escala_si_la_salida_es_valida(agent):
+    agent.send_message("Hola")
+    agent._mock_client.chat.completions.create.return_value = _llm_reply(
+        '{"respuesta": "¿Qué día te viene bien?", "data": {"terapia": "Fisioterapia"}}')
+
+    agent.send_message("me duele el hombro")
+
+    call = agent._mock_client.chat.completions.create.call_args
+    assert agent._mock_client.chat.completions.create.call_count == 1
+    assert call.kwargs["max_tokens"] == agent.router.fast.max_tokens
+
+def test_escalado_no_vuelve_a_emitir_texto(agent):
+    agent.send_message("Hola")
+    responses = iter([
+        '{"respuesta": "Primera respuesta", "terapia": "Acupuntura Cuántica"}',
+        '{"respuesta": "Segunda", "terapia": "Fisioterapia"}',
+    ])
+    streamed = []
+
+    def fake_extract(user_message, on_token=None, tier=None):
+        content = next(responses)
+        if on_token:
+            on_token(content.split('"')[3])
+        return content
+
+    with patch.object(agent, "extract_data_with_llm", side_effect=fake_extract):
+        agent.send_message("quería algo para el dolor de espalda que tengo desde hace días",
+                           on_event=lambda event, data: event == "token" and streamed.append(data["text"]))
+
+    assert streamed == ["Primera respuesta"]
+    assert agent.user_data["terapia"] == "Fisioterapia"
+
+def test_extraccion_que_no_valida_no_se_cachea(agent):
+    agent.send_message("Hola")
+    agent.router.strong = agent.router.default  # sin nivel superior al que escalar
+    agent._mock_client.chat.completions.create.return_value = _llm_reply(
+        '{"respuesta": "Perfecto", "data": {"terapia": "Acupuntura Cuántica"}}')
+
+    agent.send_message("quería algo de acupuntura cuántica para la espalda")
+    agent.user_data = {}
+    agent.send_message("quería algo de acupuntura cuántica para la espalda")
+
+    assert agent._mock_client.chat.completions.create.call_count == 2
+
+
+# === Tests del formato compacto de salida ===
+
+def test_formato_compacto_sin_respuesta_pregunta_lo_que_falta(agent):
+    agent.send_message("Hola")
+    agent.user_data = {"terapia": "Fisioterapia", "subopcion": "Fisioterapia"}
+    day = datetime.today() + timedelta(days=3)
+    agent._mock_client.chat.completions.create.return_value = _llm_reply(f'{{"fecha": "{day:%d/%m/%y}"}}')
+
+    response = agent.send_message("me viene bien ese día, el que te dije antes")
+
+    assert agent.user_data["fecha"] == f"{day:%d/%m/%y}"
+    assert response.startswith(f"¿A qué hora te viene bien el {day:%d/%m/%y}?")
+    assert agent.last_step == "respuesta_llm"
+
+def test_formato_compacto_en_el_prompt(agent):
+    messages = agent.build_llm_messages("hola")
+
+    assert '"respuesta"' in messages[0]["content"] and "SOLO los campos" in messages[0]["content"]
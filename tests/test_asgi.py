@@ -0,0 +1,111 @@
+import asyncio
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import httpx
+
+import app as app_module
+from asgi import application
+from sessions import SessionStore
+
+
+def _completion(content):
+    completion = MagicMock()
+    completion.choices = [MagicMock()]
+    completion.choices[0].message.content = content
+    return completion
+
+
+def _slow_async_client(content, delay=0.1):
+    async def create(**kwargs):
+        await asyncio.sleep(delay)
+        return _completion(content)
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=create)
+    return client
+
+
+async def _post_all(messages_by_session):
+    transport = httpx.ASGITransport(app=application)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*(
+            client.post("/chat", json={"message": message}, headers={"X-Session-Id": session_id})
+            for session_id, message in messages_by_session
+        ))
+
+
+# === Tests de la ruta ASGI ===
+
+def test_asgi_chat_atiende_conversaciones_en_paralelo():
+    async_client = _slow_async_client('{"respuesta": "¿Qué terapia quieres?", "data": {}}')
+
+    def factory():
+        agent = app_module.NaturalAppointmentAgent(client=MagicMock(), async_client=async_client)
+        agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+        return agent
+
+    store = SessionStore(factory=factory)
+    requests = [(f"sesion-concurrente-{i:04d}", "hola, ¿qué me recomiendas?") for i in range(50)]
+
+    with patch.object(app_module, 'sessions', store), patch('asgi.sessions', store):
+        start = time.monotonic()
+        responses = asyncio.run(_post_all(requests))
+        elapsed = time.monotonic() - start
+
+    assert all(r.status_code == 200 for r in responses)
+    assert all(r.json()["response"] == "¿Qué terapia quieres?" for r in responses)
+    # 50 llamadas de 0.1 s en serie serían 5 s
+    assert elapsed < 2
+    assert async_client.chat.completions.create.await_count == 50
+
+def test_asgi_chat_consulta_timp_de_forma_asincrona():
+    agent = app_module.NaturalAppointmentAgent(client=MagicMock(), async_client=MagicMock())
+    agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+    agent.user_data = {"terapia": "Láser"}
+    store = SessionStore(factory=lambda: agent)
+    admissions = AsyncMock(return_value=[
+        {"id": 1, "status": "available", "hours": "09:00 - 10:00"},
+        {"id": 2, "status": "available", "hours": "10:00 - 11:00"},
+    ])
+
+    with patch('asgi.sessions', store), patch.object(app_module.admissions_cache, 'aget_admissions', admissions):
+        response = asyncio.run(_post_all([("sesion-timp-asincrona-01", "Tratamiento Láser")]))[0]
+
+    assert response.status_code == 200
+    assert "09:00, 10:00" in response.json()["response"]
+    assert admissions.await_count == 7
+
+def test_asgi_chat_stream_asincrono():
+    async_client = _slow_async_client('{"respuesta": "¿Qué terapia quieres?", "data": {}}', delay=0)
+    agent = app_module.NaturalAppointmentAgent(client=MagicMock(), async_client=async_client)
+    agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+    store = SessionStore(factory=lambda: agent)
+
+    async def post_stream():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/chat/stream", json={"message": "hola, ¿qué me recomiendas?"},
+                                     headers={"X-Session-Id": "sesion-stream-asinc-01"})
+
+    with patch('asgi.sessions', store), patch.object(app_module.threading, 'Thread') as thread:
+        response = asyncio.run(post_stream())
+
+    thread.assert_not_called()
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert "event: progress" in response.text
+    assert 'event: done\ndata: {"response": "¿Qué terapia quieres?"' in response.text
+
+def test_asgi_chat_mensaje_vacio():
+    response = asyncio.run(_post_all([("sesion-vacia-000000001", "   ")]))[0]
+    assert response.status_code == 400
+
+def test_asgi_delega_en_flask():
+    async def get_home():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/")
+
+    response = asyncio.run(get_home())
+    assert response.status_code == 200
+    assert "chatbox" in response.text
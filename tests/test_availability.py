@@ -0,0 +1,307 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import app as app_module
+from app import (
+    day_period, find_nearby_slots, free_options_at, get_availability_bitmaps, get_availability_grid,
+    get_available_dates_for_therapy
+)
+from metrics import AVAILABILITY_SEARCH_DAYS, PREFETCHES
+from query_planner import plan_availability_query
+from timp import AdmissionsCache, TimpError
+
+
+# === Tests de consulta concurrente de disponibilidad ===
+
+@patch('app.admissions_cache.get_admissions')
+def test_get_available_dates_orden_determinista(mock_admissions):
+    today = datetime.today()
+
+    def fake_admissions(activity_id, date, timeout=None, force_refresh=False):
+        # Los primeros días tardan más: el resultado debe seguir ordenado
+        offset = (datetime.strptime(date, "%Y-%m-%d").date() - today.date()).days
+        time.sleep(0.02 * (3 - offset))
+        return [
+            {"id": offset, "status": "available", "hours": "10:00 - 11:00"},
+            {"id": 99, "status": "available", "hours": "09:00 - 10:00"},
+            {"id": 98, "status": "full", "hours": "12:00 - 13:00"},
+        ]
+
+    mock_admissions.side_effect = fake_admissions
+    available = get_available_dates_for_therapy(72574, 0, 3)
+
+    expected_days = [(today + timedelta(days=i)).strftime("%d/%m") for i in range(4)]
+    assert list(available.keys()) == expected_days
+    assert all(times == ["09:00", "10:00"] for times in available.values())
+    assert mock_admissions.call_count == 4
+
+@patch('app.admissions_cache.get_admissions')
+def test_get_available_dates_respeta_limite_concurrencia(mock_admissions):
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+
+    def fake_admissions(activity_id, date, timeout=None, force_refresh=False):
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.02)
+        with lock:
+            state["active"] -= 1
+        return []
+
+    mock_admissions.side_effect = fake_admissions
+    get_available_dates_for_therapy(72574, 0, 9, max_workers=3, timeout=2)
+
+    assert mock_admissions.call_count == 10
+    assert state["peak"] <= 3
+    assert all(call.kwargs["timeout"] == 2 for call in mock_admissions.call_args_list)
+
+@patch('app.admissions_cache.get_admissions')
+def test_get_available_dates_ignora_dias_con_error(mock_admissions):
+    mock_admissions.side_effect = [
+        [{"id": 1, "status": "available", "hours": "08:00 - 09:00"}],
+        Exception("timeout"),
+        TimpError(500, "boom"),
+    ]
+    available = get_available_dates_for_therapy(72574, 0, 2, max_workers=1)
+
+    assert list(available.values()) == [["08:00"]]
+
+@patch('app.admissions_cache.get_admissions')
+def test_plan_solo_pide_los_dias_y_horas_necesarios(mock_admissions):
+    mock_admissions.return_value = [
+        {"id": 1, "status": "available", "hours": "09:00 - 10:00"},
+        {"id": 2, "status": "available", "hours": "16:00 - 17:00"},
+    ]
+    query = plan_availability_query("martes y jueves por la mañana durante tres semanas", datetime.today())
+    requested = AVAILABILITY_SEARCH_DAYS.count(source="requested")
+
+    available = get_available_dates_for_therapy(72574, query=query)
+
+    assert mock_admissions.call_count == len(query.offsets) == 6
+    assert sorted(call.args[1] for call in mock_admissions.call_args_list) == query.dates()
+    assert all(times == ["09:00"] for times in available.values())
+    assert AVAILABILITY_SEARCH_DAYS.count(source="requested") == requested + 1
+
+
+# === Tests de la rejilla multi-actividad y /availability ===
+
+def _slots_by_activity(activity_id, date, timeout=None, force_refresh=False):
+    # Actividad 72648 solo tiene hueco los días pares del mes; el resto, siempre a las 10:00
+    if activity_id == 72648 and int(date[-2:]) % 2:
+        return []
+    return [{"id": 1, "status": "available", "hours": "10:00 - 11:00"}]
+
+@patch('app.admissions_cache.get_admissions')
+def test_availability_grid_un_solo_lote(mock_admissions):
+    mock_admissions.side_effect = _slots_by_activity
+    grid = get_availability_grid([72648, 72649], start_offset=7, days=14)
+
+    first = (datetime.today() + timedelta(days=7)).strftime("%Y-%m-%d")
+    assert mock_admissions.call_count == 28
+    assert list(grid[72649])[0] == first and len(grid[72649]) == 14
+    assert all(int(d[-2:]) % 2 == 0 for d in grid[72648])
+    assert list(grid[72648]) == sorted(grid[72648])
+
+@patch('app.admissions_cache.get_admissions')
+def test_availability_endpoint_todas_las_subopciones(mock_admissions):
+    mock_admissions.side_effect = _slots_by_activity
+    client = app_module.app.test_client()
+
+    body = client.get('/availability?therapy=fisio&days=21').get_json()
+
+    names = [a["name"] for a in body["activities"]]
+    assert names == ["Fisioterapia 1ª visita", "Fisioterapia", "Fisio+Indiba+Láser"]
+    assert all(a["therapy"] == "Fisioterapia" for a in body["activities"])
+    assert len(body["activities"][1]["dates"]) == 21
+    assert mock_admissions.call_count == 3 * 21
+
+@patch('app.admissions_cache.get_admissions')
+def test_free_options_at_cruza_subopciones_y_dias(mock_admissions):
+    mock_admissions.side_effect = _slots_by_activity
+    bitmaps = get_availability_bitmaps([72648, 72574], [_day(i) for i in range(7)])
+    free = free_options_at(bitmaps, "10:00")
+
+    assert len(free) == 7
+    for check_date, activity_ids in free.items():
+        assert activity_ids == ([72648, 72574] if int(check_date[-2:]) % 2 == 0 else [72574])
+    assert free_options_at(bitmaps, "10:30") == {}
+
+    body = app_module.app.test_client().get('/availability?activity_id=72648&activity_id=72574&days=7&at=10:00').get_json()
+    assert body["free_at"] == {"time": "10:00", "dates": free}
+    assert mock_admissions.call_count == 2 * 7 * 2
+
+@patch('app.admissions_cache.get_admissions')
+def test_availability_endpoint_franja_y_combinacion(mock_admissions):
+    mock_admissions.side_effect = _slots_by_activity
+    client = app_module.app.test_client()
+
+    body = client.get('/availability?activity_id=72648&activity_id=72574&days=4&combine=all&period=mañana').get_json()
+    both = [d for d in body["activities"][1]["dates"] if int(d[-2:]) % 2 == 0]
+    assert body["combined"] == {"how": "all", "dates": {d: ["10:00"] for d in both}}
+
+    body = client.get('/availability?activity_id=72574&days=4&from=10:30&to=12:00&combine=any').get_json()
+    assert body["activities"][0]["dates"] == {} and body["combined"]["dates"] == {}
+
+    assert client.get('/availability?activity_id=72574&period=noche').status_code == 400
+    assert client.get('/availability?activity_id=72574&from=9').status_code == 400
+    assert client.get('/availability?activity_id=72574&combine=some').status_code == 400
+
+def test_availability_endpoint_valida_parametros():
+    client = app_module.app.test_client()
+
+    assert client.get('/availability').status_code == 400
+    assert client.get('/availability?therapy=fisio&days=90').status_code == 400
+    assert client.get('/availability?therapy=fisio&start=99999999999').status_code == 400
+    assert client.get('/availability?therapy=fisio&start=20&days=14').status_code == 400
+    assert client.get('/availability?activity_id=abc').status_code == 400
+    assert client.get('/availability?therapy=yoga').status_code == 404
+    assert client.get('/availability?activity_id=1').status_code == 404
+
+
+# === Tests de búsqueda del hueco más cercano ===
+
+def _day(offset):
+    return (datetime.today() + timedelta(days=offset)).strftime("%Y-%m-%d")
+
+def _slots_for(hours_by_date):
+    def fake_admissions(activity_id, date, timeout=None, force_refresh=False):
+        return [
+            {"id": f"{date}-{h}", "status": "available", "hours": f"{h} - --:--"}
+            for h in hours_by_date.get(date, [])
+        ]
+    return fake_admissions
+
+@patch('app.admissions_cache.get_admissions')
+def test_find_nearby_slots_mismo_dia_y_contiguos(mock_admissions):
+    mock_admissions.side_effect = _slots_for({
+        _day(1): ["08:00", "10:15", "12:30"],
+        _day(2): ["10:00"],
+        _day(0): ["10:30"],
+    })
+
+    nearby = find_nearby_slots(72648, _day(1), "10:00", limit=3)
+
+    assert nearby == [(_day(1), "10:15"), (_day(2), "10:00"), (_day(0), "10:30")]
+    assert mock_admissions.call_count == 3
+
+@patch('app.admissions_cache.get_admissions')
+def test_find_nearby_slots_por_franja_sin_dias_pasados(mock_admissions):
+    mock_admissions.side_effect = _slots_for({_day(0): ["09:00", "16:00", "18:30"]})
+
+    nearby = find_nearby_slots(72648, _day(0), period=day_period("por la tarde"))
+
+    assert nearby == [(_day(0), "16:00"), (_day(0), "18:30")]
+    assert [c.args[1] for c in mock_admissions.call_args_list] == [_day(0), _day(1)]
+
+
+# === Tests de la consulta anticipada mientras responde el LLM ===
+
+TWO_SLOTS = [
+    {"id": 1, "status": "available", "hours": "10:00 - 11:00"},
+    {"id": 2, "status": "available", "hours": "11:00 - 12:00"},
+]
+
+def _completion(content):
+    completion = MagicMock()
+    completion.choices = [MagicMock()]
+    completion.choices[0].message.content = content
+    return completion
+
+def _agent_eligiendo_fecha(**clients):
+    agent = app_module.NaturalAppointmentAgent(**clients)
+    agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+    agent.user_data = {"terapia": "Láser", "subopcion": "Láser"}
+    return agent
+
+@patch('app.admissions_cache.get_admissions')
+def test_paso2_avisa_si_lo_pedido_pasa_del_horizonte(mock_admissions):
+    mock_admissions.return_value = TWO_SLOTS
+    client = MagicMock()
+    client.chat.completions.create.return_value = _completion('{"data": {}}')
+    agent = _agent_eligiendo_fecha(client=client)
+
+    response = agent.send_message("para dentro de un mes y pico, en 40 días")
+
+    assert response.startswith(f"Solo puedo consultar hasta {app_module.AVAILABILITY_MAX_DAYS} días vista")
+    assert "Elige una fecha" in response
+    last = (datetime.today() + timedelta(days=app_module.AVAILABILITY_MAX_DAYS - 1)).strftime("%Y-%m-%d")
+    assert max(call.args[1] for call in mock_admissions.call_args_list) == last
+
+def test_prefetch_consulta_timp_a_la_vez_que_el_llm():
+    timp_started = threading.Event()
+    timp = MagicMock()
+    timp.get_admissions.side_effect = lambda *args, **kwargs: timp_started.set() or TWO_SLOTS
+    waited = []
+
+    def completion(**kwargs):
+        # El LLM no contesta hasta ver que TIMP ya está trabajando
+        waited.append(timp_started.wait(2))
+        return _completion('{"respuesta": "Miro la semana que viene", "data": {}}')
+
+    client = MagicMock()
+    client.chat.completions.create.side_effect = completion
+    agent = _agent_eligiendo_fecha(client=client)
+    used = PREFETCHES.value(outcome="used")
+
+    with patch.object(app_module, "SPECULATIVE_PREFETCH", True), \
+            patch.object(app_module, "admissions_cache", AdmissionsCache(timp)):
+        response = agent.send_message("la semana que viene me va bien")
+
+    assert waited == [True]
+    assert "Elige una fecha" in response
+    # El paso 2 reutiliza lo descargado: una sola petición por día (7 días)
+    assert timp.get_admissions.call_count == 7
+    assert PREFETCHES.value(outcome="used") == used + 1
+
+def test_prefetch_se_cancela_si_el_llm_cambia_la_seleccion():
+    client = MagicMock()
+    client.chat.completions.create.return_value = _completion(
+        '{"respuesta": "Perfecto", "data": {"fecha": "%s", "hora": "10:00"}}'
+        % (datetime.today() + timedelta(days=8)).strftime("%d/%m/%y")
+    )
+    agent = _agent_eligiendo_fecha(client=client)
+    timp = MagicMock()
+    timp.get_admissions.return_value = TWO_SLOTS
+    cancelled = PREFETCHES.value(outcome="cancelled")
+
+    with patch.object(app_module, "SPECULATIVE_PREFETCH", True), \
+            patch.object(app_module, "admissions_cache", AdmissionsCache(timp)), \
+            patch("app.find_timp_slot", return_value="555"):
+        response = agent.send_message("la semana que viene me va bien")
+
+    assert "admissions/555" in response
+    assert PREFETCHES.value(outcome="cancelled") == cancelled + 1
+
+def test_prefetch_asincrono_solapa_timp_y_llm():
+    async def run():
+        timp_started = asyncio.Event()
+        overlapped = []
+
+        async def admissions(*args, **kwargs):
+            timp_started.set()
+            return TWO_SLOTS
+
+        async def completion(**kwargs):
+            await asyncio.wait_for(timp_started.wait(), 2)
+            overlapped.append(True)
+            return _completion('{"respuesta": "Miro la semana que viene", "data": {}}')
+
+        async_timp = MagicMock()
+        async_timp.get_admissions = AsyncMock(side_effect=admissions)
+        async_client = MagicMock()
+        async_client.chat.completions.create = AsyncMock(side_effect=completion)
+        agent = _agent_eligiendo_fecha(client=MagicMock(), async_client=async_client)
+
+        with patch.object(app_module, "SPECULATIVE_PREFETCH", True), \
+                patch.object(app_module, "admissions_cache", AdmissionsCache(MagicMock(), async_client=async_timp)):
+            response = await agent.asend_message("la semana que viene me va bien")
+        return response, overlapped, async_timp.get_admissions.await_count
+
+    response, overlapped, timp_calls = asyncio.run(run())
+    assert overlapped == [True]
+    assert "Elige una fecha" in response
+    assert timp_calls == 7
@@ -0,0 +1,90 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+from groq import Groq
+from werkzeug.serving import make_server
+
+import app as app_module
+from benchmark import SCRIPTS, FakeGroqServer, FakeTimpServer, measure_startup, percentile, run_benchmark
+from llm_cache import LLMResponseCache
+from sessions import SessionStore
+from timp import AdmissionsCache, TimpClient, TimpError
+
+
+@pytest.fixture
+def fake_timp():
+    server = FakeTimpServer(latency=0, slots_per_day=3).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def fake_groq():
+    replies = {message: data for script in SCRIPTS for message, data in script if data}
+    server = FakeGroqServer(latency=0, replies=replies).start()
+    yield server
+    server.stop()
+
+
+# === Tests del benchmark offline ===
+
+def test_percentile_rango_mas_cercano():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([0.2], 95) == 0.2
+    assert percentile([], 50) == 0.0
+
+def test_fake_timp_sirve_admisiones_con_el_cliente_real(fake_timp):
+    client = TimpClient(base_url=fake_timp.url, max_retries=0)
+    slots = client.get_admissions(72648, "2025-10-20")
+
+    assert [s["hours"] for s in slots] == ["09:00 - 10:00", "10:00 - 11:00", "11:00 - 12:00"]
+    assert fake_timp.calls == 1
+
+def test_fake_timp_tasa_de_errores(fake_timp):
+    fake_timp.error_rate = 1.0
+    client = TimpClient(base_url=fake_timp.url, max_retries=0)
+
+    with pytest.raises(TimpError) as exc:
+        client.get_admissions(72648, "2025-10-20")
+    assert exc.value.status_code == 503
+
+def test_fake_groq_compatible_con_el_sdk(fake_groq):
+    client = Groq(api_key="x", base_url=fake_groq.url)
+    completion = client.chat.completions.create(
+        model="llama-3.1-8b-instant",
+        messages=[{"role": "user", "content": "quiero pedir cita de fisioterapia"}]
+    )
+
+    assert '"terapia": "Fisioterapia"' in completion.choices[0].message.content
+    assert completion.usage.prompt_tokens == 400
+
+def test_run_benchmark_reserva_de_extremo_a_extremo(fake_timp, fake_groq):
+    groq_client = Groq(api_key="x", base_url=fake_groq.url)
+    store = SessionStore(factory=lambda: app_module.NaturalAppointmentAgent(client=groq_client))
+    cache = AdmissionsCache(TimpClient(base_url=fake_timp.url, max_retries=0))
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        with patch.object(app_module, "sessions", store), patch.object(app_module, "admissions_cache", cache), \
+                patch.object(app_module, "llm_cache", LLMResponseCache(maxsize=0)):
+            result = run_benchmark(f"http://127.0.0.1:{server.server_port}", conversations=6, concurrency=3)
+    finally:
+        server.shutdown()
+
+    assert result["bookings"] == 6
+    assert result["failures"] == 0
+    assert result["requests"] == sum(len(script) for script in SCRIPTS) * 2
+    assert 0 < result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    # Cada guion se repite dos veces: Fisioterapia usa el LLM en dos turnos, Indiba en uno, Osteopatía en ninguno
+    assert fake_groq.calls == 2 * (2 + 1 + 0)
+
+def test_arranque_sin_dependencias_pesadas_ni_api_key():
+    startup = measure_startup(runs=1)
+
+    # Sin GROQ_API_KEY la importación no falla y el SDK de Groq no se carga hasta la primera sesión
+    assert startup["heavy_modules"] == []
+    # Margen amplio para máquinas lentas: dateparser y groq sumaban casi medio segundo
+    assert startup["import_ms"] < 3000
@@ -0,0 +1,54 @@
+import json
+import os
+
+from catalogue import Catalogue, fold_text
+
+
+def test_fold_text():
+    assert fold_text("  Osteopatía  1ª Visita ") == "osteopatia 1a visita"
+
+
+# === Tests de índices del catálogo ===
+
+def test_catalogue_therapy_key_sin_acentos():
+    catalogue = Catalogue()
+
+    assert catalogue.therapy_key("Láser") == "láser"
+    assert catalogue.therapy_key("laser") == "láser"
+    assert catalogue.therapy_key("Fisio") == "fisioterapia"
+    assert catalogue.therapy_key("yoga") is None
+
+def test_catalogue_resuelve_subopciones():
+    catalogue = Catalogue()
+
+    assert catalogue.option_name("tratamiento laser") == "Tratamiento Láser"
+    assert catalogue.option_name("OSTEOPATIA 1a visita") == "Osteopatía 1ª visita"
+    assert catalogue.option_name("doble", therapy="indiba") == "Indiba + Láser"
+    assert catalogue.option_name("doble", therapy="ondas") is None
+    assert catalogue.option_name("doble", aliases=False) is None
+
+def test_catalogue_activity_ids():
+    catalogue = Catalogue()
+
+    assert catalogue.activity_id("Fisio+Indiba+Láser", therapy="fisioterapia") == 96265
+    assert catalogue.activity_id("Fisio+Indiba+Láser", therapy="indiba") is None
+    assert catalogue.therapy_for_activity(110000) == "láser"
+    assert [c["name"] for c in catalogue.choices("ondas")][0] == "Primera Visita Ondas"
+    assert len(catalogue.activity_ids()) == 12
+
+def test_catalogue_recarga_en_caliente(tmp_path):
+    path = tmp_path / "terapias.json"
+    data = {"yoga": {"name": "Yoga", "aliases": [], "first_visit": None,
+                     "options": [{"id": 1, "name": "Yoga suave", "aliases": ["suave"]}]}}
+    path.write_text(json.dumps(data), encoding="utf-8")
+    catalogue = Catalogue(str(path), check_interval=0)
+
+    assert catalogue.option_name("suave") == "Yoga suave"
+
+    data["yoga"]["options"].append({"id": 2, "name": "Yoga intenso", "aliases": []})
+    path.write_text(json.dumps(data), encoding="utf-8")
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+
+    assert catalogue.maybe_reload() is True
+    assert catalogue.activity_id("yoga intenso") == 2
@@ -0,0 +1,86 @@
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import LLM_FALLBACK_RESPONSE, NaturalAppointmentAgent
+from llm_cache import LLMResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.day = date(2025, 10, 20)
+
+    def __call__(self):
+        return self.now
+
+    def today(self):
+        return self.day
+
+
+@pytest.fixture
+def agent():
+    with patch('app.Groq') as mock_groq_class:
+        mock_client = MagicMock()
+        mock_groq_class.return_value = mock_client
+        agent = NaturalAppointmentAgent(model_name="fake-model")
+        agent._mock_client = mock_client
+    return agent
+
+def llm_reply(agent, content):
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = content
+    agent._mock_client.chat.completions.create.return_value = response
+
+
+# === Tests de la caché de respuestas del LLM ===
+
+def test_clave_normaliza_mensaje_y_depende_del_estado():
+    cache = LLMResponseCache()
+
+    assert cache.key("¡Sí!", {}) == cache.key("si", {})
+    assert cache.key("Mañana a las 10", {}) == cache.key("  mañana   a las 10. ", {})
+    assert cache.key("si", {}) != cache.key("si", {"terapia": "Láser"})
+    assert cache.key("x" * 200, {}) is None
+    assert LLMResponseCache(maxsize=0).key("si", {}) is None
+
+def test_caduca_por_ttl_y_al_cambiar_de_dia():
+    clock = FakeClock()
+    cache = LLMResponseCache(ttl=60, timer=clock, today=clock.today)
+    key = cache.key("mañana a las 10", {"terapia": "Láser"})
+
+    cache.put(key, {"fecha": "21/10/25"}, "ok")
+    assert cache.get(key) == ({"fecha": "21/10/25"}, "ok")
+    clock.now += 61
+    assert cache.get(key) is None
+
+    cache.put(key, {"fecha": "21/10/25"}, "ok")
+    clock.day = date(2025, 10, 21)
+    assert cache.get(key) is None
+    assert cache.hits == 1 and cache.misses == 2
+
+def test_mensaje_repetido_no_vuelve_a_llamar_al_llm(agent):
+    other = NaturalAppointmentAgent(model_name="fake-model", client=agent._mock_client)
+    llm_reply(agent, '{"respuesta": "¿Qué terapia?", "data": {}}')
+
+    for conversation in (agent, other):
+        conversation.send_message("Hola")
+        response = conversation.send_message("no sé qué elegir")
+
+    assert response == "¿Qué terapia?"
+    assert agent._mock_client.chat.completions.create.call_count == 1
+
+def test_no_cachea_el_fallback_de_error(agent):
+    agent._mock_client.chat.completions.create.side_effect = Exception("API error")
+    agent.send_message("Hola")
+    agent.send_message("no sé qué elegir")
+
+    llm_reply(agent, '{"respuesta": "¿Qué terapia?", "data": {}}')
+    agent._mock_client.chat.completions.create.side_effect = None
+    response = agent.send_message("no sé qué elegir")
+
+    assert response == "¿Qué terapia?"
+    assert LLM_FALLBACK_RESPONSE not in response
+    assert agent._mock_client.chat.completions.create.call_count == 2
@@ -0,0 +1,47 @@
+import pytest
+
+from llm_output import LLMOutputError, parse_llm_output
+
+
+# === Tests del parseo de la salida del LLM ===
+
+def test_parsea_y_valida_en_una_pasada():
+    parsed = parse_llm_output(
+        '<think>razonando {algo}</think> Aquí tienes: '
+        '{"respuesta": "¡Genial!", "data": {"terapia": " Láser ", "fecha": "?", "hora": 9}} fin'
+    )
+
+    assert parsed.respuesta == "¡Genial!"
+    assert parsed.data.slots() == {"terapia": "Láser", "hora": "9"}
+    assert parsed.recovered is False
+
+def test_admite_caracteres_de_control_y_think_sin_cerrar():
+    parsed = parse_llm_output('<think> pensando...\n{"respuesta": "línea 1\nlínea 2", "data": []}')
+
+    assert parsed.respuesta == "línea 1\nlínea 2"
+    assert parsed.data.slots() == {}
+
+def test_recupera_respuesta_cortada():
+    parsed = parse_llm_output('{"data": {"terapia": "Indiba"}, "respuesta": "Tenemos huecos el lun')
+
+    assert parsed.recovered is True
+    assert parsed.respuesta == "Tenemos huecos el lun"
+    assert parsed.data.terapia == "Indiba"
+
+def test_descarta_valor_cortado_dentro_de_data():
+    parsed = parse_llm_output('{"respuesta": "Perfecto", "data": {"terapia": "Fisioterapia", "hora": "10:3')
+
+    assert parsed.recovered is True
+    assert parsed.data.slots() == {"terapia": "Fisioterapia"}
+
+def test_formato_compacto_con_solo_los_cambios():
+    parsed = parse_llm_output('{"fecha": "27/10/25", "hora": "?"}')
+
+    assert parsed.data.slots() == {"fecha": "27/10/25"}
+    assert parsed.respuesta is None
+    assert parse_llm_output('{"terapia": "Indiba", "respuesta": "¡Genial!"}').respuesta == "¡Genial!"
+
+@pytest.mark.parametrize("text", ["Lo siento, no entendí", "", "[1, 2]", '{"respuesta'])
+def test_salida_inservible_lanza_error(text):
+    with pytest.raises(LLMOutputError):
+        parse_llm_output(text)
@@ -0,0 +1,93 @@
+import io
+import json
+import logging
+
+import pytest
+
+import logging_config
+from logging_config import JsonFormatter, RedactingFilter, SamplingFilter, flush_logging, setup_logging
+
+
+def make_record(msg, *args, level=logging.INFO, **extra):
+    record = logging.LogRecord("secretario.test", level, __file__, 1, msg, args, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+@pytest.fixture
+def log_stream():
+    stream = io.StringIO()
+    yield stream
+    flush_logging()
+    setup_logging()
+
+
+# === Tests del logger estructurado ===
+
+def test_json_formatter_incluye_extra():
+    record = make_record("Paso %s", 2, activity_id=2547)
+    payload = json.loads(JsonFormatter().format(record))
+
+    assert payload["msg"] == "Paso 2"
+    assert payload["level"] == "INFO"
+    assert payload["logger"] == "secretario.test"
+    assert payload["activity_id"] == 2547
+
+def test_redacting_filter_oculta_datos_del_paciente():
+    record = make_record(
+        "Contacto %s / %s", "ana@example.com", "+34 600 123 456",
+        user_data={"terapia": "láser", "fecha": "2025-06-27"}, user_message="soy Ana", activity_id=7
+    )
+    RedactingFilter().filter(record)
+    payload = json.loads(JsonFormatter().format(record))
+
+    assert payload["msg"] == "Contacto [email] / [teléfono]"
+    assert payload["user_data"] == {"terapia": "***", "fecha": "***"}
+    assert payload["user_message"] == "<7 caracteres>"
+    assert payload["activity_id"] == 7
+
+def test_redacting_filter_oculta_datos_repetidos_en_el_mensaje():
+    error = ValueError("time data '31/13/26' does not match format '%d/%m/%y'")
+    record = make_record("Fecha/hora en formato no válido: %s", error, fecha="31/13/26", hora="10:00")
+    RedactingFilter().filter(record)
+    payload = json.loads(JsonFormatter().format(record))
+
+    assert "31/13/26" not in payload["msg"]
+    assert "<fecha>" in payload["msg"]
+    assert payload["fecha"] == "<8 caracteres>"
+
+def test_sampling_filter_solo_muestrea_debug():
+    sampler = SamplingFilter(rate=0.0)
+    assert not sampler.filter(make_record("debug", level=logging.DEBUG))
+    assert sampler.filter(make_record("aviso", level=logging.WARNING))
+    assert SamplingFilter(rate=1.0).filter(make_record("debug", level=logging.DEBUG))
+
+def test_setup_logging_escribe_desde_la_cola(log_stream):
+    setup_logging(level="DEBUG", stream=log_stream)
+    log = logging.getLogger("secretario.app")
+
+    log.debug("Respuesta LLM", extra={"llm_raw": '{"respuesta": "hola"}'})
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.exception("Fallo")
+    flush_logging()
+
+    lines = [json.loads(line) for line in log_stream.getvalue().splitlines()]
+    assert lines[0]["llm_raw"] == "<21 caracteres>"
+    assert lines[1]["level"] == "ERROR"
+    assert "ValueError: boom" in lines[1]["exc"]
+    assert logging_config._listener is None
+
+def test_setup_logging_sin_redaccion_respeta_nivel(log_stream):
+    setup_logging(level="INFO", redact=False, stream=log_stream)
+    log = logging.getLogger("secretario.app")
+
+    log.debug("No debe salir")
+    log.info("Enlace", extra={"cita_url": "https://example.com/1"})
+    flush_logging()
+
+    lines = [json.loads(line) for line in log_stream.getvalue().splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["cita_url"] == "https://example.com/1"
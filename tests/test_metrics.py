@@ -0,0 +1,82 @@
+from unittest.mock import MagicMock, patch
+
+import app as app_module
+from metrics import Registry, STEP_SECONDS, UPSTREAM_ERRORS, LLM_TOKENS
+from timp import TimpClient, TimpError
+
+
+# === Tests del registro de métricas ===
+
+def test_registry_render_formato_prometheus():
+    registry = Registry()
+    counter = registry.counter("demo_total", "Demo.", ("kind",))
+    histogram = registry.histogram("demo_seconds", "Demo.", buckets=(0.1, 1))
+    registry.callback("demo_gauge", "Demo.", lambda: 3, kind="gauge")
+
+    counter.inc(kind='a"b')
+    counter.inc(2, kind='a"b')
+    histogram.observe(0.5)
+    text = registry.render()
+
+    assert '# TYPE demo_total counter' in text
+    assert 'demo_total{kind="a\\"b"} 3' in text
+    assert 'demo_seconds_bucket{le="0.1"} 0' in text
+    assert 'demo_seconds_bucket{le="1"} 1' in text
+    assert 'demo_seconds_bucket{le="+Inf"} 1' in text
+    assert 'demo_seconds_count 1' in text
+    assert 'demo_gauge 3' in text
+
+def test_histogram_time_registra_aunque_falle():
+    registry = Registry()
+    histogram = registry.histogram("span_seconds", "Demo.", ("stage",))
+
+    try:
+        with histogram.time(stage="x"):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert histogram.count(stage="x") == 1
+
+
+# === Tests de instrumentación ===
+
+def test_timp_client_cuenta_errores_upstream():
+    client = TimpClient(api_key="secret")
+    response = MagicMock(status_code=503, text="busy")
+    before = UPSTREAM_ERRORS.value(upstream="timp", reason="503")
+
+    with patch.object(client.session, 'get', return_value=response):
+        try:
+            client.get_admissions(72574, "2025-10-20")
+        except TimpError:
+            pass
+
+    assert UPSTREAM_ERRORS.value(upstream="timp", reason="503") == before + 1
+
+def test_turno_registra_paso_y_tokens():
+    completion = MagicMock()
+    completion.choices[0].message.content = '{"respuesta": "¿Qué terapia?", "data": {}}'
+    completion.usage.prompt_tokens = 120
+    completion.usage.completion_tokens = 30
+    client = MagicMock()
+    client.chat.completions.create.return_value = completion
+    agent = app_module.NaturalAppointmentAgent(client=client)
+    agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+    steps_before = STEP_SECONDS.count(step="respuesta_llm")
+    tokens_before = LLM_TOKENS.value(kind="prompt")
+
+    agent.send_message("no sé qué quiero")
+
+    assert agent.last_step == "respuesta_llm"
+    assert STEP_SECONDS.count(step="respuesta_llm") == steps_before + 1
+    assert LLM_TOKENS.value(kind="prompt") == tokens_before + 120
+
+def test_metrics_endpoint():
+    response = app_module.app.test_client().get('/metrics')
+    text = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert "secretario_timp_cache_hits_total" in text
+    assert "secretario_fast_path_hits_total" in text
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import app as app_module
+from prewarm import AvailabilityPrewarmer
+from timp import AdmissionsCache, AvailabilitySnapshot
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+# === Tests de la foto de disponibilidad ===
+
+def test_snapshot_no_sirve_entradas_caducadas():
+    clock = FakeClock()
+    snapshot = AvailabilitySnapshot(max_age=60, timer=clock)
+    snapshot.put(72574, "2025-10-20", [{"id": 1}])
+
+    assert snapshot.get(72574, "2025-10-20") == [{"id": 1}]
+    clock.now += 61
+    assert snapshot.get(72574, "2025-10-20") is None
+    assert snapshot.status()["activities"][72574]["stale"] is True
+
+def test_consulta_en_vivo_caduca_con_el_ttl_aunque_este_en_la_foto():
+    clock = FakeClock()
+    client = MagicMock()
+    client.get_admissions.return_value = [{"id": 1}]
+    snapshot = AvailabilitySnapshot(max_age=600, timer=clock)
+    cache = AdmissionsCache(client, ttl=60, snapshot=snapshot)
+
+    cache.get_admissions(72574, "2025-10-20")
+    clock.now += 300
+    cache.invalidate()  # entrada TTL caducada
+
+    cache.get_admissions(72574, "2025-10-20")
+    assert client.get_admissions.call_count == 2
+    # Sigue disponible como respaldo si TIMP cae
+    assert snapshot.get(72574, "2025-10-20", allow_stale=True) == [{"id": 1}]
+
+def test_snapshot_acotada_y_sin_dias_pasados():
+    clock = FakeClock()
+    snapshot = AvailabilitySnapshot(maxsize=2, timer=clock)
+    yesterday = datetime.fromtimestamp(clock.now - 86400).strftime("%Y-%m-%d")
+    snapshot.put(1, yesterday, [])
+    clock.now += 86400
+
+    snapshot.put(1, "2099-01-01", [])
+    assert snapshot.status()["entries"] == 1
+    snapshot.put(1, "2099-01-02", [])
+    snapshot.put(1, "2099-01-03", [])
+    assert snapshot.status()["entries"] == 2
+
+def test_snapshot_prune_dias_pasados():
+    snapshot = AvailabilitySnapshot()
+    snapshot.put(1, "2025-10-19", [])
+    snapshot.put(1, "2025-10-20", [])
+
+    snapshot.prune("2025-10-20")
+
+    assert snapshot.status()["entries"] == 1
+
+
+# === Tests del pre-calentador ===
+
+def test_prewarmer_rellena_la_foto_para_todas_las_actividades():
+    client = MagicMock()
+    client.get_admissions.return_value = [{"id": 5, "status": "available", "hours": "09:00 - 10:00"}]
+    snapshot = AvailabilitySnapshot()
+    cache = AdmissionsCache(client, ttl=0.001, snapshot=snapshot)
+    prewarmer = AvailabilityPrewarmer(cache, activity_ids=lambda: [1, 2], days=3, rate=1000)
+
+    prewarmer.refresh_all()
+
+    assert client.get_admissions.call_count == 6
+    assert snapshot.status()["entries"] == 6
+    assert prewarmer.runs == 1
+
+    # Caducada la caché TTL, la lectura sale de la foto sin ir a TIMP
+    tomorrow = (datetime.today() + timedelta(days=1)).strftime("%Y-%m-%d")
+    assert cache.get_admissions(2, tomorrow) == client.get_admissions.return_value
+    assert client.get_admissions.call_count == 6
+
+def test_prewarmer_cuenta_errores_y_sigue():
+    client = MagicMock()
+    client.get_admissions.side_effect = [Exception("timeout"), [], [], []]
+    cache = AdmissionsCache(client, snapshot=AvailabilitySnapshot())
+    prewarmer = AvailabilityPrewarmer(cache, activity_ids=lambda: [1, 2], days=2, rate=1000)
+
+    prewarmer.refresh_all()
+
+    assert prewarmer.errors == 1
+    assert client.get_admissions.call_count == 4
+
+def test_availability_status_endpoint():
+    response = app_module.app.test_client().get('/availability/status')
+    body = response.get_json()
+
+    assert response.status_code == 200
+    assert body["prewarmer"]["running"] is False
+    assert "entries" in body["snapshot"]
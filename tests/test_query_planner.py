@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+
+from query_planner import DAY_PERIODS, plan_availability_query
+
+
+# Martes 16/12/2025: la semana siguiente y "del 28 al 3" cruzan de mes y de año
+TODAY = datetime(2025, 12, 16, 10, 0)
+
+
+# === Tests del planificador de búsquedas ===
+
+def test_dias_de_la_semana_con_franja_y_duracion():
+    query = plan_availability_query("martes y jueves por la mañana durante tres semanas", TODAY)
+
+    assert query.dates(TODAY) == [
+        "2025-12-16", "2025-12-18", "2025-12-23", "2025-12-25", "2025-12-30", "2026-01-01"
+    ]
+    assert query.window == DAY_PERIODS["manana"]
+
+@pytest.mark.parametrize("message, dates", [
+    ("del 28 al 3", ["2025-12-28", "2025-12-29", "2025-12-30", "2025-12-31", "2026-01-01", "2026-01-02", "2026-01-03"]),
+    ("del 31 al 2", ["2025-12-31", "2026-01-01", "2026-01-02"]),
+    ("el martes que viene", ["2025-12-23"]),
+    ("pasado mañana", ["2025-12-18"]),
+    ("este fin de semana", ["2025-12-20", "2025-12-21"]),
+    ("los viernes", ["2025-12-19"]),
+])
+def test_dias_concretos(message, dates):
+    assert plan_availability_query(message, TODAY).dates(TODAY) == dates
+
+def test_semana_que_viene_es_de_lunes_a_domingo():
+    query = plan_availability_query("la semana que viene", TODAY)
+
+    assert query.dates(TODAY)[0] == "2025-12-22" and query.dates(TODAY)[-1] == "2025-12-28"
+    assert query.window is None
+
+def test_mañana_como_dia_o_como_franja():
+    tomorrow = plan_availability_query("mañana por la tarde", TODAY)
+    mornings = plan_availability_query("por las mañanas", TODAY)
+
+    assert tomorrow.offsets == (1,) and tomorrow.window == DAY_PERIODS["tarde"]
+    assert mornings.offsets == tuple(range(7)) and mornings.window == DAY_PERIODS["manana"]
+
+def test_franjas_a_partir_de_y_antes_de():
+    assert plan_availability_query("a partir de las 5", TODAY).window == ("17:00", "23:59")
+    assert plan_availability_query("antes de las 12", TODAY).window == ("00:00", "11:59")
+    assert plan_availability_query("desde las 10 y antes de las 13:30", TODAY).window == ("10:00", "13:29")
+
+def test_por_defecto_y_fuera_de_horizonte():
+    assert plan_availability_query("qué hay libre?", TODAY).offsets == tuple(range(7))
+    # Más allá del horizonte: se recorta a sus últimos días y se marca para avisar
+    far = plan_availability_query("en 40 días", TODAY, max_days=28)
+    assert far.offsets == (24, 25, 26, 27) and far.clamped
+    assert plan_availability_query("del 20 al 25", TODAY, max_days=3).offsets == (0, 1, 2)
+    long = plan_availability_query("durante seis semanas", TODAY, max_days=28)
+    assert long.offsets == tuple(range(28)) and long.clamped
+    assert not plan_availability_query("la semana que viene", TODAY).clamped
+
+def test_rango_explicito_antes_que_hoy():
+    query = plan_availability_query("hoy no, mejor la semana que viene", TODAY)
+    assert query.dates(TODAY)[0] == "2025-12-22" and len(query.offsets) == 7
@@ -0,0 +1,151 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import app as app_module
+from resilience import CircuitBreaker, TokenBucket, UpstreamGuard, UpstreamUnavailable
+from timp import AdmissionsCache, AvailabilitySnapshot, TimpError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _fail(guard, error):
+    with pytest.raises(type(error)):
+        with guard.call():
+            raise error
+
+
+# === Tests del limitador y el circuit breaker ===
+
+def test_token_bucket_rafaga_y_espera():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=2, timer=clock)
+
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert bucket.reserve() is None
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.5)
+    clock.now += 1.5
+    assert bucket.reserve() == 0
+
+def test_circuit_breaker_abre_y_prueba_tras_reset():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, timer=clock)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    clock.now += 10
+    assert breaker.allow()          # llamada de prueba
+    assert not breaker.allow()      # solo una a la vez
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+def test_guard_no_cuenta_4xx_como_fallo_y_rechaza_al_abrir():
+    guard = UpstreamGuard("timp", failure_threshold=2, timer=FakeClock())
+
+    _fail(guard, TimpError(404, "no existe"))
+    _fail(guard, TimpError(404, "no existe"))
+    assert guard.available()
+
+    _fail(guard, TimpError(503, "caído"))
+    _fail(guard, TimeoutError())
+    assert not guard.available()
+    with pytest.raises(UpstreamUnavailable) as exc:
+        with guard.call():
+            pass
+    assert exc.value.reason == "circuit_open"
+
+
+# === Tests de las alternativas con el servicio caído ===
+
+def test_cache_sirve_foto_antigua_si_timp_falla():
+    clock = FakeClock()
+    client = MagicMock()
+    client.get_admissions.side_effect = [[{"id": 1}], TimpError(503, "caído")]
+    snapshot = AvailabilitySnapshot(max_age=60, timer=clock)
+    cache = AdmissionsCache(client, ttl=1, snapshot=snapshot)
+
+    cache.get_admissions(72574, "2025-10-20")
+    clock.now += 3600
+    cache.invalidate()
+
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+    assert cache.stale_served == 1
+    # Antes de generar un enlace no vale una foto antigua
+    client.get_admissions.side_effect = TimpError(503, "caído")
+    with pytest.raises(TimpError):
+        cache.get_admissions(72574, "2025-10-20", force_refresh=True)
+
+def test_consulta_forzada_no_hereda_la_foto_antigua_de_otra():
+    clock = FakeClock()
+    snapshot = AvailabilitySnapshot(max_age=60, timer=clock)
+    snapshot.put(72574, "2025-10-20", [{"id": "viejo"}], fresh=False)
+    started, release = threading.Event(), threading.Event()
+
+    def fetch(activity_id, date, timeout=None):
+        started.set()
+        release.wait(1)
+        raise TimpError(503, "caído")
+
+    client = MagicMock()
+    client.get_admissions.side_effect = fetch
+    cache = AdmissionsCache(client, ttl=1, snapshot=snapshot)
+    with ThreadPoolExecutor(2) as pool:
+        normal = pool.submit(cache.get_admissions, 72574, "2025-10-20", force_refresh=False)
+        started.wait(1)
+        forced = pool.submit(cache.get_admissions, 72574, "2025-10-20", force_refresh=True)
+        release.set()
+
+        assert normal.result() == [{"id": "viejo"}]
+        with pytest.raises(TimpError):
+            forced.result()
+    assert client.get_admissions.call_count == 2
+
+def test_circuito_de_groq_abierto_responde_sin_llm():
+    agent = app_module.NaturalAppointmentAgent(client=MagicMock())
+    agent.send_message("Hola")
+    guard = UpstreamGuard("groq", failure_threshold=1)
+    _fail(guard, TimeoutError())
+
+    with patch.object(app_module, "groq_guard", guard):
+        response = agent.send_message("quería pedir una cita para mi madre")
+        assert "Fisioterapia" in response
+        # Las opciones guiadas se resuelven con el parser local
+        assert "Elige una opción" in agent.send_message("Fisioterapia")
+
+    agent.client.chat.completions.create.assert_not_called()
+
+def test_circuito_de_groq_abierto_pregunta_solo_lo_que_falta():
+    agent = app_module.NaturalAppointmentAgent(client=MagicMock())
+    agent.send_message("Hola")
+    agent.user_data = {"terapia": "Fisioterapia", "subopcion": "Fisioterapia", "fecha": "20/10/26"}
+    guard = UpstreamGuard("groq", failure_threshold=1)
+    _fail(guard, TimeoutError())
+
+    with patch.object(app_module, "groq_guard", guard):
+        response = agent.send_message("no sé, lo que mejor te venga")
+
+    assert "¿A qué hora te viene bien el 20/10/26?" in response
+    assert "terapia" not in response
+
+def test_clientes_groq_con_timeout_y_reintentos_acotados():
+    with patch("groq.Groq") as client_class:
+        app_module.Groq(api_key="x")
+    kwargs = client_class.call_args.kwargs
+    assert kwargs["timeout"] == app_module.GROQ_TIMEOUT
+    assert kwargs["max_retries"] == app_module.GROQ_MAX_RETRIES
@@ -0,0 +1,78 @@
+import json
+from unittest.mock import patch, MagicMock
+
+import app as app_module
+from app import ReplyStreamExtractor
+from sessions import SessionStore
+
+
+def _chunk(text):
+    chunk = MagicMock()
+    chunk.choices = [MagicMock()]
+    chunk.choices[0].delta.content = text
+    return chunk
+
+
+def _parse_sse(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+# === Tests de extracción incremental de "respuesta" ===
+
+def test_reply_stream_extractor_por_trozos():
+    raw = json.dumps({"respuesta": "¡Hola! 😅 \"ok\"\nadiós", "data": {"terapia": "?"}})
+    extractor = ReplyStreamExtractor()
+
+    text = "".join(extractor.feed(raw[i:i + 3]) for i in range(0, len(raw), 3))
+
+    assert text == "¡Hola! 😅 \"ok\"\nadiós"
+    assert extractor.done
+    assert extractor.buffer == raw
+
+def test_extract_data_with_llm_streaming_emite_tokens():
+    client = MagicMock()
+    client.chat.completions.create.return_value = iter([
+        _chunk('{"respuesta": "¿Qué '), _chunk('terapia?", "data": '), _chunk('{"terapia": "?"}}')
+    ])
+    agent = app_module.NaturalAppointmentAgent(client=client)
+    tokens = []
+
+    result = agent.extract_data_with_llm("hola", on_token=tokens.append)
+
+    assert "".join(tokens) == "¿Qué terapia?"
+    assert json.loads(result)["respuesta"] == "¿Qué terapia?"
+    assert client.chat.completions.create.call_args.kwargs["stream"] is True
+
+
+# === Tests del endpoint /chat/stream ===
+
+@patch('app.get_available_dates_for_therapy')
+def test_chat_stream_emite_progreso_y_disponibilidad(mock_get_dates):
+    def fake_get_dates(activity_id, start_offset=0, end_offset=6, on_day=None, query=None):
+        on_day("20/10", ["09:00", "10:00"])
+        return {"20/10": ["09:00", "10:00"]}
+
+    mock_get_dates.side_effect = fake_get_dates
+    agent = app_module.NaturalAppointmentAgent(client=MagicMock())
+    agent.conversation_history.append({"role": "assistant", "content": "¡Hola!"})
+    agent.user_data = {"terapia": "Láser"}
+    store = SessionStore(factory=lambda: agent)
+
+    with patch.object(app_module, 'sessions', store):
+        response = app_module.app.test_client().post('/chat/stream', json={"message": "Tratamiento Láser"})
+        events = _parse_sse(response.get_data(as_text=True))
+
+    assert response.mimetype == "text/event-stream"
+    names = [name for name, _ in events]
+    assert "progress" in names
+    assert ("availability", {"date": "20/10", "times": ["09:00", "10:00"]}) in events
+    assert names[-1] == "done"
+    assert "20/10" in events[-1][1]["response"]
+
+def test_chat_stream_mensaje_vacio():
+    response = app_module.app.test_client().post('/chat/stream', json={"message": "  "})
+    assert response.status_code == 400
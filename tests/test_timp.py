@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from unittest.mock import patch, MagicMock
+
+from timp import AdmissionsCache, AsyncTimpClient, AvailabilityBitmap, SlotIndex, TimpClient, TimpError, slot_start_time
+
+
+def _fake_response(payload, status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.text = "error"
+    response.json.return_value = payload
+    return response
+
+
+def test_timp_client_cabeceras_y_timeouts():
+    client = TimpClient(api_key="secret", connect_timeout=1, read_timeout=5)
+
+    assert client.session.headers['api-access-key'] == "secret"
+    assert client.session.headers['app-platform'] == "web"
+    assert client.timeout == (1, 5)
+
+def test_timp_request_timeout_sigue_valiendo_como_timeout_de_lectura(monkeypatch):
+    monkeypatch.delenv("TIMP_READ_TIMEOUT", raising=False)
+    monkeypatch.setenv("TIMP_REQUEST_TIMEOUT", "4")
+
+    assert TimpClient(api_key="secret", connect_timeout=1).timeout == (1, 4.0)
+
+def test_timp_client_reintenta_429_y_5xx():
+    client = TimpClient(api_key="secret", max_retries=3, pool_maxsize=16)
+    adapter = client.session.get_adapter("https://panel.timp.pro")
+
+    assert adapter.max_retries.total == 3
+    assert 429 in adapter.max_retries.status_forcelist
+    assert 503 in adapter.max_retries.status_forcelist
+    assert adapter._pool_maxsize == 16
+
+def test_timp_client_get_admissions_reutiliza_sesion():
+    client = TimpClient(api_key="secret")
+    with patch.object(client.session, 'get', return_value=_fake_response([{"id": 1}])) as mock_get:
+        assert client.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+        client.get_admissions(72574, "2025-10-21")
+
+    assert mock_get.call_count == 2
+    assert mock_get.call_args.kwargs["params"] == {"date": "2025-10-21"}
+    assert mock_get.call_args.kwargs["timeout"] == client.timeout
+
+def test_timp_client_get_admissions_error():
+    client = TimpClient(api_key="secret")
+    with patch.object(client.session, 'get', return_value=_fake_response([], status_code=404)):
+        with pytest.raises(TimpError) as exc_info:
+            client.get_admissions(72574, "2025-10-20")
+
+    assert exc_info.value.status_code == 404
+
+def test_slot_start_time():
+    assert slot_start_time({"hours": "09:15 - 10:00"}) == "09:15"
+    assert slot_start_time({"hours": "09:15"}) == "09:15"
+    assert slot_start_time({}) == ""
+
+
+# === Tests de caché de admisiones ===
+
+def test_admissions_cache_reutiliza_respuesta():
+    client = MagicMock()
+    client.get_admissions.return_value = [{"id": 1}]
+    cache = AdmissionsCache(client, ttl=60)
+
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+    cache.get_admissions(72574, "2025-10-21")
+
+    assert client.get_admissions.call_count == 2
+    assert cache.hits == 1
+
+def test_admissions_cache_force_refresh():
+    client = MagicMock()
+    client.get_admissions.side_effect = [[{"id": 1}], [{"id": 2}]]
+    cache = AdmissionsCache(client, ttl=60)
+
+    cache.get_admissions(72574, "2025-10-20")
+    assert cache.get_admissions(72574, "2025-10-20", force_refresh=True) == [{"id": 2}]
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 2}]
+
+def test_admissions_cache_lru_acotada():
+    client = MagicMock()
+    client.get_admissions.return_value = []
+    cache = AdmissionsCache(client, ttl=60, maxsize=2)
+
+    for day in ("2025-10-20", "2025-10-21", "2025-10-22", "2025-10-20"):
+        cache.get_admissions(72574, day)
+
+    assert client.get_admissions.call_count == 4
+
+def test_admissions_cache_no_guarda_errores():
+    client = MagicMock()
+    client.get_admissions.side_effect = [TimpError(503), [{"id": 1}]]
+    cache = AdmissionsCache(client, ttl=60)
+
+    with pytest.raises(TimpError):
+        cache.get_admissions(72574, "2025-10-20")
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+
+def test_admissions_cache_single_flight():
+    release = threading.Event()
+    client = MagicMock()
+
+    def slow_admissions(activity_id, date, timeout=None):
+        release.wait(2)
+        return [{"id": 1}]
+
+    client.get_admissions.side_effect = slow_admissions
+    cache = AdmissionsCache(client, ttl=60)
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(cache.get_admissions, 72574, "2025-10-20") for _ in range(5)]
+        time.sleep(0.05)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert client.get_admissions.call_count == 1
+    assert all(r == [{"id": 1}] for r in results)
+    assert cache.coalesced == 4
+
+
+# === Tests del índice de huecos ===
+
+DAY_SLOTS = [
+    {"id": 3, "status": "available", "hours": "11:30 - 12:30"},
+    {"id": 1, "status": "available", "hours": "09:00 - 10:00"},
+    {"id": 2, "status": "full", "hours": "10:00 - 11:00"},
+    {"id": 4, "status": "available", "hours": "10:15 - 11:15"},
+    {"id": 5, "status": "available", "hours": "sin hora"},
+]
+
+def test_slot_index_exacto_franja_y_cercanos():
+    index = SlotIndex(DAY_SLOTS)
+
+    assert len(index) == 3
+    assert index.exact("10:15") == 4
+    assert index.exact("10:00") is None
+    assert index.window("09:00", "11:00") == [("09:00", 1), ("10:15", 4)]
+    assert index.nearest("10:00", max_distance=60) == [("10:15", 4), ("09:00", 1)]
+    assert index.nearest("10:00", max_distance=90, limit=1) == [("10:15", 4)]
+
+def test_bitmap_del_indice_union_interseccion_y_bytes():
+    free = SlotIndex(DAY_SLOTS).free
+    other = AvailabilityBitmap.from_times(["09:00", "16:45"])
+
+    assert free.times() == ["09:00", "10:15", "11:30"]
+    assert free.has("10:15") and not free.has("10:00")
+    assert (free | other).times() == ["09:00", "10:15", "11:30", "16:45"]
+    assert (free & other).times() == ["09:00"]
+    assert AvailabilityBitmap.intersection([free, other, AvailabilityBitmap()]) == AvailabilityBitmap()
+    assert free.window("10:00", "11:30").times() == ["10:15", "11:30"]
+    assert len(free) == 3
+
+    data = free.to_bytes()
+    assert len(data) == AvailabilityBitmap.SIZE
+    assert AvailabilityBitmap.from_bytes(data) == free
+
+def test_admissions_cache_reutiliza_indice_hasta_refrescar():
+    client = MagicMock()
+    client.get_admissions.side_effect = lambda *a, **k: list(DAY_SLOTS)
+    cache = AdmissionsCache(client)
+
+    first = cache.get_index(72574, "2025-10-20")
+    assert cache.get_index(72574, "2025-10-20") is first
+    assert cache.get_index(72574, "2025-10-20", force_refresh=True) is not first
+    assert client.get_admissions.call_count == 2
+
+
+# === Tests de la ruta asíncrona ===
+
+def test_admissions_cache_async_single_flight_y_cache_compartida():
+    calls = []
+
+    async def fake_admissions(activity_id, date, timeout=None):
+        calls.append(date)
+        await asyncio.sleep(0.05)
+        return [{"id": 1}]
+
+    async_client = MagicMock()
+    async_client.get_admissions = fake_admissions
+    cache = AdmissionsCache(MagicMock(), ttl=60, async_client=async_client)
+
+    async def run():
+        return await asyncio.gather(*(cache.aget_admissions(72574, "2025-10-20") for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert calls == ["2025-10-20"]
+    assert all(r == [{"id": 1}] for r in results)
+    # La ruta síncrona ve la misma entrada
+    assert cache.get_admissions(72574, "2025-10-20") == [{"id": 1}]
+    cache.client.get_admissions.assert_not_called()
+
+def test_async_timp_client_reintenta_503():
+    responses = iter([
+        httpx.Response(503, text="busy"),
+        httpx.Response(200, json=[{"id": 7}]),
+    ])
+    client = AsyncTimpClient(api_key="secret", max_retries=2, backoff_factor=0)
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: next(responses)))
+
+    async def run():
+        try:
+            return await client.get_admissions(72574, "2025-10-20")
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == [{"id": 7}]
@@ -0,0 +1,624 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import Future
+
+import httpx
+import requests
+from cachetools import LRUCache, TTLCache
+
+from metrics import TIMP_SECONDS, UPSTREAM_ERRORS
+from resilience import UpstreamGuard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger('secretario.timp')
+
+
+# Configurable para apuntar a un servidor local (benchmark.py)
+TIMP_BASE_URL = os.getenv('TIMP_BASE_URL', 'https://panel.timp.pro/api/user_app/v2')
+
+DEFAULT_HEADERS = {
+    'accept': 'application/timp.user-app-v2',
+    'accept-language': 'en_US',
+    'app-platform': 'web',
+    'app-version': '8.7.0',
+    'content-type': 'application/json',
+    'origin': 'https://web.timp.pro/',
+    'referer': 'https://web.timp.pro/',
+    'sec-ch-ua': '"Chromium";v="140", "Not=A?Brand";v="24", "Google Chrome";v="140"',
+    'sec-ch-ua-mobile': '?1',
+    'sec-ch-ua-platform': '"Android"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-site',
+    'time-zone': 'Europe/Madrid',
+    'user-agent': 'Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Mobile Safari/537.36'
+}
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TimpError(Exception):
+    """Respuesta no válida de la API de TIMP."""
+
+    def __init__(self, status_code: int, text: str = ""):
+        super().__init__(f"{status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+def slot_start_time(slot: dict) -> str:
+    """Extrae 'HH:MM' de inicio a partir del campo 'hours' ('09:00 - 10:00')."""
+    hours_str = slot.get('hours', '')
+    return hours_str.split(' - ')[0] if ' - ' in hours_str else hours_str
+
+
+def _record_timp_request(mode: str, start: float, result):
+    """Métricas de una petición a TIMP: result es el código HTTP o el nombre de la excepción."""
+    outcome = "ok" if result == 200 else str(result)
+    TIMP_SECONDS.observe(time.perf_counter() - start, mode=mode, outcome=outcome)
+    if outcome != "ok":
+        UPSTREAM_ERRORS.inc(upstream="timp", reason=outcome)
+
+
+class TimpClient:
+    """
+    Cliente HTTP compartido para TIMP.
+    Mantiene una sesión con pool de conexiones (keep-alive), cabeceras comunes,
+    timeouts de conexión/lectura y reintentos con backoff ante 429/5xx.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = None,
+        connect_timeout: float | None = None,
+        read_timeout: float | None = None,
+        max_retries: int | None = None,
+        backoff_factor: float = 0.3,
+        pool_maxsize: int = 10,
+        base_url: str = TIMP_BASE_URL
+    ):
+        self.base_url = base_url.rstrip('/')
+        if api_key is None:
+            api_key = os.getenv('TIMP_API_KEY')
+        if connect_timeout is None:
+            connect_timeout = float(os.getenv('TIMP_CONNECT_TIMEOUT', '3.05'))
+        if read_timeout is None:
+            # TIMP_REQUEST_TIMEOUT: nombre anterior, se sigue aceptando
+            read_timeout = float(os.getenv('TIMP_READ_TIMEOUT', os.getenv('TIMP_REQUEST_TIMEOUT', '10')))
+        if max_retries is None:
+            max_retries = int(os.getenv('TIMP_MAX_RETRIES', '2'))
+
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(DEFAULT_HEADERS)
+        if api_key:
+            self.session.headers['api-access-key'] = api_key
+
+    def get_admissions(self, activity_id: int, date: str, timeout=None) -> list[dict]:
+        """
+        Descarga las admisiones de una actividad para una fecha 'YYYY-MM-DD'.
+        Lanza TimpError si la respuesta no es 200 (tras agotar reintentos).
+        """
+        url = f"{self.base_url}/activities/{activity_id}/admissions"
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, params={'date': date}, timeout=timeout or self.timeout)
+        except requests.RequestException as e:
+            _record_timp_request("sync", start, type(e).__name__)
+            raise
+        _record_timp_request("sync", start, response.status_code)
+        if response.status_code != 200:
+            raise TimpError(response.status_code, response.text)
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncTimpClient:
+    """
+    Equivalente asíncrono de TimpClient sobre httpx.AsyncClient (ruta ASGI).
+    Mismas cabeceras, timeouts y política de reintentos ante 429/5xx.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = None,
+        connect_timeout: float | None = None,
+        read_timeout: float | None = None,
+        max_retries: int | None = None,
+        backoff_factor: float = 0.3,
+        pool_maxsize: int = 10,
+        base_url: str = TIMP_BASE_URL
+    ):
+        self.base_url = base_url.rstrip('/')
+        if api_key is None:
+            api_key = os.getenv('TIMP_API_KEY')
+        if connect_timeout is None:
+            connect_timeout = float(os.getenv('TIMP_CONNECT_TIMEOUT', '3.05'))
+        if read_timeout is None:
+            read_timeout = float(os.getenv('TIMP_READ_TIMEOUT', os.getenv('TIMP_REQUEST_TIMEOUT', '10')))
+        if max_retries is None:
+            max_retries = int(os.getenv('TIMP_MAX_RETRIES', '2'))
+
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.headers = dict(DEFAULT_HEADERS)
+        if api_key:
+            self.headers['api-access-key'] = api_key
+        self.limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Se crea al primer uso, dentro del event loop que lo va a utilizar
+        if self._client is None:
+            self._client = httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def get_admissions(self, activity_id: int, date: str, timeout=None) -> list[dict]:
+        url = f"{self.base_url}/activities/{activity_id}/admissions"
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            start = time.perf_counter()
+            try:
+                response = await self.client.get(url, params={'date': date}, timeout=timeout or self.timeout)
+                _record_timp_request("async", start, response.status_code)
+            except httpx.TransportError as e:
+                _record_timp_request("async", start, type(e).__name__)
+                if last_attempt:
+                    raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                retry_after = response.headers.get('retry-after', '')
+                delay = float(retry_after) if retry_after.isdigit() else self.backoff_factor * (2 ** attempt)
+                await asyncio.sleep(delay)
+                continue
+            break
+
+        if response.status_code != 200:
+            raise TimpError(response.status_code, response.text)
+        return response.json()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AvailabilitySnapshot:
+    """
+    Foto compartida de admisiones por (activity_id, fecha), alimentada por el
+    pre-calentador en segundo plano y por las consultas en vivo.
+    Solo las entradas del pre-calentador se sirven como frescas (hasta max_age); las
+    de las consultas en vivo quedan como último recurso si TIMP falla.
+    Acotada a maxsize entradas (LRU); los días pasados se descartan al cambiar de día.
+    """
+
+    def __init__(self, max_age: float = 600, maxsize: int = 4096, timer=time.time):
+        self.max_age = max_age
+        self._timer = timer
+        # (activity_id, fecha) → (admisiones, momento, la escribió el pre-calentador)
+        self._entries: LRUCache = LRUCache(maxsize=maxsize)
+        self._day = None
+        self._lock = threading.Lock()
+
+    def put(self, activity_id: int, date: str, slots: list[dict], fresh: bool = True):
+        """fresh=False: consulta en vivo, solo para servir con allow_stale (TIMP caído)."""
+        now = self._timer()
+        today = datetime.fromtimestamp(now).strftime("%Y-%m-%d")
+        if today != self._day:
+            self.prune(today)
+            self._day = today
+        with self._lock:
+            self._entries[(activity_id, date)] = (slots, now, fresh)
+
+    def get(self, activity_id: int, date: str, allow_stale: bool = False) -> list[dict] | None:
+        """Admisiones de la foto; con allow_stale=True también las caducadas (TIMP caído)."""
+        with self._lock:
+            entry = self._entries.get((activity_id, date))
+        if entry is None:
+            return None
+        slots, refreshed_at, fresh = entry
+        if not allow_stale and (not fresh or self._timer() - refreshed_at > self.max_age):
+            return None
+        return slots
+
+    def age(self, activity_id: int, date: str) -> float | None:
+        with self._lock:
+            entry = self._entries.get((activity_id, date))
+        return None if entry is None else self._timer() - entry[1]
+
+    def prune(self, before_date: str):
+        """Descarta los días anteriores a before_date ('YYYY-MM-DD')."""
+        with self._lock:
+            for key in [k for k in self._entries if k[1] < before_date]:
+                del self._entries[key]
+
+    def status(self) -> dict:
+        """Metadatos de antigüedad por actividad (para /availability/status)."""
+        now = self._timer()
+        with self._lock:
+            entries = list(self._entries.items())
+        activities = {}
+        for (activity_id, _), (_, refreshed_at, _) in entries:
+            info = activities.setdefault(activity_id, {"days": 0, "oldest": refreshed_at, "newest": refreshed_at})
+            info["days"] += 1
+            info["oldest"] = min(info["oldest"], refreshed_at)
+            info["newest"] = max(info["newest"], refreshed_at)
+        return {
+            "entries": len(entries),
+            "max_age_seconds": self.max_age,
+            "activities": {
+                activity_id: {
+                    "days": info["days"],
+                    "refreshed_at": datetime.fromtimestamp(info["oldest"]).isoformat(timespec='seconds'),
+                    "age_seconds": round(now - info["oldest"], 1),
+                    "stale": now - info["oldest"] > self.max_age
+                }
+                for activity_id, info in activities.items()
+            }
+        }
+
+
+def _minutes(hhmm: str) -> int:
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+
+class AvailabilityBitmap:
+    """
+    Horas de inicio libres de un día como bits de un entero (bit i = minuto i del día).
+    Unión (|) e intersección (&) entre subopciones o días en una sola operación,
+    y serialización fija de 180 bytes.
+    """
+
+    __slots__ = ("bits",)
+    MINUTES_PER_DAY = 24 * 60
+    SIZE = MINUTES_PER_DAY // 8
+
+    def __init__(self, bits: int = 0):
+        self.bits = bits
+
+    @classmethod
+    def from_times(cls, times) -> "AvailabilityBitmap":
+        bits = 0
+        for t in times:
+            bits |= 1 << _minutes(t)
+        return cls(bits)
+
+    @classmethod
+    def union(cls, bitmaps) -> "AvailabilityBitmap":
+        bits = 0
+        for bitmap in bitmaps:
+            bits |= bitmap.bits
+        return cls(bits)
+
+    @classmethod
+    def intersection(cls, bitmaps) -> "AvailabilityBitmap":
+        bitmaps = list(bitmaps)
+        if not bitmaps:
+            return cls()
+        bits = bitmaps[0].bits
+        for bitmap in bitmaps[1:]:
+            bits &= bitmap.bits
+        return cls(bits)
+
+    def __or__(self, other: "AvailabilityBitmap") -> "AvailabilityBitmap":
+        return AvailabilityBitmap(self.bits | other.bits)
+
+    def __and__(self, other: "AvailabilityBitmap") -> "AvailabilityBitmap":
+        return AvailabilityBitmap(self.bits & other.bits)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AvailabilityBitmap) and self.bits == other.bits
+
+    def __hash__(self) -> int:
+        return hash(self.bits)
+
+    def __bool__(self) -> bool:
+        return self.bits != 0
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __repr__(self) -> str:
+        return f"AvailabilityBitmap({self.times()})"
+
+    def has(self, time: str) -> bool:
+        return bool(self.bits >> _minutes(time) & 1)
+
+    def window(self, start: str, end: str) -> "AvailabilityBitmap":
+        """Solo las horas entre start y end (incluidas)."""
+        lo, hi = _minutes(start), _minutes(end)
+        if hi < lo:
+            return AvailabilityBitmap()
+        mask = ((1 << (hi - lo + 1)) - 1) << lo
+        return AvailabilityBitmap(self.bits & mask)
+
+    def times(self) -> list[str]:
+        """Horas 'HH:MM' en orden."""
+        result, bits = [], self.bits
+        while bits:
+            low = bits & -bits
+            minute = low.bit_length() - 1
+            result.append(f"{minute // 60:02d}:{minute % 60:02d}")
+            bits ^= low
+        return result
+
+    def to_bytes(self) -> bytes:
+        return self.bits.to_bytes(self.SIZE, "little")
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "AvailabilityBitmap":
+        return cls(int.from_bytes(data, "little"))
+
+
+class SlotIndex:
+    """
+    Huecos libres de un día ordenados por hora de inicio: búsqueda exacta,
+    por franja y del más cercano con bisect en lugar de recorrer la lista.
+    """
+
+    def __init__(self, slots: list[dict]):
+        entries = []
+        for slot in slots:
+            if slot.get('status') != 'available':
+                continue
+            start = slot_start_time(slot)
+            try:
+                entries.append((_minutes(start), start, slot['id']))
+            except (ValueError, KeyError):
+                continue
+        entries.sort()
+        self._entries = entries
+        self._keys = [e[0] for e in entries]
+        # Mismas horas como bitmap, para combinar subopciones y días sin volver a parsear
+        bits = 0
+        for minutes in self._keys:
+            bits |= 1 << minutes
+        self.free = AvailabilityBitmap(bits)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def exact(self, time: str):
+        """slot_id del hueco que empieza justo a `time` ('HH:MM'), o None."""
+        minutes = _minutes(time)
+        i = bisect.bisect_left(self._keys, minutes)
+        if i < len(self._keys) and self._keys[i] == minutes:
+            return self._entries[i][2]
+        return None
+
+    def window(self, start: str, end: str) -> list[tuple[str, object]]:
+        """[(hora, slot_id)] de los huecos que empiezan entre start y end (incluidos)."""
+        lo = bisect.bisect_left(self._keys, _minutes(start))
+        hi = bisect.bisect_right(self._keys, _minutes(end))
+        return [(t, slot_id) for _, t, slot_id in self._entries[lo:hi]]
+
+    def nearest(self, time: str, max_distance: int = 60, limit: int = 3) -> list[tuple[str, object]]:
+        """Hasta `limit` huecos a ±max_distance minutos de `time`, del más cercano al más lejano."""
+        target = _minutes(time)
+        lo = bisect.bisect_left(self._keys, target - max_distance)
+        hi = bisect.bisect_right(self._keys, target + max_distance)
+        candidates = sorted(self._entries[lo:hi], key=lambda e: (abs(e[0] - target), e[0]))
+        return [(t, slot_id) for _, t, slot_id in candidates[:limit]]
+
+
+class AdmissionsCache:
+    """
+    Caché en memoria de admisiones por (activity_id, fecha).
+    TTL corto con expulsión LRU acotada por tamaño; las peticiones concurrentes
+    a la misma clave comparten una única llamada a TIMP (single-flight).
+    """
+
+    def __init__(
+        self,
+        client: TimpClient,
+        ttl: float = 60,
+        maxsize: int = 1024,
+        async_client: AsyncTimpClient | None = None,
+        snapshot: AvailabilitySnapshot | None = None,
+        guard: UpstreamGuard | None = None
+    ):
+        self.client = client
+        self.async_client = async_client
+        self.snapshot = snapshot
+        self.guard = guard
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (activity_id, fecha) → (lista de admisiones, SlotIndex construido sobre ella)
+        self._indexes = LRUCache(maxsize=maxsize)
+        self._inflight: dict[tuple, Future] = {}
+        self._ainflight: dict[tuple, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_served = 0
+
+    def _lookup(self, key: tuple) -> list[dict] | None:
+        """
+        Caché TTL y, si no está, lo que dejó el pre-calentador en la foto (las consultas
+        en vivo no cuentan: caducan con el TTL). Llamar con el lock tomado.
+        """
+        slots = self._cache.get(key)
+        if slots is None and self.snapshot is not None:
+            slots = self.snapshot.get(*key)
+        if slots is not None:
+            self.hits += 1
+        return slots
+
+    def cached(self, activity_id: int, date: str) -> bool:
+        """True si get_admissions se serviría sin ir a TIMP (no cuenta como lectura)."""
+        key = (activity_id, date)
+        with self._lock:
+            if key in self._cache:
+                return True
+        return self.snapshot is not None and self.snapshot.get(*key) is not None
+
+    def _stale(self, key: tuple, error: BaseException) -> list[dict] | None:
+        """Con TIMP fallando o el circuito abierto, la última foto conocida aunque esté caducada."""
+        if self.snapshot is None or not isinstance(error, Exception):
+            return None
+        slots = self.snapshot.get(*key, allow_stale=True)
+        if slots is not None:
+            with self._lock:
+                self.stale_served += 1
+            log.warning("Sirviendo disponibilidad antigua: %s", error, extra={"activity_id": key[0], "date": key[1]})
+        return slots
+
+    def _fetch(self, activity_id: int, date: str, timeout) -> list[dict]:
+        if self.guard is None:
+            return self.client.get_admissions(activity_id, date, timeout=timeout)
+        with self.guard.call():
+            return self.client.get_admissions(activity_id, date, timeout=timeout)
+
+    async def _afetch(self, activity_id: int, date: str, timeout) -> list[dict]:
+        if self.guard is None:
+            return await self.async_client.get_admissions(activity_id, date, timeout=timeout)
+        async with self.guard.acall():
+            return await self.async_client.get_admissions(activity_id, date, timeout=timeout)
+
+    def _store(self, key: tuple, slots: list[dict], prewarm: bool = False):
+        with self._lock:
+            self._cache[key] = slots
+        if self.snapshot is not None:
+            self.snapshot.put(*key, slots, fresh=prewarm)
+
+    def get_admissions(
+        self, activity_id: int, date: str, timeout=None, force_refresh: bool = False, prewarm: bool = False
+    ) -> list[dict]:
+        """
+        Igual que TimpClient.get_admissions pero servido desde caché.
+        Con force_refresh=True se ignora la entrada cacheada y se vuelve a consultar TIMP;
+        prewarm=True (pre-calentador) deja el resultado en la foto como servible.
+        """
+        key = (activity_id, date)
+        # Las consultas forzadas no se unen a una normal: esa podría resolverse con datos antiguos
+        flight = (activity_id, date, force_refresh)
+        with self._lock:
+            if not force_refresh:
+                slots = self._lookup(key)
+                if slots is not None:
+                    return slots
+            future = self._inflight.get(flight)
+            if future is None:
+                future = Future()
+                self._inflight[flight] = future
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            return future.result()
+
+        try:
+            slots = self._fetch(activity_id, date, timeout)
+        except BaseException as e:
+            # Antes de generar un enlace (force_refresh) no se sirve nada antiguo
+            stale = None if force_refresh else self._stale(key, e)
+            if stale is not None:
+                future.set_result(stale)
+                return stale
+            future.set_exception(e)
+            raise
+        else:
+            self._store(key, slots, prewarm)
+            future.set_result(slots)
+            return slots
+        finally:
+            with self._lock:
+                self._inflight.pop(flight, None)
+
+    async def aget_admissions(self, activity_id: int, date: str, timeout=None, force_refresh: bool = False) -> list[dict]:
+        """Versión asíncrona de get_admissions; comparte la caché con la ruta síncrona."""
+        key = (activity_id, date)
+        with self._lock:
+            if not force_refresh:
+                slots = self._lookup(key)
+                if slots is not None:
+                    return slots
+
+        loop = asyncio.get_running_loop()
+        flight = (activity_id, date, force_refresh)
+        future = self._ainflight.get(flight)
+        if future is not None and future.get_loop() is loop:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = loop.create_future()
+        self._ainflight[flight] = future
+        self.misses += 1
+        try:
+            slots = await self._afetch(activity_id, date, timeout)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            stale = None if force_refresh else self._stale(key, e)
+            if stale is not None:
+                future.set_result(stale)
+                return stale
+            future.set_exception(e)
+            # Evitar "exception was never retrieved" si nadie más esperaba
+            future.exception()
+            raise
+        else:
+            self._store(key, slots)
+            future.set_result(slots)
+            return slots
+        finally:
+            if self._ainflight.get(flight) is future:
+                del self._ainflight[flight]
+
+    def _index_for(self, key: tuple, slots: list[dict]) -> SlotIndex:
+        # El índice solo se reconstruye cuando cambia la lista de admisiones cacheada
+        with self._lock:
+            entry = self._indexes.get(key)
+            if entry is not None and entry[0] is slots:
+                return entry[1]
+        index = SlotIndex(slots)
+        with self._lock:
+            self._indexes[key] = (slots, index)
+        return index
+
+    def get_index(self, activity_id: int, date: str, timeout=None, force_refresh: bool = False) -> SlotIndex:
+        """Índice de huecos libres del día (mismas reglas de caché que get_admissions)."""
+        slots = self.get_admissions(activity_id, date, timeout=timeout, force_refresh=force_refresh)
+        return self._index_for((activity_id, date), slots)
+
+    async def aget_index(self, activity_id: int, date: str, timeout=None, force_refresh: bool = False) -> SlotIndex:
+        slots = await self.aget_admissions(activity_id, date, timeout=timeout, force_refresh=force_refresh)
+        return self._index_for((activity_id, date), slots)
+
+    def invalidate(self, activity_id: int | None = None, date: str | None = None):
+        """Elimina entradas de la caché (todas si no se indica clave)."""
+        with self._lock:
+            if activity_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop((activity_id, date), None)